@@ -0,0 +1,115 @@
+"""
+Buffered page-view log (who opened which lesson, quiz or resource).
+
+Views are recorded on GET requests, and a synchronous INSERT on each of
+them would put a write transaction on the hottest pages. Instead record()
+appends to a per-process list, and a background thread writes the whole
+list every FLUSH_INTERVAL seconds (sooner once MAX_PENDING events are
+waiting) through writer(events), in one transaction per tenant shard.
+
+Storage is append-only and partitioned by day: each UTC day gets its own
+table (services.append_activity). The maintenance thread rolls the days up
+into activity_hourly and activity_daily and drops partitions older than
+ACTIVITY_KEEP_DAYS (services.rollup_activity). Analytics read the rollups.
+
+If the database stays unavailable, at most MAX_BUFFERED events are kept;
+older ones are dropped and counted in stats().
+
+Configuration (environment variables):
+    ACTIVITY_LOG          0 disables recording (default: 1)
+    ACTIVITY_FLUSH        seconds between flushes (default: 10)
+    ACTIVITY_MAX_PENDING  events buffered before an early flush (default: 2000)
+"""
+
+import atexit
+import os
+import threading
+import time
+
+import tenants
+
+ENABLED = os.environ.get('ACTIVITY_LOG', '1') != '0'
+FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH', 10))
+MAX_PENDING = int(os.environ.get('ACTIVITY_MAX_PENDING', 2000))
+MAX_BUFFERED = MAX_PENDING * 10
+
+KINDS = ('lesson', 'quiz', 'resource')
+
+
+class ActivityBuffer:
+    """
+    Page views waiting to be written. writer(events) receives a list of
+    (tenant, ts, user_id, kind, object_id) and must persist them.
+    """
+
+    def __init__(self, writer, interval=FLUSH_INTERVAL, max_pending=MAX_PENDING, max_buffered=MAX_BUFFERED):
+        self.writer = writer
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_buffered = max_buffered
+        self._pending = []
+        self._lock = threading.Lock()
+        # one flush at a time, so a retry cannot reorder batches
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._counts = {'events': 0, 'flushes': 0, 'rows_flushed': 0, 'errors': 0, 'dropped': 0}
+        atexit.register(self.flush)
+
+    def record(self, user_id, kind, object_id, ts=None):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._pending.append((tenants.current(), ts or time.time(), user_id, kind, object_id))
+            self._counts['events'] += 1
+            full = len(self._pending) >= self.max_pending
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, []
+            try:
+                self.writer(batch)
+            except Exception:
+                # keep the batch for the next flush, within bounds
+                with self._lock:
+                    self._pending[:0] = batch
+                    over = len(self._pending) - self.max_buffered
+                    if over > 0:
+                        del self._pending[:over]
+                        self._counts['dropped'] += over
+                    self._counts['errors'] += 1
+                raise
+            with self._lock:
+                self._counts['flushes'] += 1
+                self._counts['rows_flushed'] += len(batch)
+            return len(batch)
+
+    def _ensure_thread(self):
+        # a forked worker inherits the object but not the thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='activity-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts, pending=len(self._pending), interval=self.interval, enabled=ENABLED)
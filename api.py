@@ -0,0 +1,319 @@
+"""
+JSON API (/api/v1) for the mobile app and LMS integrations.
+
+Built on the services functions, with the same session login as the web
+pages (POST /api/v1/session). Every listing supports:
+  ?fields=id,title      sparse fieldsets
+  ?ids=1,2,3            batch GET of up to MAX_IDS rows
+  ?after=<id>&limit=N   keyset pagination; the response carries next_after
+and courses take ?include=lessons,assignments,quizzes,submissions to embed
+their children, so one call returns what used to take several page loads.
+
+Responses are compact JSON; compression.py compresses them when the
+client accepts it.
+"""
+
+import json
+
+from flask import Blueprint, Response, g, request, session
+
+import hashing
+import services as svc
+from ratelimit import rate_limit
+
+bp = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+MAX_IDS = 100
+MAX_GRADES = 1000
+INCLUDE_LIMIT = 2000       # children embedded per course listing
+# everything except the answer key
+_QUIZ_FIELDS = ('id', 'lesson_id', 'course_id', 'question_count', 'time_limit', 'shuffle')
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def respond(data, status=200):
+    # compact separators; compression.py compresses the body on the way out
+    body = json.dumps(data, separators=(',', ':'), default=str)
+    return Response(body, status=status, mimetype='application/json')
+
+
+@bp.errorhandler(ApiError)
+def api_error(e):
+    return respond({'error': e.message}, e.status)
+
+
+@bp.errorhandler(404)
+def not_found(e):
+    return respond({'error': 'not found'}, 404)
+
+
+@bp.errorhandler(405)
+def method_not_allowed(e):
+    return respond({'error': 'method not allowed'}, 405)
+
+
+def api_user():
+    """The signed-in user as a dict; raises 401 otherwise."""
+    uid = session.get('user_id')
+    if not uid:
+        raise ApiError(401, 'not signed in')
+    if g.get('_api_user') is None:
+        user = svc.get_user_by_id(uid)
+        if not user:
+            raise ApiError(401, 'not signed in')
+        g._api_user = dict(user)
+    return g._api_user
+
+
+def _int_list(name, raw, cap):
+    try:
+        values = [int(v) for v in raw.split(',') if v.strip()]
+    except ValueError:
+        raise ApiError(400, f'{name} must be a comma-separated list of ids')
+    if len(values) > cap:
+        raise ApiError(400, f'at most {cap} {name} per request')
+    return values
+
+
+def _int_arg(name, default=None):
+    raw = request.args.get(name)
+    if raw in (None, ''):
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        raise ApiError(400, f'{name} must be an integer')
+
+
+def _fields(kind, allowed=None):
+    allowed = allowed or svc.api_fields(kind)
+    raw = request.args.get('fields')
+    if not raw:
+        return list(allowed)
+    fields = [f.strip() for f in raw.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ApiError(400, f"unknown field(s) {', '.join(unknown)}; available: {', '.join(allowed)}")
+    # id is always returned: it is the pagination cursor
+    return ['id'] + [f for f in fields if f != 'id']
+
+
+def list_resource(kind, allowed=None):
+    """Shared listing: filters, ?ids=, ?fields=, keyset pagination."""
+    user = api_user()
+    filters = {}
+    for name in svc.api_filters(kind):
+        if request.args.get(name):
+            filters[name] = _int_list(name, request.args[name], MAX_IDS)
+    ids = _int_list('ids', request.args['ids'], MAX_IDS) if request.args.get('ids') else None
+    limit = min(max(_int_arg('limit', DEFAULT_LIMIT), 1), MAX_LIMIT)
+    fields = _fields(kind, allowed)
+    rows, more = svc.api_list(kind, user, fields, filters, ids, _int_arg('after'), MAX_IDS if ids else limit)
+    out = {'data': rows, 'next_after': rows[-1]['id'] if more and rows else None}
+    if ids is not None:
+        found = {r['id'] for r in rows}
+        out['missing'] = [i for i in ids if i not in found]
+    return user, out
+
+
+def get_one(kind, obj_id, allowed=None):
+    rows, _ = svc.api_list(kind, api_user(), _fields(kind, allowed), ids=[obj_id], limit=1)
+    if not rows:
+        raise ApiError(404, f'{kind[:-1]} not found')
+    return rows[0]
+
+
+# ---------------------------------------------------------------------------
+# Session
+# ---------------------------------------------------------------------------
+
+@bp.route('/session', methods=['POST'])
+@rate_limit(20, per=60, key='ip')
+@rate_limit(10, per=300, key='email')
+def login():
+    """Sign in with {"email", "password"}; the session cookie authenticates later calls."""
+    body = request.get_json(silent=True) or {}
+    email = (body.get('email') or '').strip().lower()
+    password = body.get('password') or ''
+    user = svc.get_user_by_email(email) if email and password else None
+    if not user or not hashing.verify_password(user['password_hash'], password):
+        raise ApiError(401, 'invalid email or password')
+    if hashing.needs_rehash(user['password_hash']):
+        try:
+            svc.set_password(user['id'], password)
+        except hashing.HasherBusy:
+            pass   # the password is right; upgrade on a later login
+    tenant = session.get('tenant')
+    session.clear()
+    if tenant:
+        session['tenant'] = tenant
+    session['user_id'] = user['id']
+    return respond({'user': {c: user[c] for c in ('id', 'name', 'email', 'role')}})
+
+
+@bp.route('/session', methods=['DELETE'])
+def logout():
+    session.clear()
+    return respond({'signed_out': True})
+
+
+@bp.route('/me')
+def me():
+    user = api_user()
+    return respond({'user': {c: user[c] for c in ('id', 'name', 'email', 'role', 'school_id', 'bio', 'unread_notifications')}})
+
+
+# ---------------------------------------------------------------------------
+# Resources
+# ---------------------------------------------------------------------------
+
+_INCLUDABLE = ('lessons', 'assignments', 'quizzes', 'submissions')
+
+
+@bp.route('/courses')
+def courses():
+    """Courses the user teaches or joined (all for admins); ?include= embeds children."""
+    user, out = list_resource('courses')
+    include = [k.strip() for k in request.args.get('include', '').split(',') if k.strip()]
+    bad = [k for k in include if k not in _INCLUDABLE]
+    if bad:
+        raise ApiError(400, f"cannot include {', '.join(bad)}; choose from {', '.join(_INCLUDABLE)}")
+    course_ids = [c['id'] for c in out['data']]
+    for kind in include:
+        fields = _QUIZ_FIELDS if kind == 'quizzes' else None
+        children, more = svc.api_list(kind, user, fields, {'course_id': course_ids}, limit=INCLUDE_LIMIT) \
+            if course_ids else ([], False)
+        if more:
+            raise ApiError(400, f'too many {kind} to embed; page with a smaller limit or list /{kind}')
+        by_course = {}
+        for row in children:
+            by_course.setdefault(row['course_id'], []).append(row)
+        for course in out['data']:
+            course[kind] = by_course.get(course['id'], [])
+    return respond(out)
+
+
+@bp.route('/courses/<int:course_id>')
+def course(course_id):
+    return respond({'data': get_one('courses', course_id)})
+
+
+@bp.route('/lessons')
+def lessons():
+    return respond(list_resource('lessons')[1])
+
+
+@bp.route('/lessons/<int:lesson_id>')
+def lesson(lesson_id):
+    return respond({'data': get_one('lessons', lesson_id)})
+
+
+@bp.route('/assignments')
+def assignments():
+    return respond(list_resource('assignments')[1])
+
+
+@bp.route('/assignments/<int:assignment_id>')
+def assignment(assignment_id):
+    return respond({'data': get_one('assignments', assignment_id)})
+
+
+@bp.route('/submissions')
+def submissions():
+    """Submissions in the teacher's courses (all for admins); a student's own."""
+    return respond(list_resource('submissions')[1])
+
+
+@bp.route('/submissions/<int:submission_id>')
+def submission(submission_id):
+    return respond({'data': get_one('submissions', submission_id)})
+
+
+@bp.route('/quizzes')
+def quizzes():
+    return respond(list_resource('quizzes', _QUIZ_FIELDS)[1])
+
+
+@bp.route('/quizzes/<int:quiz_id>')
+def quiz(quiz_id):
+    """
+    A quiz with its questions. Students get their own draw and order without
+    the answer key; the course's teacher (or an admin) gets the key.
+    """
+    user = api_user()
+    data = get_one('quizzes', quiz_id, _QUIZ_FIELDS)
+    _, obj, owner = svc.authorize(user['id'], 'quiz', quiz_id)
+    questions = json.loads(obj['questions'] or '[]')
+    if user['role'] == 'student':
+        layout = svc.quiz_layout(quiz_id, user['id'], questions, obj['draw_count'], obj['shuffle'])
+        data['questions'] = [{'question': q.get('question'), 'choices': q.get('choices') or []}
+                             for q in svc.present_quiz(questions, layout)]
+    elif user['role'] == 'admin' or owner == user['id']:
+        data['questions'] = questions
+    return respond({'data': data})
+
+
+@bp.route('/progress')
+def progress():
+    """The student's progress, overall and per course; teachers may pass ?student_id= for their students."""
+    user = api_user()
+    student_id = _int_arg('student_id', user['id'])
+    if student_id != user['id']:
+        if user['role'] == 'student':
+            raise ApiError(403, 'students can only see their own progress')
+        if user['role'] == 'teacher':
+            taught = svc.owned_course_ids(user['id'])
+            if not any(svc.student_is_member(student_id, cid) for cid in taught):
+                raise ApiError(404, 'student not found in your classes')
+            data = svc.student_progress(student_id)
+            # only the teacher's own courses
+            data['courses'] = [c for c in data['courses'] if c['course_id'] in taught]
+            return respond({'data': data})
+    return respond({'data': svc.student_progress(student_id)})
+
+
+# ---------------------------------------------------------------------------
+# Grading
+# ---------------------------------------------------------------------------
+
+@bp.route('/assignments/<int:assignment_id>/grades', methods=['POST'])
+def grade_assignment(assignment_id):
+    """
+    Batch grading: {"grades": [{"submission_id", "grade", "feedback"}, ...]}.
+
+    Ownership is checked once for the assignment and everything is applied
+    in one transaction; returns only the submissions that changed.
+    """
+    user = api_user()
+    _, obj, owner = svc.authorize(user['id'], 'assignment', assignment_id)
+    if not obj:
+        raise ApiError(404, 'assignment not found')
+    if not (user['role'] == 'admin' or (user['role'] == 'teacher' and owner == user['id'])):
+        raise ApiError(403, 'only the course teacher can grade this assignment')
+    items = (request.get_json(silent=True) or {}).get('grades')
+    if not isinstance(items, list) or not items:
+        raise ApiError(400, 'grades must be a non-empty list')
+    if len(items) > MAX_GRADES:
+        raise ApiError(400, f'at most {MAX_GRADES} grades per request')
+    grades = []
+    for n, item in enumerate(items):
+        try:
+            sid = int(item['submission_id'])
+            grade = item.get('grade')
+            grade = None if grade in (None, '') else float(grade)
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, f'grades[{n}]: submission_id and a numeric grade are required')
+        feedback = item.get('feedback')
+        if feedback is not None and not isinstance(feedback, str):
+            raise ApiError(400, f'grades[{n}]: feedback must be a string')
+        grades.append((sid, grade, feedback))
+    changed = svc.grade_submissions(assignment_id, grades)
+    return respond({'changed': changed})
@@ -44,16 +44,30 @@ TECHNOLOGY STACK:
 ================================================================================
 """
 
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory, g
 import sqlite3
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import functools
+import threading
 import json
+import time
+import csv
+import mimetypes
 from io import StringIO
-from flask import Response
+from flask import Response, jsonify, stream_with_context
+from werkzeug.middleware.proxy_fix import ProxyFix
+import click
 import services as svc
+import tenants
+import maintenance
+import api
+import compression
+import zipstream
+import hashing
+from ratelimit import rate_limit, RateLimited
+from autosave import AutosaveBuffer
+from activity import ActivityBuffer
 
 # ============================================================================
 # APPLICATION CONFIGURATION
@@ -62,11 +76,24 @@ import services as svc
 BASE_DIR = os.path.dirname(__file__)
 DB_PATH = os.path.join(BASE_DIR, 'database.db')
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Nothing here touches the filesystem or the databases; create_app() does
+# that once per process (see APPLICATION FACTORY).
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'dev-secret'
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MIGRATE_ON_START'] = True
+
+# Behind a reverse proxy, take the client address and scheme from the
+# X-Forwarded-* headers its hops set; rate limits key on that address
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS,
+                            x_host=TRUSTED_PROXY_HOPS)
+
+# Compress text responses on the way out (see compression.py)
+if compression.ENABLED:
+    app.wsgi_app = compression.CompressionMiddleware(app.wsgi_app)
 
 # Make enumerate available in Jinja2 templates
 app.jinja_env.globals['enumerate'] = enumerate
@@ -81,6 +108,8 @@ def get_db():
     Establish a database connection with proper configuration.
     
     Features:
+    - Routed to the current tenant's database shard (see tenants.py)
+    - Reused from a per-shard pool; close() hands it back
     - 10-second timeout for concurrent access
     - WAL (Write-Ahead Logging) mode for better concurrency
     - Foreign key constraint enforcement
@@ -88,14 +117,16 @@ def get_db():
     Returns:
         sqlite3.Connection: Database connection object with row factory
     """
-    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    try:
-        conn.execute('PRAGMA journal_mode=WAL;')
-        conn.execute('PRAGMA foreign_keys = ON;')
-    except Exception:
-        pass
-    return conn
+    return tenants.connect()
+
+
+def get_read_db():
+    """
+    Read-only connection (mode=ro, query_only) from the current tenant's
+    reader pool, for pages that only display data. Writes keep using
+    get_db() or the services functions.
+    """
+    return tenants.connect(readonly=True)
 
 
 def init_db():
@@ -109,15 +140,13 @@ def init_db():
     - Quizzes and attempts
     - Progress tracking
     """
-    if not os.path.exists(DB_PATH):
+    if not os.path.exists(tenants.db_path()):
         with get_db() as db:
                 schema_path = os.path.join(BASE_DIR, 'schema.sql')
                 with open(schema_path, 'r', encoding='utf8') as f:
                     db.executescript(f.read())
 
 
-init_db()
-
 
 # ============================================================================
 # DATABASE MIGRATION / SCHEMA UPDATES
@@ -152,8 +181,6 @@ def _ensure_user_columns():
     conn.close()
 
 
-_ensure_user_columns()
-
 
 def _ensure_deleted_users_table():
     """
@@ -181,8 +208,6 @@ def _ensure_deleted_users_table():
     conn.close()
 
 
-_ensure_deleted_users_table()
-
 
 def _ensure_deleted_courses_table():
     """
@@ -205,8 +230,6 @@ def _ensure_deleted_courses_table():
         pass
     conn.close()
 
-_ensure_deleted_courses_table()
-
 
 def _ensure_courses_code_column():
     """
@@ -230,8 +253,6 @@ def _ensure_courses_code_column():
     conn.close()
 
 
-_ensure_courses_code_column()
-
 
 def _ensure_class_members_table():
     """
@@ -259,7 +280,512 @@ def _ensure_class_members_table():
     conn.close()
 
 
-_ensure_class_members_table()
+
+def _ensure_quiz_item_tables():
+    """
+    Create normalized quiz storage and backfill it from the JSON columns.
+
+    - quiz_questions / quiz_choices: one row per question and per choice
+    - attempt_answers: one row per (attempt, question) with the chosen index
+      and whether it was correct, for set-based item analysis
+    - attempts.answer_vec: the same answers packed one byte per question,
+      for fast batch re-grading
+    """
+    conn = get_db()
+    try:
+        cols = [r['name'] for r in conn.execute("PRAGMA table_info(attempts)").fetchall()]
+        if 'answer_vec' not in cols:
+            conn.execute("ALTER TABLE attempts ADD COLUMN answer_vec BLOB")
+            conn.commit()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS quiz_questions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                quiz_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                question TEXT,
+                answer INTEGER,
+                UNIQUE(quiz_id, position)
+            );
+            CREATE TABLE IF NOT EXISTS quiz_choices (
+                question_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                choice TEXT,
+                PRIMARY KEY (question_id, position)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS attempt_answers (
+                attempt_id INTEGER NOT NULL,
+                quiz_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                choice INTEGER,
+                correct INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (attempt_id, position)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_attempt_answers_item ON attempt_answers(quiz_id, position, choice, correct);
+            CREATE INDEX IF NOT EXISTS idx_attempts_quiz_score ON attempts(quiz_id, score);
+            CREATE INDEX IF NOT EXISTS idx_attempts_quiz ON attempts(quiz_id);
+        ''')
+    except Exception:
+        conn.close()
+        return
+    conn.close()
+    svc.backfill_quiz_items()
+
+
+
+def _ensure_analytics_indexes():
+    """
+    Indexes for class analytics.
+
+    Lets the per-course aggregate queries walk lessons -> assignments /
+    quizzes -> submissions / attempts through covering indexes instead of
+    scanning whole tables.
+    """
+    conn = get_db()
+    try:
+        conn.executescript('''
+            CREATE INDEX IF NOT EXISTS idx_lessons_course ON lessons(course_id);
+            CREATE INDEX IF NOT EXISTS idx_assignments_lesson ON assignments(lesson_id);
+            CREATE INDEX IF NOT EXISTS idx_quizzes_lesson ON quizzes(lesson_id);
+            CREATE INDEX IF NOT EXISTS idx_submissions_assignment ON submissions(assignment_id, student_id, submitted_at, grade);
+            CREATE INDEX IF NOT EXISTS idx_attempts_quiz_student ON attempts(quiz_id, student_id, score);
+        ''')
+    except Exception:
+        pass
+    conn.close()
+
+
+
+def _ensure_quiz_sessions_table():
+    """
+    Timed exam support.
+
+    - quizzes.time_limit: minutes allowed, NULL for untimed quizzes
+    - quiz_sessions: one row per timed attempt with its deadline (unix
+      seconds), the last autosaved answers and, once submitted, the attempt
+    """
+    conn = get_db()
+    try:
+        cols = [r['name'] for r in conn.execute("PRAGMA table_info(quizzes)").fetchall()]
+        if 'time_limit' not in cols:
+            conn.execute("ALTER TABLE quizzes ADD COLUMN time_limit INTEGER")
+            conn.commit()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS quiz_sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                quiz_id INTEGER NOT NULL,
+                student_id INTEGER NOT NULL,
+                started_at REAL NOT NULL,
+                deadline REAL NOT NULL,
+                answers TEXT,
+                saved_at REAL,
+                submitted_at REAL,
+                attempt_id INTEGER
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_quiz_sessions_open ON quiz_sessions(quiz_id, student_id) WHERE submitted_at IS NULL;
+            CREATE INDEX IF NOT EXISTS idx_quiz_sessions_deadline ON quiz_sessions(deadline) WHERE submitted_at IS NULL;
+        ''')
+    except Exception:
+        pass
+    conn.close()
+
+
+
+def _ensure_quiz_randomization_columns():
+    """
+    Question bank randomization settings on quizzes.
+
+    - draw_count: questions each student gets from the bank (NULL = all)
+    - shuffle: 1 to randomize question and choice order per student
+    """
+    conn = get_db()
+    try:
+        cols = [r['name'] for r in conn.execute("PRAGMA table_info(quizzes)").fetchall()]
+        if 'draw_count' not in cols:
+            conn.execute("ALTER TABLE quizzes ADD COLUMN draw_count INTEGER")
+        if 'shuffle' not in cols:
+            conn.execute("ALTER TABLE quizzes ADD COLUMN shuffle INTEGER NOT NULL DEFAULT 0")
+        conn.commit()
+    except Exception:
+        pass
+    conn.close()
+
+
+
+def _ensure_maintenance_table():
+    """
+    Support for maintenance.py.
+
+    - maintenance_runs: when optimize/ANALYZE last ran, shared by all workers
+    - auto_vacuum=INCREMENTAL so space freed by purges can be handed back in
+      small steps; an existing database is rebuilt once with VACUUM
+    """
+    conn = get_db()
+    try:
+        conn.execute('''CREATE TABLE IF NOT EXISTS maintenance_runs (
+            task TEXT PRIMARY KEY,
+            last_run REAL NOT NULL DEFAULT 0
+        )''')
+        conn.commit()
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+    except Exception:
+        pass
+    conn.close()
+
+
+
+def _ensure_reminder_tables():
+    """
+    Due-date reminders (see reminders.py and outbox.py).
+
+    - assignments.due_at: due_date normalized to unix seconds, indexed for
+      the scheduler's range scans; backfilled from due_date
+    - notifications: the in-app inbox, one row per user and message
+    - outbox: e-mails waiting to be handed to a sender
+    - due_reminders: the reminder windows already sent per assignment and
+      deadline, so no window is sent twice
+    """
+    conn = get_db()
+    try:
+        cols = [r['name'] for r in conn.execute("PRAGMA table_info(assignments)").fetchall()]
+        if 'due_at' not in cols:
+            conn.execute("ALTER TABLE assignments ADD COLUMN due_at REAL")
+            conn.commit()
+        conn.executescript('''
+            CREATE INDEX IF NOT EXISTS idx_assignments_due_at ON assignments(due_at) WHERE due_at IS NOT NULL;
+            CREATE TABLE IF NOT EXISTS notifications (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                title TEXT NOT NULL,
+                body TEXT,
+                link TEXT,
+                created_at REAL NOT NULL,
+                read_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, id);
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                recipient TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                claimed_until REAL,
+                sent_at REAL,
+                last_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(id) WHERE sent_at IS NULL;
+            CREATE TABLE IF NOT EXISTS due_reminders (
+                assignment_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                due_at REAL NOT NULL,
+                sent_at REAL NOT NULL,
+                recipients INTEGER,
+                PRIMARY KEY (assignment_id, kind, due_at)
+            ) WITHOUT ROWID;
+        ''')
+    except Exception:
+        conn.close()
+        return
+    conn.close()
+    svc.backfill_due_at()
+
+
+def _ensure_notification_counters():
+    """
+    In-app notification inbox (see services NOTIFICATIONS).
+
+    - users.unread_notifications: unread count kept up to date on every
+      write, so the badge in the navigation bar is read with the user row;
+      counted once from the notifications table when added
+    - an index on notifications.created_at for the periodic prune
+    """
+    conn = get_db()
+    try:
+        cols = [r['name'] for r in conn.execute("PRAGMA table_info(users)").fetchall()]
+        if 'unread_notifications' not in cols:
+            conn.execute("ALTER TABLE users ADD COLUMN unread_notifications INTEGER NOT NULL DEFAULT 0")
+            conn.execute("""UPDATE users SET unread_notifications = (
+                SELECT COUNT(*) FROM notifications n WHERE n.user_id = users.id AND n.read_at IS NULL)""")
+            conn.commit()
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_created ON notifications(created_at)")
+        conn.commit()
+    except Exception:
+        pass
+    conn.close()
+
+
+def _ensure_activity_tables():
+    """
+    Page-view log (see activity.py and services ACTIVITY LOG).
+
+    - activity_days: the day partitions (activity_YYYYMMDD tables, created
+      as events arrive) with how many events each holds and how many were
+      rolled up
+    - activity_hourly: views and distinct users per hour and page
+    - activity_daily: views and seconds on page per day, user and page
+    """
+    conn = get_db()
+    try:
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS activity_days (
+                day TEXT PRIMARY KEY,
+                events INTEGER NOT NULL DEFAULT 0,
+                rolled_events INTEGER NOT NULL DEFAULT 0,
+                rolled_up_at REAL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS activity_hourly (
+                hour INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                object_id INTEGER NOT NULL,
+                views INTEGER NOT NULL,
+                users INTEGER NOT NULL,
+                PRIMARY KEY (hour, kind, object_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS activity_daily (
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                object_id INTEGER NOT NULL,
+                views INTEGER NOT NULL,
+                seconds REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (kind, object_id, day, user_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_activity_daily_user ON activity_daily(user_id, day);
+        ''')
+    except Exception:
+        pass
+    conn.close()
+
+
+def _ensure_retention_tables():
+    """
+    Retention (services RETENTION, run by the maintenance thread).
+
+    - attempt_summaries: per quiz and student, the attempts folded away by
+      compact_attempts(): count, best and latest score, first/last time,
+      the score total of the removed attempts (for exact averages) and how
+      many of them gave each answer vector (so regrade_quiz can rescore them)
+    - deleted_at indexes, so expiring audit records does not scan them
+    """
+    conn = get_db()
+    try:
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS attempt_summaries (
+                quiz_id INTEGER NOT NULL,
+                student_id INTEGER NOT NULL,
+                attempts INTEGER NOT NULL,
+                compacted INTEGER NOT NULL DEFAULT 0,
+                compacted_score REAL NOT NULL DEFAULT 0,
+                answer_counts BLOB,
+                best_score REAL,
+                latest_score REAL,
+                first_at DATETIME,
+                last_at DATETIME,
+                PRIMARY KEY (quiz_id, student_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_attempt_summaries_student ON attempt_summaries(student_id);
+            CREATE INDEX IF NOT EXISTS idx_deleted_users_deleted_at ON deleted_users(deleted_at);
+            CREATE INDEX IF NOT EXISTS idx_deleted_courses_deleted_at ON deleted_courses(deleted_at);
+        ''')
+        cols = [r['name'] for r in conn.execute("PRAGMA table_info(attempt_summaries)").fetchall()]
+        if 'compacted_score' not in cols:
+            conn.execute("ALTER TABLE attempt_summaries ADD COLUMN compacted_score REAL NOT NULL DEFAULT 0")
+            conn.commit()
+        if 'answer_counts' not in cols:
+            conn.execute("ALTER TABLE attempt_summaries ADD COLUMN answer_counts BLOB")
+            conn.commit()
+    except Exception:
+        pass
+    conn.close()
+
+
+def _ensure_audit_columns():
+    """
+    Searchable audit records (see services restore_user).
+
+    - deleted_users.name / email / role: copied out of the snapshot, indexed
+      (name and email case-insensitively) for the admin search
+    - deleted_courses.deleted_by: who removed the course
+    - snapshots are stored zlib-compressed; older JSON-text snapshots are
+      compressed once here
+    """
+    conn = get_db()
+    try:
+        cols = [r['name'] for r in conn.execute("PRAGMA table_info(deleted_users)").fetchall()]
+        for col, decl in (('name', 'TEXT COLLATE NOCASE'), ('email', 'TEXT COLLATE NOCASE'), ('role', 'TEXT')):
+            if col not in cols:
+                conn.execute(f"ALTER TABLE deleted_users ADD COLUMN {col} {decl}")
+        if 'deleted_by' not in [r['name'] for r in conn.execute("PRAGMA table_info(deleted_courses)").fetchall()]:
+            conn.execute("ALTER TABLE deleted_courses ADD COLUMN deleted_by INTEGER")
+        conn.commit()
+        conn.executescript('''
+            CREATE INDEX IF NOT EXISTS idx_deleted_users_name ON deleted_users(name);
+            CREATE INDEX IF NOT EXISTS idx_deleted_users_email ON deleted_users(email);
+            CREATE INDEX IF NOT EXISTS idx_deleted_users_role ON deleted_users(role, id);
+            CREATE INDEX IF NOT EXISTS idx_deleted_users_deleted_by ON deleted_users(deleted_by, id);
+            CREATE INDEX IF NOT EXISTS idx_deleted_users_user ON deleted_users(user_id);
+            CREATE INDEX IF NOT EXISTS idx_deleted_courses_teacher ON deleted_courses(teacher_id, id);
+        ''')
+    except Exception:
+        conn.close()
+        return
+    conn.close()
+    svc.backfill_audit_snapshots()
+
+
+def _ensure_setup_tokens_table():
+    """
+    One-time password setup links (provision_users.py --setup-tokens).
+    Only a SHA-256 of each token is stored.
+    """
+    conn = get_db()
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS setup_tokens (
+                token_hash TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                expires_at DATETIME NOT NULL,
+                used_at DATETIME
+            )
+        ''')
+        conn.commit()
+    except Exception:
+        pass
+    conn.close()
+
+
+# Every tenant shard gets the same schema; add new migrations at the end.
+MIGRATIONS = (
+    init_db,
+    _ensure_user_columns,
+    _ensure_deleted_users_table,
+    _ensure_deleted_courses_table,
+    _ensure_courses_code_column,
+    _ensure_class_members_table,
+    _ensure_quiz_item_tables,
+    _ensure_analytics_indexes,
+    _ensure_quiz_sessions_table,
+    _ensure_quiz_randomization_columns,
+    _ensure_maintenance_table,
+    _ensure_reminder_tables,
+    _ensure_notification_counters,
+    _ensure_activity_tables,
+    _ensure_retention_tables,
+    _ensure_audit_columns,
+    _ensure_setup_tokens_table,
+)
+
+
+def migrate_all():
+    """Create and upgrade the database of every tenant shard (see tenants.py)."""
+    tenants.prepare()
+    for slug in tenants.slugs():
+        with tenants.use(slug):
+            for migration in MIGRATIONS:
+                migration()
+
+
+# Per-process autosave buffer for timed exams; flushed in batches by a
+# background thread, which also grades sessions abandoned past their deadline.
+def _save_exam_autosaves(items):
+    """Autosave writer: buffer keys are (tenant, session id), written shard by shard."""
+    by_tenant = {}
+    for (slug, session_id), answers, saved_at in items:
+        by_tenant.setdefault(slug, []).append((session_id, answers, saved_at))
+    for slug, batch in by_tenant.items():
+        with tenants.use(slug):
+            svc.save_session_answers(batch)
+
+
+exam_autosave = AutosaveBuffer(_save_exam_autosaves, housekeeping=lambda: tenants.each(svc.finalize_expired_sessions))
+
+
+# Per-process page-view buffer (see activity.py), written shard by shard.
+def _save_activity(events):
+    by_tenant = {}
+    for slug, *event in events:
+        by_tenant.setdefault(slug, []).append(event)
+    for slug, batch in by_tenant.items():
+        with tenants.use(slug):
+            svc.append_activity(batch)
+
+
+activity_log = ActivityBuffer(_save_activity)
+
+
+# ============================================================================
+# APPLICATION FACTORY
+# ============================================================================
+
+_start_lock = threading.Lock()
+_started = False
+
+
+def create_app(config=None):
+    """
+    Configure the app and prepare every tenant's directories and schema.
+
+    config is a mapping, or an object / import path, applied to app.config;
+    FLASK_-prefixed environment variables are applied too. The setup runs
+    once per process. Importing this module does none of it. SECRET_KEY
+    must be set unless the app runs in debug or testing mode, where a
+    development key is used; otherwise this raises RuntimeError. With gunicorn
+    --preload (gunicorn.conf.py) the master process runs it and then closes
+    its pooled connections, so none are inherited by the forked workers;
+    each worker calls warm_up() after the fork.
+    """
+    global _started
+    with _start_lock:
+        if config is not None:
+            if isinstance(config, dict):
+                app.config.from_mapping(config)
+            else:
+                app.config.from_object(config)
+        if _started:
+            return app
+        app.config.from_prefixed_env()
+        if not app.config['SECRET_KEY']:
+            if not app.debug and not app.testing:
+                raise RuntimeError('SECRET_KEY is not set; sessions cannot be signed securely')
+            app.config['SECRET_KEY'] = 'dev-secret'
+        tenants.prepare()
+        if app.config['MIGRATE_ON_START']:
+            migrate_all()
+        tenants.close_all()
+        _started = True
+    return app
+
+
+@app.before_request
+def ensure_started():
+    """Set up on first use when the app was imported without create_app() (flask run, app:app)."""
+    if not _started:
+        create_app()
+
+
+def compile_templates() -> int:
+    """Compile every template now rather than on its first render. No database access."""
+    names = app.jinja_env.list_templates(extensions=('html',))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def warm_up():
+    """
+    Fill this worker's caches before it takes traffic (gunicorn post_fork):
+    compiled templates (already done if the master ran compile_templates()
+    before forking), owned course ids and in-progress quiz layouts per
+    tenant. Returns what was loaded and how long it took.
+    """
+    start = time.perf_counter()
+    templates = compile_templates()
+    caches = tenants.each(svc.warm_caches)
+    return {'templates': templates, 'tenants': caches,
+            'seconds': round(time.perf_counter() - start, 3)}
 
 
 # ============================================================================
@@ -276,9 +802,15 @@ def current_user():
     uid = session.get('user_id')
     if not uid:
         return None
-    db = get_db()
-    user = db.execute('SELECT id, name, email, role, school_id, bio FROM users WHERE id = ?', (uid,)).fetchone()
+    # cached for the rest of the request (decorators, view and templates)
+    cached = g.get('_user')
+    if cached and cached[0] == uid:
+        return cached[1]
+    db = get_read_db()
+    user = db.execute('SELECT id, name, email, role, school_id, bio, unread_notifications FROM users WHERE id = ?',
+                      (uid,)).fetchone()
     db.close()
+    g._user = (uid, user)
     return user
 
 
@@ -304,12 +836,121 @@ def role_required(*roles):
     return decorator
 
 
+def authorize(kind, obj_id):
+    """
+    Resolve the current user and a course/lesson/assignment together.
+
+    Runs one query (services.authorize) and caches the result for the rest
+    of the request. Returns (user, obj, is_owner).
+    """
+    uid = session.get('user_id')
+    if not uid:
+        return None, None, False
+    cache = g.setdefault('_authz', {})
+    if (kind, obj_id) not in cache:
+        user, obj, owner = svc.authorize(uid, kind, obj_id)
+        g._user = (uid, user)
+        cache[(kind, obj_id)] = (user, obj, bool(user and obj and owner == user['id']))
+    return cache[(kind, obj_id)]
+
+
+def owner_required(kind, arg, roles=('teacher',), admin_override=False):
+    """
+    Decorator combining role_required with an ownership check.
+
+    The route's `arg` URL parameter names a course, lesson or assignment;
+    the user must have one of `roles` and teach the owning course (admins
+    pass too when admin_override is set). The loaded object is exposed to
+    the view as g.obj.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            user, obj, is_owner = authorize(kind, kwargs[arg])
+            if not user or user['role'] not in roles:
+                flash('Access denied')
+                return redirect(url_for('login'))
+            if not obj or not (is_owner or (admin_override and user['role'] == 'admin')):
+                flash('Access denied')
+                return redirect(url_for('teacher_classes' if user['role'] == 'teacher' else 'dashboard'))
+            g.obj = obj
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def owns_course(course_id):
+    """Template helper: True if the current user teaches course_id."""
+    user = current_user()
+    return bool(user and user['role'] == 'teacher' and course_id in svc.owned_course_ids(user['id']))
+
+
+app.jinja_env.globals['owns_course'] = owns_course
+
+
+@app.errorhandler(hashing.HasherBusy)
+def hasher_busy(e):
+    """Shed load when the password hashing pool is saturated."""
+    return Response('Server is busy, please try again shortly.', status=503,
+                    headers={'Retry-After': str(hashing.RETRY_AFTER)}, mimetype='text/plain')
+
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    """Reject clients that exceeded a route's rate limit."""
+    return Response('Too many requests, please slow down.', status=429,
+                    headers={'Retry-After': str(e.retry_after)}, mimetype='text/plain')
+
+
 @app.context_processor
 def inject_user():
     """Inject current_user into all template contexts."""
     return dict(current_user=current_user())
 
 
+@app.before_request
+def select_tenant():
+    """
+    Route the request to its institution's database shard.
+
+    The subdomain decides (zds.example.edu -> zds); otherwise the tenant kept
+    in the session, which a signed-out visitor picks on the sign-in page or
+    through ?tenant= on a setup link. A session signed in at one tenant is
+    never carried over to another: user ids are only unique per shard.
+    """
+    slug = tenants.from_host(request.host)
+    if not slug and not session.get('user_id') and tenants.known(request.values.get('tenant')):
+        slug = request.values.get('tenant')
+    slug = slug or session.get('tenant')
+    if not tenants.known(slug):
+        slug = tenants.DEFAULT
+    if session.get('user_id') and session.get('tenant', tenants.DEFAULT) != slug:
+        session.clear()
+    if tenants.MULTI and session.get('tenant') != slug:
+        session['tenant'] = slug
+    g.tenant_token = tenants.activate(slug)
+
+
+@app.before_request
+def start_maintenance():
+    """Make sure this worker runs the database maintenance thread (see maintenance.py)."""
+    maintenance.scheduler.start()
+
+
+@app.teardown_request
+def release_tenant(exc):
+    token = g.pop('tenant_token', None)
+    if token is not None:
+        tenants.deactivate(token)
+
+
+@app.context_processor
+def inject_tenant():
+    """Offer an institution picker on sign-in pages when the subdomain does not name one."""
+    choose = tenants.MULTI and not tenants.from_host(request.host)
+    return dict(current_tenant=tenants.current(), tenant_choices=tenants.slugs() if choose else [])
+
+
 # ============================================================================
 # AUTHENTICATION ROUTES
 # ============================================================================
@@ -323,6 +964,8 @@ def index():
 
 
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limit(60, per=3600, burst=20, key='ip', methods=('POST',))
+@rate_limit(5, per=3600, key='email', methods=('POST',))
 def register():
     """
     User Registration Route
@@ -364,6 +1007,8 @@ def register():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit(20, per=60, key='ip', methods=('POST',))
+@rate_limit(10, per=300, key='email', methods=('POST',))
 def login():
     """
     User Login Route
@@ -378,7 +1023,13 @@ def login():
             flash('Enter email and password')
             return render_template('login.html')
         user = svc.get_user_by_email(email)
-        if user and check_password_hash(user['password_hash'], password):
+        if user and hashing.verify_password(user['password_hash'], password):
+            # transparently upgrade hashes made with older method/cost settings
+            if hashing.needs_rehash(user['password_hash']):
+                try:
+                    svc.set_password(user['id'], password)
+                except hashing.HasherBusy:
+                    pass   # the password is right; upgrade on a later login
             session['user_id'] = user['id']
             flash('Logged in')
             return redirect(url_for('dashboard'))
@@ -394,6 +1045,37 @@ def logout():
     return redirect(url_for('login'))
 
 
+@app.route('/setup/<token>', methods=['GET', 'POST'])
+@rate_limit(20, per=60, key='ip')
+def setup_account(token):
+    """
+    Account Setup Route
+
+    Lets a bulk-provisioned user choose their password using the one-time
+    token issued by provision_users.py, then logs them in.
+    """
+    user = svc.get_setup_token_user(token)
+    if not user:
+        flash('This setup link is invalid or has expired')
+        return redirect(url_for('login'))
+    if request.method == 'POST':
+        password = request.form.get('password','')
+        if len(password) < 6:
+            flash('Password must be at least 6 characters')
+            return render_template('setup_password.html', user=user)
+        if password != request.form.get('confirm',''):
+            flash('Passwords do not match')
+            return render_template('setup_password.html', user=user)
+        uid = svc.consume_setup_token(token, password)
+        if not uid:
+            flash('This setup link is invalid or has expired')
+            return redirect(url_for('login'))
+        session['user_id'] = uid
+        flash('Account activated — welcome!')
+        return redirect(url_for('dashboard'))
+    return render_template('setup_password.html', user=user)
+
+
 # ============================================================================
 # DASHBOARD & USER PROFILE ROUTES
 # ============================================================================
@@ -417,7 +1099,7 @@ def dashboard():
     user = current_user()
     if not user:
         return redirect(url_for('login'))
-    db = get_db()
+    db = get_read_db()
     # simple listings
     # For students, only show courses they have joined; teachers/admin see all
     if user['role'] == 'student':
@@ -429,7 +1111,10 @@ def dashboard():
     if user['role'] == 'student':
         completed = db.execute('SELECT COUNT(DISTINCT l.id) as completed FROM lessons l JOIN assignments a ON a.lesson_id = l.id JOIN submissions s ON s.assignment_id = a.id WHERE s.student_id = ?', (user['id'],)).fetchone()
         total_lessons = db.execute('SELECT COUNT(*) as total FROM lessons').fetchone()
-        avg_score = db.execute('SELECT AVG(score) as avg FROM attempts WHERE student_id = ?', (user['id'],)).fetchone()
+        avg_score = db.execute('SELECT (a.total + s.total) / NULLIF(a.n + s.n, 0) as avg '
+                               'FROM (SELECT TOTAL(score) AS total, COUNT(score) AS n FROM attempts WHERE student_id = ?) a, '
+                               '(SELECT TOTAL(compacted_score) AS total, TOTAL(compacted) AS n FROM attempt_summaries WHERE student_id = ?) s',
+                               (user['id'], user['id'])).fetchone()
         completed_count = completed['completed'] if completed else 0
         total_count = total_lessons['total'] if total_lessons else 0
         avg = round(avg_score['avg'],2) if avg_score and avg_score['avg'] is not None else None
@@ -475,8 +1160,8 @@ def create_course():
         user = current_user()
         cid = svc.create_course(title, description, user['id'])
         # fetch the code
-        from services import _get_conn
-        conn = _get_conn()
+        from services import _get_read_conn
+        conn = _get_read_conn()
         code_row = conn.execute('SELECT code FROM courses WHERE id = ?', (cid,)).fetchone()
         conn.close()
         code = code_row['code'] if code_row else '—'
@@ -491,7 +1176,7 @@ def create_course():
 def teacher_classes():
     """List all courses created by the logged-in instructor."""
     user = current_user()
-    db = get_db()
+    db = get_read_db()
     classes = svc.get_teacher_classes(user['id'])
     db.close()
     return render_template('teacher_classes.html', classes=classes)
@@ -503,7 +1188,7 @@ def course_page(course_id):
     user = current_user()
     if not user:
         return redirect(url_for('login'))
-    db = get_db()
+    db = get_read_db()
     course = db.execute('SELECT * FROM courses WHERE id = ?', (course_id,)).fetchone()
     lessons = db.execute('SELECT * FROM lessons WHERE course_id = ?', (course_id,)).fetchall()
     db.close()
@@ -511,16 +1196,10 @@ def course_page(course_id):
 
 
 @app.route('/course/<int:course_id>/edit', methods=['GET', 'POST'])
-@role_required('teacher')
+@owner_required('course', 'course_id')
 def edit_course(course_id):
     """Edit course information (title, description)."""
-    user = current_user()
-    db = get_db()
-    c = db.execute('SELECT * FROM courses WHERE id = ?', (course_id,)).fetchone()
-    db.close()
-    if not c or c['teacher_id'] != user['id']:
-        flash('Access denied')
-        return redirect(url_for('teacher_classes'))
+    c = g.obj
     if request.method == 'POST':
         title = request.form.get('title')
         description = request.form.get('description')
@@ -531,24 +1210,23 @@ def edit_course(course_id):
 
 
 @app.route('/course/<int:course_id>/delete', methods=['POST'])
-@role_required('teacher', 'admin')
 def delete_course_route(course_id):
     """Delete a course and all associated content."""
-    user = current_user()
-    db = get_db()
-    c = db.execute('SELECT teacher_id FROM courses WHERE id = ?', (course_id,)).fetchone()
-    db.close()
+    user, c, is_owner = authorize('course', course_id)
+    if not user or user['role'] not in ('teacher', 'admin'):
+        flash('Access denied')
+        return redirect(url_for('login'))
 
     if not c:
         flash('Course not found')
         return redirect(request.referrer or url_for('dashboard'))
 
-    if user['role'] != 'admin' and c['teacher_id'] != user['id']:
+    if user['role'] != 'admin' and not is_owner:
         flash('Access denied')
         return redirect(request.referrer or url_for('dashboard'))
 
     # Pass the actual teacher_id to satisfy service check
-    ok = svc.remove_course(course_id, c['teacher_id'])
+    ok = svc.remove_course(course_id, c['teacher_id'], deleted_by=user['id'])
     if ok:
         flash('Class deleted')
     else:
@@ -586,32 +1264,40 @@ def join_class():
 
 
 @app.route('/teacher/class/<int:course_id>/members')
-@role_required('teacher')
+@owner_required('course', 'course_id')
 def class_members(course_id):
     """View and manage students enrolled in a course."""
-    user = current_user()
-    # verify ownership
-    db = get_db()
-    c = db.execute('SELECT teacher_id FROM courses WHERE id = ?', (course_id,)).fetchone()
-    db.close()
-    if not c or c['teacher_id'] != user['id']:
-        flash('Access denied')
-        return redirect(url_for('teacher_classes'))
     students = svc.get_class_students(course_id)
     return render_template('class_members.html', students=students, course_id=course_id)
 
 
+@app.route('/teacher/class/<int:course_id>/analytics')
+@owner_required('course', 'course_id', roles=('teacher', 'admin'), admin_override=True)
+def class_analytics(course_id):
+    """
+    Class Analytics Route
+
+    Score distributions, submission and late rates per assignment, quiz
+    participation, at-risk students and lesson engagement (page views and
+    time on lesson, from the activity rollups) for one course. ?refresh=1
+    skips the short cache window.
+    """
+    data = svc.course_analytics(course_id, max_age=0 if request.args.get('refresh') else svc._ANALYTICS_RECHECK)
+    return render_template('class_analytics.html', course=g.obj, a=data, engagement=svc.lesson_engagement(course_id))
+
+
+@app.route('/teacher/class/<int:course_id>/analytics.json')
+@owner_required('course', 'course_id', roles=('teacher', 'admin'), admin_override=True)
+def class_analytics_json(course_id):
+    """Class analytics as JSON (same data as the analytics page)."""
+    data = svc.course_analytics(course_id, max_age=0 if request.args.get('refresh') else svc._ANALYTICS_RECHECK)
+    return jsonify(dict(data, engagement=svc.lesson_engagement(course_id)))
+
+
 @app.route('/teacher/class/<int:course_id>/remove_member/<int:student_id>', methods=['POST'])
-@role_required('teacher')
+@owner_required('course', 'course_id')
 def remove_member(course_id, student_id):
     """Remove a student from a course."""
-    user = current_user()
-    db = get_db()
-    c = db.execute('SELECT teacher_id FROM courses WHERE id = ?', (course_id,)).fetchone()
-    db.close()
-    if not c or c['teacher_id'] != user['id']:
-        flash('Access denied')
-        return redirect(url_for('teacher_classes'))
     ok = svc.remove_member(course_id, student_id)
     if ok:
         flash('Student removed from class')
@@ -620,6 +1306,32 @@ def remove_member(course_id, student_id):
     return redirect(url_for('class_members', course_id=course_id))
 
 
+@app.route('/teacher/class/<int:course_id>/enroll', methods=['GET', 'POST'])
+@owner_required('course', 'course_id', roles=('teacher', 'admin'), admin_override=True)
+def bulk_enroll(course_id):
+    """
+    Bulk Roster Enrollment Route
+
+    Enrolls every student listed in an uploaded CSV (emails or school IDs)
+    and reports matched, unmatched and already-enrolled rows.
+    """
+    c = g.obj
+    result = None
+    if request.method == 'POST':
+        f = request.files.get('roster')
+        if not f or not f.filename:
+            flash('Please choose a CSV file')
+            return render_template('bulk_enroll.html', course=c, result=None)
+        text = f.read().decode('utf-8-sig', errors='replace')
+        identifiers = svc.parse_roster_csv(text)
+        if not identifiers:
+            flash('No students found in the file')
+            return render_template('bulk_enroll.html', course=c, result=None)
+        result = svc.bulk_enroll(course_id, identifiers)
+        flash(f"Enrolled {len(result['matched'])} student(s)")
+    return render_template('bulk_enroll.html', course=c, result=result)
+
+
 # ============================================================================
 # LESSON MANAGEMENT ROUTES
 # ============================================================================
@@ -629,14 +1341,14 @@ def remove_member(course_id, student_id):
 def create_lesson_select():
     """Show teacher's classes so they can choose which class to add a lesson to."""
     user = current_user()
-    db = get_db()
+    db = get_read_db()
     classes = svc.get_teacher_classes(user['id'])
     db.close()
     return render_template('create_lesson_select.html', classes=classes)
 
 
 @app.route('/lesson/create/<int:course_id>', methods=['GET', 'POST'])
-@role_required('teacher')
+@owner_required('course', 'course_id')
 def create_lesson(course_id):
     """
     Create Lesson Route
@@ -650,26 +1362,16 @@ def create_lesson(course_id):
         filename = None
         if f and f.filename:
             filename = secure_filename(f.filename)
-            f.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            f.save(os.path.join(tenants.upload_dir(), filename))
         svc.create_lesson(course_id, title, content, filename)
         flash('Lesson created')
         return redirect(url_for('course_page', course_id=course_id))
     # load course title for display and compute human-friendly sequential number
-    db = get_db()
-    course = db.execute('SELECT title, teacher_id FROM courses WHERE id = ?', (course_id,)).fetchone()
-    course_title = course['title'] if course else f'Course {course_id}'
-    # compute sequential index among teacher's classes when possible
-    course_number = None
-    try:
-        if course and course['teacher_id']:
-            rows = db.execute('SELECT id FROM courses WHERE teacher_id = ? ORDER BY id ASC', (course['teacher_id'],)).fetchall()
-            # find 1-based index
-            ids = [r['id'] for r in rows]
-            if course_id in ids:
-                course_number = ids.index(course_id) + 1
-    except Exception:
-        course_number = None
-    db.close()
+    course = g.obj
+    course_title = course['title'] or f'Course {course_id}'
+    # sequential 1-based index among the teacher's classes
+    owned = sorted(svc.owned_course_ids(course['teacher_id']))
+    course_number = owned.index(course_id) + 1 if course_id in owned else None
     return render_template('create_lesson.html', course_id=course_id, course_title=course_title, course_number=course_number)
 
 
@@ -679,25 +1381,21 @@ def lesson_page(lesson_id):
     user = current_user()
     if not user:
         return redirect(url_for('login'))
-    db = get_db()
+    db = get_read_db()
     lesson = db.execute('SELECT * FROM lessons WHERE id = ?', (lesson_id,)).fetchone()
     assignments = db.execute('SELECT * FROM assignments WHERE lesson_id = ?', (lesson_id,)).fetchall()
     quizzes = db.execute('SELECT * FROM quizzes WHERE lesson_id = ?', (lesson_id,)).fetchall()
     db.close()
+    if lesson:
+        activity_log.record(user['id'], 'lesson', lesson_id)
     return render_template('lesson.html', user=user, lesson=lesson, assignments=assignments, quizzes=quizzes)
 
 
 @app.route('/lesson/<int:lesson_id>/edit', methods=['GET', 'POST'])
-@role_required('teacher')
+@owner_required('lesson', 'lesson_id')
 def edit_lesson(lesson_id):
     """Edit lesson content and attachments."""
-    db = get_db()
-    lesson = db.execute('SELECT l.*, c.teacher_id FROM lessons l JOIN courses c ON l.course_id = c.id WHERE l.id = ?', (lesson_id,)).fetchone()
-    db.close()
-    user = current_user()
-    if not lesson or lesson['teacher_id'] != user['id']:
-        flash('Access denied')
-        return redirect(url_for('teacher_classes'))
+    lesson = g.obj
     if request.method == 'POST':
         title = request.form.get('title')
         content = request.form.get('content')
@@ -708,16 +1406,10 @@ def edit_lesson(lesson_id):
 
 
 @app.route('/lesson/<int:lesson_id>/delete', methods=['POST'])
-@role_required('teacher')
+@owner_required('lesson', 'lesson_id')
 def delete_lesson_route(lesson_id):
     """Delete a lesson and all associated content."""
-    db = get_db()
-    lesson = db.execute('SELECT l.*, c.teacher_id FROM lessons l JOIN courses c ON l.course_id = c.id WHERE l.id = ?', (lesson_id,)).fetchone()
-    db.close()
-    user = current_user()
-    if not lesson or lesson['teacher_id'] != user['id']:
-        flash('Access denied')
-        return redirect(url_for('teacher_classes'))
+    lesson = g.obj
     svc.delete_lesson(lesson_id)
     flash('Lesson deleted')
     return redirect(url_for('course_page', course_id=lesson['course_id']))
@@ -728,7 +1420,7 @@ def delete_lesson_route(lesson_id):
 # ============================================================================
 
 @app.route('/assignment/create/<int:lesson_id>', methods=['GET', 'POST'])
-@role_required('teacher')
+@owner_required('lesson', 'lesson_id')
 def create_assignment(lesson_id):
     """
     Create Assignment Route
@@ -756,7 +1448,7 @@ def assignment_detail(assignment_id):
     user = current_user()
     if not user:
         return redirect(url_for('login'))
-    db = get_db()
+    db = get_read_db()
     assignment = db.execute('SELECT * FROM assignments WHERE id = ?', (assignment_id,)).fetchone()
     submissions = []
     student_submission = None
@@ -774,16 +1466,10 @@ def assignment_detail(assignment_id):
 
 
 @app.route('/assignment/<int:assignment_id>/edit', methods=['GET', 'POST'])
-@role_required('teacher')
+@owner_required('assignment', 'assignment_id')
 def edit_assignment(assignment_id):
     """Edit assignment details, description, and due date."""
-    db = get_db()
-    a = db.execute('SELECT a.*, c.teacher_id FROM assignments a JOIN lessons l ON a.lesson_id = l.id JOIN courses c ON l.course_id = c.id WHERE a.id = ?', (assignment_id,)).fetchone()
-    db.close()
-    user = current_user()
-    if not a or a['teacher_id'] != user['id']:
-        flash('Access denied')
-        return redirect(url_for('teacher_classes'))
+    a = g.obj
     if request.method == 'POST':
         title = request.form.get('title')
         description = request.form.get('description')
@@ -795,16 +1481,10 @@ def edit_assignment(assignment_id):
 
 
 @app.route('/assignment/<int:assignment_id>/delete', methods=['POST'])
-@role_required('teacher')
+@owner_required('assignment', 'assignment_id')
 def delete_assignment_route(assignment_id):
     """Delete an assignment and all associated submissions."""
-    db = get_db()
-    a = db.execute('SELECT a.*, c.teacher_id FROM assignments a JOIN lessons l ON a.lesson_id = l.id JOIN courses c ON l.course_id = c.id WHERE a.id = ?', (assignment_id,)).fetchone()
-    db.close()
-    user = current_user()
-    if not a or a['teacher_id'] != user['id']:
-        flash('Access denied')
-        return redirect(url_for('teacher_classes'))
+    a = g.obj
     svc.delete_assignment(assignment_id)
     flash('Assignment deleted')
     return redirect(url_for('lesson_page', lesson_id=a['lesson_id']))
@@ -829,7 +1509,7 @@ def submit_assignment(assignment_id):
         filename = None
         if f and f.filename:
             filename = secure_filename(f.filename)
-            dest = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            dest = os.path.join(tenants.upload_dir(), filename)
             f.save(dest)
         svc.submit_assignment(assignment_id, user['id'], filename, text)
         flash('Submitted')
@@ -852,6 +1532,69 @@ def grade_submission(assignment_id, submission_id):
     return redirect(url_for('assignment_detail', assignment_id=assignment_id))
 
 
+GRADING_BATCH = 10      # submissions per grading-queue prefetch
+
+
+def _grade_value(raw):
+    """A grade from a form or JSON field: None when blank, ValueError when not a number."""
+    if raw is None or (isinstance(raw, str) and not raw.strip()):
+        return None
+    return float(raw)
+
+
+@app.route('/assignment/<int:assignment_id>/grades', methods=['POST'])
+@owner_required('assignment', 'assignment_id', roles=('teacher', 'admin'), admin_override=True)
+def grade_submissions(assignment_id):
+    """
+    Grade many submissions of the assignment at once.
+
+    Accepts the bulk form on the assignment page (grade-<id> / feedback-<id>
+    fields) or, from the grading queue, JSON {"grades": [{"submission_id",
+    "grade", "feedback"}, ...]}. Ownership is checked once for the assignment
+    and all grades are saved in one transaction; JSON callers get back only
+    the submissions that changed.
+    """
+    grades = []
+    try:
+        if request.is_json:
+            for item in (request.get_json(silent=True) or {}).get('grades') or []:
+                grades.append((int(item['submission_id']), _grade_value(item.get('grade')),
+                               item.get('feedback') or None))
+        else:
+            for key in request.form:
+                if key.startswith('grade-'):
+                    sid = int(key[len('grade-'):])
+                    grades.append((sid, _grade_value(request.form[key]),
+                                   request.form.get(f'feedback-{sid}') or None))
+    except (KeyError, TypeError, ValueError):
+        if request.is_json:
+            return jsonify({'error': 'grades must be numbers'}), 400
+        flash('Grades must be numbers')
+        return redirect(url_for('assignment_detail', assignment_id=assignment_id))
+    changed = svc.grade_submissions(assignment_id, grades)
+    if request.is_json:
+        return jsonify({'changed': changed})
+    flash(f"{len(changed)} submission{'s' if len(changed) != 1 else ''} graded" if changed else 'No grades changed')
+    return redirect(url_for('assignment_detail', assignment_id=assignment_id))
+
+
+@app.route('/assignment/<int:assignment_id>/grading')
+@owner_required('assignment', 'assignment_id', roles=('teacher', 'admin'), admin_override=True)
+def grading_queue(assignment_id):
+    """Keyboard-driven queue of ungraded submissions; the page prefetches the next batch as it goes."""
+    return render_template('grading_queue.html', assignment=g.obj, batch=GRADING_BATCH,
+                           queue=svc.ungraded_submissions(assignment_id, limit=GRADING_BATCH))
+
+
+@app.route('/assignment/<int:assignment_id>/grading/next')
+@owner_required('assignment', 'assignment_id', roles=('teacher', 'admin'), admin_override=True)
+def grading_queue_next(assignment_id):
+    """The next ungraded submissions after ?after=<id> (JSON, for the queue's prefetch)."""
+    after = request.args.get('after', type=int)
+    limit = min(request.args.get('limit', GRADING_BATCH, type=int), 50)
+    return jsonify({'submissions': svc.ungraded_submissions(assignment_id, after, limit)})
+
+
 @app.route('/assignment/<int:assignment_id>/export')
 @role_required('teacher', 'admin')
 def export_submissions(assignment_id):
@@ -860,12 +1603,65 @@ def export_submissions(assignment_id):
     return Response(csv, mimetype='text/csv', headers={"Content-Disposition": f"attachment;filename=assignment_{assignment_id}_submissions.csv"})
 
 
+def _zip_name(name):
+    """A file or folder name that is safe inside a ZIP archive."""
+    name = ''.join('_' if c in '/\\:*?"<>|' or ord(c) < 32 else c for c in (name or '')).strip(' .')
+    return name or 'unnamed'
+
+
+@app.route('/assignment/<int:assignment_id>/download_all')
+@owner_required('assignment', 'assignment_id', roles=('teacher', 'admin'), admin_override=True)
+def download_all(assignment_id):
+    """
+    Download every submitted file of the assignment as one ZIP.
+
+    The archive is built while it is sent (see zipstream.py): files are read
+    in small chunks and nothing is staged on disk or in memory, so the
+    download starts at once however large the submissions are. Entries are
+    student_name/filename, plus a manifest.csv listing every submission.
+    """
+    rows = svc.submission_files(assignment_id)
+    upload_dir = tenants.upload_dir()
+
+    def entries():
+        manifest = StringIO()
+        writer = csv.writer(manifest)
+        writer.writerow(['submission_id', 'student_id', 'student_name', 'submitted_at', 'grade', 'file', 'size', 'status'])
+        used = set()
+        for r in rows:
+            entry, size, status = '', '', 'no file'
+            if r['file_path']:
+                path = os.path.join(upload_dir, r['file_path'])
+                base, ext = os.path.splitext(_zip_name(os.path.basename(r['file_path'])))
+                folder = _zip_name(r['student_name'])
+                entry, n = f'{folder}/{base}{ext}', 1
+                while entry.lower() in used:
+                    n += 1
+                    entry = f'{folder}/{base} ({n}){ext}'
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    entry, status = '', 'missing'
+                else:
+                    used.add(entry.lower())
+                    status = 'included'
+                    yield entry, path
+            writer.writerow([r['id'], r['student_id'], r['student_name'], r['submitted_at'],
+                             '' if r['grade'] is None else r['grade'], entry, size, status])
+        yield 'manifest.csv', manifest.getvalue().encode('utf-8-sig')
+
+    filename = f"assignment_{assignment_id}_{secure_filename(g.obj['title'] or '') or 'submissions'}.zip"
+    return Response(stream_with_context(zipstream.stream_zip(entries())), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                             'X-Accel-Buffering': 'no'})
+
+
 # ============================================================================
 # QUIZ & ASSESSMENT ROUTES
 # ============================================================================
 
 @app.route('/quiz/create/<int:lesson_id>', methods=['GET', 'POST'])
-@role_required('teacher', 'admin')
+@owner_required('lesson', 'lesson_id', roles=('teacher', 'admin'), admin_override=True)
 def create_quiz(lesson_id):
     """
     Create Quiz Route
@@ -881,7 +1677,19 @@ def create_quiz(lesson_id):
         except Exception as e:
             flash('Invalid JSON for questions')
             return render_template('create_quiz.html', lesson_id=lesson_id)
-        svc.create_quiz(lesson_id, parsed_questions)
+        try:
+            time_limit = int(request.form.get('time_limit') or 0) or None
+        except ValueError:
+            time_limit = None
+        if time_limit is not None and time_limit < 0:
+            time_limit = None
+        try:
+            draw_count = int(request.form.get('draw_count') or 0) or None
+        except ValueError:
+            draw_count = None
+        if draw_count is not None and not 0 < draw_count < len(parsed_questions):
+            draw_count = None
+        svc.create_quiz(lesson_id, parsed_questions, time_limit, draw_count, bool(request.form.get('shuffle')))
         flash('Quiz created')
         return redirect(url_for('lesson_page', lesson_id=lesson_id))
     return render_template('create_quiz.html', lesson_id=lesson_id)
@@ -894,18 +1702,95 @@ def view_quiz(quiz_id):
     if not user:
         return redirect(url_for('login'))
     # load quiz via services
-    from services import _get_conn
-    conn = _get_conn()
+    from services import _get_read_conn
+    conn = _get_read_conn()
     quiz = conn.execute('SELECT * FROM quizzes WHERE id = ?', (quiz_id,)).fetchone()
     conn.close()
     if not quiz:
         flash('Quiz not found')
         return redirect(url_for('dashboard'))
+    activity_log.record(user['id'], 'quiz', quiz_id)
     questions = json.loads(quiz['questions'])
-    return render_template('quiz.html', quiz=quiz, questions=questions)
+    if user['role'] == 'student':
+        # each student gets their own draw and order from the question bank
+        questions = svc.present_quiz(questions, svc.quiz_layout(quiz_id, user['id'], questions,
+                                                                quiz['draw_count'], quiz['shuffle']))
+    exam = None
+    if quiz['time_limit'] and user['role'] == 'student':
+        exam = svc.get_open_quiz_session(quiz_id, user['id'])
+        if not exam:
+            return render_template('quiz_start.html', quiz=quiz, questions=questions)
+        if time.time() > exam['deadline'] + svc.EXAM_GRACE_SECONDS:
+            return _finish_exam(quiz_id, exam, None)
+        pending = exam_autosave.get((tenants.current(), exam['id']))
+        if pending and (exam['saved_at'] is None or pending[1] > exam['saved_at']):
+            exam['answers'] = pending[0]
+        else:
+            exam['answers'] = json.loads(exam['answers'] or '[]')
+        exam['remaining'] = max(0, int(exam['deadline'] - time.time()))
+        session[f'exam_{quiz_id}'] = [exam['id'], exam['deadline'], len(questions)]
+    return render_template('quiz.html', quiz=quiz, questions=questions, exam=exam)
+
+
+@app.route('/quiz/<int:quiz_id>/start', methods=['POST'])
+@role_required('student')
+def start_quiz(quiz_id):
+    """
+    Start Timed Exam Route
+
+    Opens the student's attempt session; the clock starts now and keeps
+    running if the page is closed or reloaded.
+    """
+    user = current_user()
+    from services import _get_read_conn
+    conn = _get_read_conn()
+    quiz = conn.execute('SELECT id, time_limit FROM quizzes WHERE id = ?', (quiz_id,)).fetchone()
+    conn.close()
+    if not quiz or not quiz['time_limit']:
+        return redirect(url_for('view_quiz', quiz_id=quiz_id))
+    svc.start_quiz_session(quiz_id, user['id'], quiz['time_limit'])
+    return redirect(url_for('view_quiz', quiz_id=quiz_id))
+
+
+@app.route('/quiz/<int:quiz_id>/autosave', methods=['POST'])
+@rate_limit(30, per=60, key='user')
+def autosave_quiz(quiz_id):
+    """
+    Timed Exam Autosave Route (JSON)
+
+    Accepts {"answers": [index or null, ...]} and buffers it in memory; the
+    database is written in batches by the autosave flusher.
+    """
+    # set by view_quiz in the signed session cookie, so autosaves need no lookup
+    exam = session.get(f'exam_{quiz_id}')
+    if not session.get('user_id') or not exam:
+        return jsonify({'error': 'no open exam'}), 404
+    session_id, deadline, n = exam
+    now = time.time()
+    if now > deadline + svc.EXAM_GRACE_SECONDS:
+        return jsonify({'error': 'time is up', 'remaining': 0}), 409
+    raw = (request.get_json(silent=True) or {}).get('answers')
+    if not isinstance(raw, list) or len(raw) > n:
+        return jsonify({'error': 'invalid answers'}), 400
+    answers = [a if isinstance(a, int) and not isinstance(a, bool) and 0 <= a < svc.UNANSWERED else None for a in raw]
+    exam_autosave.put((tenants.current(), session_id), answers, now)
+    return jsonify({'saved': True, 'remaining': max(0, int(deadline - now))})
+
+
+def _finish_exam(quiz_id, exam, answers):
+    """Submit a timed session and show its result (or the dashboard if it was already submitted)."""
+    session.pop(f'exam_{quiz_id}', None)
+    result = svc.finish_quiz_session(exam['id'], answers, exam_autosave.pop((tenants.current(), exam['id'])))
+    if result is None:
+        flash('This exam was already submitted')
+        return redirect(url_for('dashboard'))
+    if result['late']:
+        flash('Time was up; your last saved answers were submitted')
+    return render_template('quiz_result.html', score=result['score'], correct=result['correct'], total=result['total'])
 
 
 @app.route('/quiz/<int:quiz_id>/attempt', methods=['POST'])
+@rate_limit(5, per=60, key='user')
 @role_required('student')
 def attempt_quiz(quiz_id):
     """
@@ -915,16 +1800,18 @@ def attempt_quiz(quiz_id):
     """
     user = current_user()
     # load quiz
-    from services import _get_conn
-    conn = _get_conn()
+    from services import _get_read_conn
+    conn = _get_read_conn()
     quiz = conn.execute('SELECT * FROM quizzes WHERE id = ?', (quiz_id,)).fetchone()
     conn.close()
     if not quiz:
         flash('Quiz not found')
         return redirect(url_for('dashboard'))
     questions = json.loads(quiz['questions'])
+    # answers arrive indexed by the slot they were displayed in
+    layout = svc.quiz_layout(quiz_id, user['id'], questions, quiz['draw_count'], quiz['shuffle'])
     answers = []
-    for i, q in enumerate(questions):
+    for i in range(len(layout[0]) if layout else len(questions)):
         key = f'q_{i}'
         val = request.form.get(key)
         try:
@@ -932,11 +1819,64 @@ def attempt_quiz(quiz_id):
         except:
             ans_index = None
         answers.append(ans_index)
+    if quiz['time_limit']:
+        exam = svc.get_open_quiz_session(quiz_id, user['id'])
+        if not exam:
+            flash('Start the exam before submitting')
+            return redirect(url_for('view_quiz', quiz_id=quiz_id))
+        return _finish_exam(quiz_id, exam, answers)
     # evaluate and store via service
     result = svc.evaluate_quiz_attempt(quiz_id, user['id'], answers)
     return render_template('quiz_result.html', score=result['score'], correct=result['correct'], total=result['total'])
 
 
+@app.route('/quiz/<int:quiz_id>/analysis')
+@owner_required('quiz', 'quiz_id', roles=('teacher', 'admin'), admin_override=True)
+def quiz_analysis(quiz_id):
+    """
+    Quiz Item Analysis Route
+
+    Per-question difficulty (p-value), discrimination index and choice
+    distribution across all attempts.
+    """
+    items = svc.quiz_item_analysis(quiz_id)
+    return render_template('quiz_analysis.html', quiz=g.obj, items=items)
+
+
+@app.route('/quiz/<int:quiz_id>/answer_key', methods=['GET', 'POST'])
+@owner_required('quiz', 'quiz_id', roles=('teacher', 'admin'), admin_override=True)
+def quiz_answer_key(quiz_id):
+    """
+    Answer Key Correction Route
+
+    Lets the instructor fix a quiz's answer key; every existing attempt is
+    re-graded against the corrected key.
+    """
+    questions = json.loads(g.obj['questions'] or '[]')
+    if request.method == 'POST':
+        key = []
+        for i, q in enumerate(questions):
+            try:
+                key.append(int(request.form.get(f'q_{i}')))
+            except (TypeError, ValueError):
+                key.append(q.get('answer'))
+        try:
+            changed = svc.update_quiz_answer_key(quiz_id, key)
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for('quiz_answer_key', quiz_id=quiz_id))
+        if changed:
+            result = svc.regrade_quiz(quiz_id)
+            flash(f"Answer key updated; re-graded {result['attempts']} attempt(s), {result['changed']} score(s) changed")
+            if result['stale']:
+                flash(f"{result['stale']} student(s) have attempts compacted before answers were kept; "
+                      "their averages still use the old scores")
+        else:
+            flash('Answer key unchanged')
+        return redirect(url_for('lesson_page', lesson_id=g.obj['lesson_id']))
+    return render_template('quiz_answer_key.html', quiz=g.obj, questions=questions)
+
+
 # ============================================================================
 # RESOURCE MANAGEMENT ROUTES
 # ============================================================================
@@ -959,7 +1899,7 @@ def create_resource():
         fname = None
         if f and f.filename:
             fname = secure_filename(f.filename)
-            f.save(os.path.join(app.config['UPLOAD_FOLDER'], fname))
+            f.save(os.path.join(tenants.upload_dir(), fname))
         svc.create_resource(rtype, title, content, user['id'], fname)
         flash('Resource created')
         return redirect(url_for('dashboard'))
@@ -972,12 +1912,13 @@ def view_resource(resource_id):
     user = current_user()
     if not user:
         return redirect(url_for('login'))
-    db = get_db()
+    db = get_read_db()
     r = db.execute('SELECT r.*, u.name as teacher_name FROM resources r LEFT JOIN users u ON r.teacher_id = u.id WHERE r.id = ?', (resource_id,)).fetchone()
     db.close()
     if not r:
         flash('Resource not found')
         return redirect(url_for('dashboard'))
+    activity_log.record(user['id'], 'resource', resource_id)
     # determine extension for inline display
     attachment = r['attachment'] if 'attachment' in r.keys() else None
     ext = None
@@ -999,7 +1940,7 @@ def resources_index():
     user = current_user()
     if not user:
         return redirect(url_for('login'))
-    db = get_db()
+    db = get_read_db()
     resources = []
     try:
         if user['role'] == 'teacher':
@@ -1023,7 +1964,7 @@ def resources_index():
 def delete_resource_route(resource_id):
     """Delete a learning resource (Owner or Admin)."""
     user = current_user()
-    db = get_db()
+    db = get_read_db()
     resource = db.execute('SELECT teacher_id FROM resources WHERE id = ?', (resource_id,)).fetchone()
     db.close()
 
@@ -1062,12 +2003,15 @@ def progress():
     user = current_user()
     if not user:
         return redirect(url_for('login'))
-    db = get_db()
+    db = get_read_db()
     # completed lessons: count of lessons with at least one submission by the student
     completed = db.execute('SELECT COUNT(DISTINCT l.id) as completed FROM lessons l JOIN assignments a ON a.lesson_id = l.id JOIN submissions s ON s.assignment_id = a.id WHERE s.student_id = ?', (user['id'],)).fetchone()
     total_lessons = db.execute('SELECT COUNT(*) as total FROM lessons').fetchone()
     # average quiz score
-    avg_score = db.execute('SELECT AVG(score) as avg FROM attempts WHERE student_id = ?', (user['id'],)).fetchone()
+    avg_score = db.execute('SELECT (a.total + s.total) / NULLIF(a.n + s.n, 0) as avg '
+                           'FROM (SELECT TOTAL(score) AS total, COUNT(score) AS n FROM attempts WHERE student_id = ?) a, '
+                           '(SELECT TOTAL(compacted_score) AS total, TOTAL(compacted) AS n FROM attempt_summaries WHERE student_id = ?) s',
+                           (user['id'], user['id'])).fetchone()
     db.close()
     completed_count = completed['completed'] if completed else 0
     total_count = total_lessons['total'] if total_lessons else 0
@@ -1075,6 +2019,53 @@ def progress():
     return render_template('progress.html', completed=completed_count, total=total_count, avg_score=avg)
 
 
+# ============================================================================
+# NOTIFICATION ROUTES
+# ============================================================================
+
+NOTIFICATIONS_PAGE = 50
+
+
+@app.route('/notifications')
+def notifications():
+    """The signed-in user's notification inbox, newest first."""
+    user = current_user()
+    if not user:
+        return redirect(url_for('login'))
+    before = request.args.get('before', type=int)
+    items = svc.notifications(user['id'], before, NOTIFICATIONS_PAGE + 1)
+    more = len(items) > NOTIFICATIONS_PAGE
+    items = items[:NOTIFICATIONS_PAGE]
+    for n in items:
+        n['created'] = time.strftime('%Y-%m-%d %H:%M', time.localtime(n['created_at']))
+    return render_template('notifications.html', notifications=items,
+                           next_before=items[-1]['id'] if more else None)
+
+
+@app.route('/notifications/<int:notification_id>')
+def open_notification(notification_id):
+    """Mark a notification read and go to what it is about."""
+    user = current_user()
+    if not user:
+        return redirect(url_for('login'))
+    link = svc.mark_notification_read(user['id'], notification_id)
+    if link is None:
+        flash('Notification not found')
+        return redirect(url_for('notifications'))
+    # only ever redirect within the site
+    return redirect(link if link.startswith('/') and not link.startswith('//') else url_for('notifications'))
+
+
+@app.route('/notifications/read_all', methods=['POST'])
+def read_all_notifications():
+    user = current_user()
+    if not user:
+        return redirect(url_for('login'))
+    n = svc.mark_all_notifications_read(user['id'])
+    flash(f'{n} notification{"s" if n != 1 else ""} marked read')
+    return redirect(url_for('notifications'))
+
+
 # ============================================================================
 # USER PROFILE ROUTES
 # ============================================================================
@@ -1127,7 +2118,7 @@ def admin_panel():
     - Role assignment
     - System monitoring
     """
-    db = get_db()
+    db = get_read_db()
     users = db.execute('SELECT id, name, email, role, school_id FROM users').fetchall()
     resources = db.execute('SELECT r.*, u.name as teacher_name FROM resources r LEFT JOIN users u ON r.teacher_id = u.id ORDER BY r.created_at DESC').fetchall()
     db.close()
@@ -1138,7 +2129,7 @@ def admin_panel():
 @role_required('admin')
 def admin_edit_user(user_id):
     """Edit user information and roles (Admin only)."""
-    db = get_db()
+    db = get_read_db()
     u = db.execute('SELECT id, name, email, role, school_id, bio FROM users WHERE id = ?', (user_id,)).fetchone()
     db.close()
     if not u:
@@ -1160,11 +2151,7 @@ def admin_edit_user(user_id):
                     flash('Password must be at least 6 characters.')
                     return render_template('admin_edit_user.html', user=u)
                 
-                password_hash = generate_password_hash(password)
-                db = get_db()
-                db.execute('UPDATE users SET password_hash = ? WHERE id = ?', (password_hash, user_id))
-                db.commit()
-                db.close()
+                svc.set_password(user_id, password)
 
             flash('User profile updated successfully.')
             return redirect(url_for('admin_panel'))
@@ -1199,7 +2186,7 @@ def admin_delete_user(user_id):
         return redirect(url_for('admin_panel'))
     try:
         # perform immediate hard delete (safe) and record snapshot
-        ok = svc.purge_user(user_id)
+        ok = svc.purge_user(user_id, deleted_by=cur['id'] if cur else None)
         if ok:
             flash('User deleted')
         else:
@@ -1218,7 +2205,7 @@ def admin_delete_resource(resource_id):
     if r:
         if r['attachment']:
             try:
-                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], r['attachment']))
+                os.remove(os.path.join(tenants.upload_dir(), r['attachment']))
             except Exception:
                 pass
         db.execute('DELETE FROM resources WHERE id = ?', (resource_id,))
@@ -1230,12 +2217,74 @@ def admin_delete_resource(resource_id):
     return redirect(url_for('admin_panel'))
 
 
+@app.route('/admin/metrics/hashing')
+@role_required('admin')
+def admin_hashing_metrics():
+    """Password hashing latency and queue counters for this worker (JSON)."""
+    return jsonify(hashing.stats())
+
+
+@app.route('/admin/metrics/autosave')
+@role_required('admin')
+def admin_autosave_metrics():
+    """Timed exam autosave buffer counters for this worker (JSON)."""
+    return jsonify(exam_autosave.stats())
+
+
+@app.route('/admin/metrics/activity')
+@role_required('admin')
+def admin_activity_metrics():
+    """Page-view buffer counters for this worker (JSON)."""
+    return jsonify(activity_log.stats())
+
+
+@app.route('/admin/metrics/db')
+@role_required('admin')
+def admin_db_metrics():
+    """Write transaction counters per shard for this worker: count, busy retries, lock wait (JSON)."""
+    return jsonify({slug: dict(tenants.shard(slug).stats) for slug in tenants.slugs()})
+
+
+@app.route('/admin/metrics/maintenance')
+@role_required('admin')
+def admin_maintenance_metrics():
+    """Database maintenance counters for this worker and current WAL sizes (JSON)."""
+    return jsonify(maintenance.scheduler.stats())
+
+
+@app.route('/admin/metrics/compression')
+@role_required('admin')
+def admin_compression_metrics():
+    """Responses compressed by this worker and bytes before/after (JSON)."""
+    mw = app.wsgi_app
+    if not isinstance(mw, compression.CompressionMiddleware):
+        return jsonify({'enabled': False})
+    return jsonify(dict(mw.stats, enabled=True, brotli=compression.brotli is not None, min_size=mw.min_size))
+
+
+DELETED_PAGE = 50
+
+
+def _page(rows):
+    """Trim a list fetched with DELETED_PAGE + 1 rows; returns (rows, next before id or None)."""
+    more = len(rows) > DELETED_PAGE
+    rows = rows[:DELETED_PAGE]
+    return rows, rows[-1]['id'] if more else None
+
+
 @app.route('/admin/deleted')
 @role_required('admin')
 def admin_deleted_users():
-    """View audit trail of deleted users (for potential restoration)."""
-    rows = svc.list_deleted_users()
-    return render_template('admin_deleted.html', rows=rows)
+    """
+    View audit trail of deleted users (for potential restoration), newest
+    first. ?q= searches the start of names and e-mails; ?role= and
+    ?deleted_by= filter.
+    """
+    filters = {'q': request.args.get('q', '').strip() or None, 'role': request.args.get('role') or None,
+               'deleted_by': request.args.get('deleted_by', type=int)}
+    rows, next_before = _page(svc.list_deleted_users(request.args.get('before', type=int), DELETED_PAGE + 1, **filters))
+    return render_template('admin_deleted.html', rows=rows, next_before=next_before,
+                           filters={k: v for k, v in filters.items() if v is not None})
 
 
 @app.route('/admin/deleted/<int:deleted_id>/restore', methods=['POST'])
@@ -1271,9 +2320,11 @@ def admin_remove_deleted_record(deleted_id):
 @app.route('/admin/deleted_courses')
 @role_required('admin')
 def admin_deleted_courses():
-    """View audit trail of deleted courses."""
-    rows = svc.list_deleted_courses()
-    return render_template('admin_deleted_courses.html', rows=rows)
+    """View audit trail of deleted courses; ?q= searches the start of titles, ?teacher_id= filters."""
+    filters = {'q': request.args.get('q', '').strip() or None, 'teacher_id': request.args.get('teacher_id', type=int)}
+    rows, next_before = _page(svc.list_deleted_courses(request.args.get('before', type=int), DELETED_PAGE + 1, **filters))
+    return render_template('admin_deleted_courses.html', rows=rows, next_before=next_before,
+                           filters={k: v for k, v in filters.items() if v is not None})
 
 
 @app.route('/admin/deleted_courses/<int:record_id>/remove', methods=['POST'])
@@ -1292,7 +2343,102 @@ def admin_remove_deleted_course_record(record_id):
 @app.route('/uploads/<path:filename>')
 def uploads(filename):
     """Serve uploaded files (lessons, assignments, resources)."""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_from_directory(tenants.upload_dir(), filename)
+
+
+# Fingerprinted, precompressed copies of static/ made by build_static.py.
+ASSET_DIR = os.path.join(BASE_DIR, 'static', 'dist')
+ASSET_MAX_AGE = 365 * 24 * 3600
+_asset_manifest = {'mtime': None, 'files': {}}
+
+
+def asset(path):
+    """
+    URL of a static file for templates: /assets/<fingerprinted name> after
+    `python build_static.py`, else the plain /static/ URL.
+    """
+    manifest = os.path.join(ASSET_DIR, 'manifest.json')
+    try:
+        mtime = os.path.getmtime(manifest)
+    except OSError:
+        return url_for('static', filename=path)
+    if mtime != _asset_manifest['mtime']:
+        with open(manifest) as f:
+            _asset_manifest['files'] = json.load(f)
+        _asset_manifest['mtime'] = mtime
+    name = _asset_manifest['files'].get(path)
+    return url_for('assets', filename=name) if name else url_for('static', filename=path)
+
+
+app.jinja_env.globals['asset'] = asset
+
+
+@app.route('/assets/<path:filename>')
+def assets(filename):
+    """
+    Serve a fingerprinted static file. The name changes whenever the content
+    does, so it is cached as immutable; the .br/.gz built next to it is sent
+    when the client accepts it (the compression middleware leaves it alone).
+    """
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    coding = compression.choose_encoding(request.headers.get('Accept-Encoding', ''))
+    if coding and os.path.isfile(os.path.join(ASSET_DIR, f'{filename}.{"br" if coding == "br" else "gz"}')):
+        resp = send_from_directory(ASSET_DIR, f'{filename}.{"br" if coding == "br" else "gz"}', mimetype=mimetype,
+                                   max_age=ASSET_MAX_AGE)
+        resp.headers['Content-Encoding'] = coding
+    else:
+        resp = send_from_directory(ASSET_DIR, filename, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    resp.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+# ============================================================================
+# JSON API (/api/v1, see api.py)
+# ============================================================================
+
+app.register_blueprint(api.bp)
+
+
+# ============================================================================
+# ADMIN COMMANDS (flask --app app <command>)
+# ============================================================================
+
+@app.cli.command('migrate-all')
+def migrate_all_command():
+    """Create or upgrade the database of every tenant shard."""
+    migrate_all()
+    for slug in tenants.slugs():
+        click.echo(f'{slug}: {tenants.db_path(slug)} up to date')
+
+
+@app.cli.command('tenant-report')
+@click.option('--csv', 'as_csv', is_flag=True, help='print CSV instead of a table')
+def tenant_report_command(as_csv):
+    """Users, courses and activity for every tenant shard."""
+    report = tenants.each(svc.usage_report)
+    cols = list(next(iter(report.values())))
+    if as_csv:
+        click.echo(','.join(['tenant'] + cols))
+        for slug, row in report.items():
+            click.echo(','.join([slug] + [str(row[c]) for c in cols]))
+        return
+    totals = {c: sum(row[c] for row in report.values()) for c in cols}
+    width = max(len(s) for s in list(report) + ['TOTAL'])
+    click.echo(f'{"tenant":<{width}}' + ''.join(f'{c:>15}' for c in cols))
+    for slug, row in list(report.items()) + [('TOTAL', totals)]:
+        click.echo(f'{slug:<{width}}' + ''.join(f'{row[c]:>15}' for c in cols))
+
+
+@app.cli.command('db-maintenance')
+@click.option('--task', 'tasks', multiple=True, type=click.Choice(maintenance.TASKS),
+              help='task to run (repeatable; default: all)')
+@click.option('--tenant', type=click.Choice(tenants.slugs()), help='only this shard (default: all)')
+def db_maintenance_command(tasks, tenant):
+    """Checkpoint, vacuum, optimize and analyze now, ignoring thresholds and schedules."""
+    for slug in [tenant] if tenant else tenants.slugs():
+        for task, result in maintenance.run(slug, tasks or maintenance.TASKS, force=True).items():
+            click.echo(f'{slug}: {task} {result}')
 
 
 # ============================================================================
@@ -1309,8 +2455,8 @@ if __name__ == '__main__':
     - Interactive debugger for troubleshooting
     
     For production deployment:
-    - Use a production WSGI server (Gunicorn, uWSGI)
+    - Use gunicorn with the bundled gunicorn.conf.py: gunicorn -c gunicorn.conf.py
     - Set debug=False
-    - Configure appropriate SECRET_KEY
+    - Set the SECRET_KEY environment variable
     """
-    app.run(debug=True)
+    create_app({'DEBUG': True}).run(debug=True)
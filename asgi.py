@@ -0,0 +1,222 @@
+"""
+ASGI entry point: the same Flask app, served from an event loop.
+
+Under a sync server a slow client pins a worker thread for the whole
+transfer: the view reads the upload from the socket as it trickles in, and
+a download holds the thread until the last byte is accepted. Here the event
+loop does the waiting instead:
+  - the request body is received asynchronously and spooled (to disk past
+    SPOOL_SIZE) before the view runs, so a view only ever sees a complete
+    body and occupies a thread for its own work;
+  - views, and with them every SQLite call, run on a bounded thread pool
+    (THREADS), never on the loop;
+  - response bodies are sent chunk by chunk, awaiting the client between
+    chunks; files (send_file / send_from_directory) are read in CHUNK_SIZE
+    blocks off the loop.
+
+Run it with any ASGI server, e.g.
+    uvicorn asgi:app --workers 2
+    GUNICORN_ASGI=1 gunicorn -c gunicorn.conf.py     (needs uvicorn installed)
+The server's lifespan startup runs create_app() and warm_up(), as
+gunicorn.conf.py's post_fork does for the sync workers.
+
+Configuration (environment variables):
+    ASGI_THREADS       threads running views per process (default: 8)
+    ASGI_SPOOL_MB      request bodies larger than this go to a temp file (default: 1)
+    ASGI_MAX_BODY_MB   larger request bodies are refused with 413 (default: 512)
+"""
+
+import asyncio
+import contextvars
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import app as application
+
+THREADS = int(os.environ.get('ASGI_THREADS', 8))
+SPOOL_SIZE = int(float(os.environ.get('ASGI_SPOOL_MB', 1)) * 1024 * 1024)
+MAX_BODY = int(float(os.environ.get('ASGI_MAX_BODY_MB', 512)) * 1024 * 1024)
+CHUNK_SIZE = 64 * 1024
+
+
+class ClientGone(Exception):
+    """The client disconnected before the request body was complete."""
+
+
+class FileWrapper:
+    """wsgi.file_wrapper: lets the adapter stream files itself instead of iterating in a thread."""
+
+    def __init__(self, filelike, block_size=CHUNK_SIZE):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.block_size), b'')
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+def _environ(scope, body, length):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        # WSGI carries the path as latin-1 decoded bytes
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = 'HTTP_' + name
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+class WsgiToAsgi:
+    """Serve a WSGI app over ASGI with async request bodies and responses (see module docstring)."""
+
+    def __init__(self, wsgi_app, threads=THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='asgi-view')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        try:
+            body, length = await self._read_body(scope, receive)
+        except ClientGone:
+            return
+        if body is None:
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'text/plain'), (b'connection', b'close')]})
+            await send({'type': 'http.response.body', 'body': b'Request body too large'})
+            return
+        try:
+            await self._respond(_environ(scope, body, length), send)
+        finally:
+            body.close()
+
+    async def _read_body(self, scope, receive):
+        """The complete request body as a file, received without holding a thread; (None, 0) if too large."""
+        declared = next((v for k, v in scope.get('headers', ()) if k == b'content-length'), None)
+        if declared is not None and declared.isdigit() and int(declared) > MAX_BODY:
+            return None, 0
+        body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        length, more = 0, True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                raise ClientGone()
+            chunk = message.get('body', b'')
+            length += len(chunk)
+            if length > MAX_BODY:
+                body.close()
+                return None, 0
+            if chunk:
+                body.write(chunk)
+            more = message.get('more_body', False)
+        body.seek(0)
+        return body, length
+
+    async def _respond(self, environ, send):
+        loop = asyncio.get_running_loop()
+        # one context for the whole response: streamed bodies (stream_with_context,
+        # the tenant ContextVar) must see what the view set, whichever thread runs them
+        context = contextvars.copy_context()
+        run = lambda fn, *args: loop.run_in_executor(self.executor, context.run, fn, *args)  # noqa: E731
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'], started['headers'] = status, headers
+            return lambda data: None   # the legacy write() callable is not supported
+
+        def call():
+            app_iter = self.wsgi_app(environ, start_response)
+            if isinstance(app_iter, FileWrapper):
+                return app_iter, None, b''
+            iterator = iter(app_iter)
+            # a generator may call start_response on its first iteration
+            first = next(iterator, b'')
+            return app_iter, iterator, first
+
+        app_iter, iterator, chunk = await run(call)
+        try:
+            status, headers = started['status'], started['headers']
+            started['sent'] = True
+            await send({'type': 'http.response.start', 'status': int(status[:3]),
+                        'headers': [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]})
+            if iterator is None:
+                # a file: read blocks off the loop, wait for the client in between
+                block_size = max(app_iter.block_size, CHUNK_SIZE)
+                while True:
+                    chunk = await run(app_iter.filelike.read, block_size)
+                    if not chunk:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            else:
+                while chunk is not None:
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    chunk = await run(next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(app_iter, 'close'):
+                await run(app_iter.close)
+
+    async def _lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await loop.run_in_executor(self.executor, application.create_app)
+                    await loop.run_in_executor(self.executor, application.warm_up)
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = WsgiToAsgi(application.app)
+
+
+def create_app(config=None):
+    """Run the app's setup (see app.create_app) and return the ASGI app; for preloading servers."""
+    application.create_app(config)
+    return app
@@ -0,0 +1,117 @@
+"""
+Buffered autosave for timed quiz sessions.
+
+Examinees' browsers autosave every few seconds. Writing each of those to
+SQLite would turn a full exam room into a steady stream of tiny write
+transactions, so autosaves land in a per-process dict instead (only the
+newest answers per session are kept) and a background thread writes the
+whole dict in one executemany transaction every FLUSH_INTERVAL seconds,
+or sooner once MAX_PENDING sessions are waiting.
+
+Every entry carries the wall-clock time it was received; the writer only
+overwrites older saves, so buffers in different workers flushing out of
+order cannot roll a session back.
+
+Configuration (environment variables):
+    EXAM_AUTOSAVE_FLUSH        seconds between flushes (default: 5)
+    EXAM_AUTOSAVE_MAX_PENDING  sessions buffered before an early flush (default: 1000)
+"""
+
+import atexit
+import os
+import threading
+import time
+
+FLUSH_INTERVAL = float(os.environ.get('EXAM_AUTOSAVE_FLUSH', 5))
+MAX_PENDING = int(os.environ.get('EXAM_AUTOSAVE_MAX_PENDING', 1000))
+HOUSEKEEPING_INTERVAL = 60
+
+
+class AutosaveBuffer:
+    """
+    Latest answers per session, flushed to the database in batches.
+
+    writer(items) receives a list of (session_id, answers, saved_at) and must
+    persist them in one transaction. housekeeping(), if given, runs on the
+    flush thread about once a minute.
+    """
+
+    def __init__(self, writer, housekeeping=None, interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.writer = writer
+        self.housekeeping = housekeeping
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._last_housekeeping = 0.0
+        self._counts = {'saves': 0, 'flushes': 0, 'rows_flushed': 0, 'errors': 0}
+        atexit.register(self.flush)
+
+    def put(self, session_id, answers, saved_at=None):
+        with self._lock:
+            self._pending[session_id] = (answers, saved_at or time.time())
+            self._counts['saves'] += 1
+            full = len(self._pending) >= self.max_pending
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+
+    def get(self, session_id):
+        """Return (answers, saved_at) buffered for a session, or None."""
+        with self._lock:
+            return self._pending.get(session_id)
+
+    def pop(self, session_id):
+        """Remove and return (answers, saved_at) buffered for a session, or None."""
+        with self._lock:
+            return self._pending.pop(session_id, None)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+        try:
+            self.writer([(sid, answers, ts) for sid, (answers, ts) in batch.items()])
+        except Exception:
+            # put the batch back unless a newer save arrived meanwhile
+            with self._lock:
+                for sid, entry in batch.items():
+                    cur = self._pending.get(sid)
+                    if cur is None or cur[1] < entry[1]:
+                        self._pending[sid] = entry
+                self._counts['errors'] += 1
+            raise
+        with self._lock:
+            self._counts['flushes'] += 1
+            self._counts['rows_flushed'] += len(batch)
+        return len(batch)
+
+    def _ensure_thread(self):
+        # a forked worker inherits the object but not the thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='autosave-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                if self.housekeeping and time.monotonic() - self._last_housekeeping >= HOUSEKEEPING_INTERVAL:
+                    self._last_housekeeping = time.monotonic()
+                    self.housekeeping()
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts, pending=len(self._pending), interval=self.interval)
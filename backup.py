@@ -0,0 +1,388 @@
+"""
+Online backups of database.db.
+
+Snapshots are taken with SQLite's online backup API while the app keeps
+running. Pages are copied a few hundred at a time with a short pause between
+steps; the read lock is released after every step, so writers such as
+submit_assignment are never queued behind a backup. Each snapshot is
+gzip-compressed and described by a JSON manifest holding the SHA-256 of both
+the compressed file and the database inside it.
+
+Uploaded files are stored content-addressed (objects/ab/abcd...), so an
+unchanged file is copied once no matter how many snapshots include it. The
+uploads directory is listed right after the database copy finishes and the
+listing goes into the manifest; since uploads are only ever added, every
+file the snapshot refers to is in it, which makes a restore consistent to
+the moment of the snapshot.
+
+Usage:
+    python backup.py snapshot [--keep 14]
+    python backup.py list
+    python backup.py verify backups/db-20260101T020000Z.json
+    python backup.py restore backups/db-20260101T020000Z.json [--db PATH] [--uploads DIR]
+
+Stop the app before restoring.
+
+With several institutions (see tenants.py) every shard is snapshotted into
+its own subdirectory, backups/<tenant>/; restore takes --tenant.
+
+Configuration (environment variables):
+    BACKUP_DIR         where snapshots and upload objects are kept (default: ./backups)
+    BACKUP_STEP_PAGES  pages copied per backup step (default: 256)
+    BACKUP_STEP_SLEEP  seconds to pause between steps (default: 0.02)
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from urllib.request import pathname2url
+
+import tenants
+
+BACKUP_DIR = os.environ.get('BACKUP_DIR', os.path.join(tenants.BASE_DIR, 'backups'))
+STEP_PAGES = int(os.environ.get('BACKUP_STEP_PAGES', 256))
+STEP_SLEEP = float(os.environ.get('BACKUP_STEP_SLEEP', 0.02))
+# the backup restarts whenever another connection writes mid-copy; after this
+# many restarts the remaining copy is done in a single step
+MAX_RESTARTS = 3
+CHUNK = 1 << 20
+
+
+class BackupError(Exception):
+    """Raised when a snapshot cannot be taken or fails verification."""
+
+
+class _Restarted(Exception):
+    pass
+
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def copy_database(db_path, dest, step_pages=STEP_PAGES, step_sleep=STEP_SLEEP):
+    """
+    Copy a live database to dest with the online backup API.
+
+    Returns {'pages', 'steps', 'restarts', 'seconds'}.
+    """
+    src = sqlite3.connect('file:' + pathname2url(os.path.abspath(db_path)) + '?mode=ro', uri=True, timeout=10)
+    stats = {'pages': 0, 'steps': 0, 'restarts': 0}
+    start = time.monotonic()
+    try:
+        while True:
+            dst = sqlite3.connect(dest)
+            last = [None]
+
+            def progress(status, remaining, total):
+                stats['steps'] += 1
+                stats['pages'] = total
+                if last[0] is not None and remaining > last[0]:
+                    stats['restarts'] += 1
+                    if stats['restarts'] >= MAX_RESTARTS:
+                        raise _Restarted()
+                last[0] = remaining
+                if remaining:
+                    time.sleep(step_sleep)
+
+            try:
+                src.backup(dst, pages=step_pages if stats['restarts'] < MAX_RESTARTS else -1, progress=progress)
+                break
+            except _Restarted:
+                pass
+            finally:
+                dst.close()
+    finally:
+        src.close()
+    stats['seconds'] = round(time.monotonic() - start, 3)
+    return stats
+
+
+def _compress(src, dest):
+    """gzip src into dest; returns (sha256 of src, sha256 of dest, size of dest)."""
+    raw = hashlib.sha256()
+    with open(src, 'rb') as fin, open(dest + '.part', 'wb') as fout:
+        with gzip.GzipFile(fileobj=fout, mode='wb', compresslevel=6, mtime=0) as gz:
+            for block in iter(lambda: fin.read(CHUNK), b''):
+                raw.update(block)
+                gz.write(block)
+    os.replace(dest + '.part', dest)
+    return raw.hexdigest(), _sha256_file(dest), os.path.getsize(dest)
+
+
+def _object_path(backup_dir, digest):
+    return os.path.join(backup_dir, 'objects', digest[:2], digest)
+
+
+def store_uploads(uploads_dir, backup_dir):
+    """
+    Copy uploads into the content-addressed object store.
+
+    Returns {relative path: {'sha256', 'size'}}. Hashes are cached by
+    (size, mtime) in objects/index.json so unchanged files are not re-read.
+    """
+    index_path = os.path.join(backup_dir, 'objects', 'index.json')
+    try:
+        with open(index_path, 'r', encoding='utf8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    files, new_index = {}, {}
+    for root, _, names in os.walk(uploads_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, uploads_dir).replace(os.sep, '/')
+            st = os.stat(path)
+            cached = index.get(rel)
+            if cached and cached['size'] == st.st_size and cached['mtime'] == st.st_mtime_ns:
+                digest = cached['sha256']
+            else:
+                digest = _sha256_file(path)
+            obj = _object_path(backup_dir, digest)
+            if not os.path.exists(obj):
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                shutil.copyfile(path, obj + '.part')
+                os.replace(obj + '.part', obj)
+            files[rel] = {'sha256': digest, 'size': st.st_size}
+            new_index[rel] = {'sha256': digest, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(index_path + '.part', 'w', encoding='utf8') as f:
+        json.dump(new_index, f)
+    os.replace(index_path + '.part', index_path)
+    return files
+
+
+def snapshot(backup_dir=BACKUP_DIR, db_path=None, uploads_dir=None, keep=None,
+             step_pages=STEP_PAGES, step_sleep=STEP_SLEEP):
+    """Take a compressed, checksummed snapshot of the database and uploads; returns its manifest."""
+    db_path = db_path or tenants.db_path()
+    uploads_dir = uploads_dir or tenants.upload_dir()
+    os.makedirs(backup_dir, exist_ok=True)
+    name = 'db-' + time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    tmp = os.path.join(backup_dir, f'.{name}.sqlite')
+    try:
+        copy = copy_database(db_path, tmp, step_pages, step_sleep)
+        uploads = store_uploads(uploads_dir, backup_dir) if os.path.isdir(uploads_dir) else {}
+        db_sha, gz_sha, gz_size = _compress(tmp, os.path.join(backup_dir, name + '.sqlite.gz'))
+        manifest = {
+            'name': name,
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+            'database': {'file': name + '.sqlite.gz', 'sha256': db_sha, 'size': os.path.getsize(tmp),
+                         'compressed_sha256': gz_sha, 'compressed_size': gz_size, 'pages': copy['pages']},
+            'backup': copy,
+            'uploads': uploads,
+        }
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    path = os.path.join(backup_dir, name + '.json')
+    with open(path + '.part', 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.part', path)
+    if keep:
+        prune(backup_dir, keep)
+    return manifest
+
+
+def list_snapshots(backup_dir=BACKUP_DIR):
+    """Manifests in backup_dir, oldest first."""
+    if not os.path.isdir(backup_dir):
+        return []
+    out = []
+    for name in sorted(os.listdir(backup_dir)):
+        if name.startswith('db-') and name.endswith('.json'):
+            with open(os.path.join(backup_dir, name), 'r', encoding='utf8') as f:
+                out.append(json.load(f))
+    return out
+
+
+def prune(backup_dir=BACKUP_DIR, keep=14):
+    """Keep the newest `keep` snapshots and drop upload objects no longer referenced."""
+    manifests = list_snapshots(backup_dir)
+    for m in manifests[:-keep] if keep else []:
+        for fn in (m['database']['file'], m['name'] + '.json'):
+            try:
+                os.remove(os.path.join(backup_dir, fn))
+            except FileNotFoundError:
+                pass
+    live = {u['sha256'] for m in manifests[-keep:] for u in m['uploads'].values()}
+    objects = os.path.join(backup_dir, 'objects')
+    removed = 0
+    for root, _, names in os.walk(objects):
+        for name in names:
+            if len(name) == 64 and name not in live:
+                os.remove(os.path.join(root, name))
+                removed += 1
+    return {'snapshots': max(0, len(manifests) - keep), 'objects': removed}
+
+
+def _load_manifest(path):
+    with open(path, 'r', encoding='utf8') as f:
+        return json.load(f), os.path.dirname(os.path.abspath(path))
+
+
+def _extract(manifest, backup_dir, dest):
+    """Check the compressed file, decompress it to dest and check the result."""
+    db = manifest['database']
+    gz_path = os.path.join(backup_dir, db['file'])
+    if _sha256_file(gz_path) != db['compressed_sha256']:
+        raise BackupError(f'{db["file"]}: checksum mismatch (file is damaged)')
+    raw = hashlib.sha256()
+    with gzip.open(gz_path, 'rb') as fin, open(dest, 'wb') as fout:
+        for block in iter(lambda: fin.read(CHUNK), b''):
+            raw.update(block)
+            fout.write(block)
+    if raw.hexdigest() != db['sha256']:
+        raise BackupError(f'{db["file"]}: database checksum mismatch after decompression')
+
+
+def _integrity_check(path):
+    conn = sqlite3.connect(path)
+    try:
+        rows = [r[0] for r in conn.execute('PRAGMA integrity_check')]
+    finally:
+        conn.close()
+    if rows != ['ok']:
+        raise BackupError('integrity_check failed: ' + '; '.join(rows[:5]))
+
+
+def verify(manifest_path, deep=False):
+    """
+    Verify a snapshot: checksums, PRAGMA integrity_check on the decompressed
+    database, and presence of every upload object (rehashed with deep=True).
+    """
+    manifest, backup_dir = _load_manifest(manifest_path)
+    fd, tmp = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        _extract(manifest, backup_dir, tmp)
+        _integrity_check(tmp)
+    finally:
+        os.remove(tmp)
+    for rel, u in manifest['uploads'].items():
+        obj = _object_path(backup_dir, u['sha256'])
+        if not os.path.exists(obj) or os.path.getsize(obj) != u['size']:
+            raise BackupError(f'upload {rel}: object missing')
+        if deep and _sha256_file(obj) != u['sha256']:
+            raise BackupError(f'upload {rel}: object checksum mismatch')
+    return manifest
+
+
+def restore(manifest_path, db_path=None, uploads_dir=None):
+    """
+    Restore a snapshot over db_path and bring back its uploads.
+
+    The database is verified (checksums and integrity_check) before it
+    replaces anything; the current database is kept as
+    <db>.pre-restore-<timestamp>. Uploads missing or changed since the
+    snapshot are copied back; newer uploads are left in place.
+    """
+    db_path = db_path or tenants.db_path()
+    uploads_dir = uploads_dir or tenants.upload_dir()
+    manifest, backup_dir = _load_manifest(manifest_path)
+    tmp = db_path + '.restore'
+    try:
+        _extract(manifest, backup_dir, tmp)
+        _integrity_check(tmp)
+        if os.path.exists(db_path):
+            # copied through SQLite rather than moved, so commits still in the
+            # -wal file are part of the kept copy
+            keep = f'{db_path}.pre-restore-{time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())}'
+            src, dst = sqlite3.connect(db_path), sqlite3.connect(keep)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+                src.close()
+        # a WAL left over from the old database would be replayed into the new one
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        os.replace(tmp, db_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    restored = 0
+    for rel, u in manifest['uploads'].items():
+        path = os.path.join(uploads_dir, *rel.split('/'))
+        if os.path.exists(path) and os.path.getsize(path) == u['size'] and _sha256_file(path) == u['sha256']:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(_object_path(backup_dir, u['sha256']), path)
+        restored += 1
+    _integrity_check(db_path)
+    return {'snapshot': manifest['name'], 'uploads_restored': restored}
+
+
+def _selected(slug):
+    return [tenants.shard(slug)] if slug else list(tenants.SHARDS.values())
+
+
+def _tenant_dir(backup_dir, slug):
+    # each institution's snapshots and objects live apart once there are several
+    return os.path.join(backup_dir, slug) if tenants.MULTI else backup_dir
+
+
+def _label(slug):
+    return f'{slug}/' if tenants.MULTI else ''
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Online backups of the e-learning database and uploads.')
+    p.add_argument('--dir', default=BACKUP_DIR, help='backup directory (default: %(default)s)')
+    sub = p.add_subparsers(dest='cmd', required=True)
+    s = sub.add_parser('snapshot', help='take a snapshot while the app is running')
+    s.add_argument('--keep', type=int, default=None, help='keep only the newest N snapshots')
+    s.add_argument('--step-pages', type=int, default=STEP_PAGES)
+    s.add_argument('--step-sleep', type=float, default=STEP_SLEEP)
+    s.add_argument('--tenant', choices=tenants.slugs(), help='only this institution (default: all)')
+    ls = sub.add_parser('list', help='list snapshots')
+    ls.add_argument('--tenant', choices=tenants.slugs(), help='only this institution (default: all)')
+    v = sub.add_parser('verify', help='check a snapshot without restoring it')
+    v.add_argument('manifest')
+    v.add_argument('--deep', action='store_true', help='also rehash every upload object')
+    r = sub.add_parser('restore', help='restore a snapshot (stop the app first)')
+    r.add_argument('manifest')
+    r.add_argument('--tenant', choices=tenants.slugs(), default=tenants.DEFAULT,
+                   help='institution to restore into (default: %(default)s)')
+    r.add_argument('--db', help="database to replace (default: the tenant's)")
+    r.add_argument('--uploads', help="uploads directory (default: the tenant's)")
+    args = p.parse_args(argv)
+
+    try:
+        if args.cmd == 'snapshot':
+            for sh in _selected(args.tenant):
+                m = snapshot(_tenant_dir(args.dir, sh.slug), sh.db_path, sh.upload_dir, keep=args.keep,
+                             step_pages=args.step_pages, step_sleep=args.step_sleep)
+                print(f"{_label(sh.slug)}{m['name']}: {m['database']['pages']} pages, {m['database']['compressed_size']} bytes compressed, "
+                      f"{len(m['uploads'])} uploads, {m['backup']['steps']} steps, {m['backup']['seconds']}s")
+        elif args.cmd == 'list':
+            for sh in _selected(args.tenant):
+                for m in list_snapshots(_tenant_dir(args.dir, sh.slug)):
+                    print(f"{_label(sh.slug)}{m['name']}  {m['created_at']}  {m['database']['compressed_size']:>12} bytes  {len(m['uploads'])} uploads")
+        elif args.cmd == 'verify':
+            m = verify(args.manifest, deep=args.deep)
+            print(f"{m['name']}: OK")
+        elif args.cmd == 'restore':
+            sh = tenants.shard(args.tenant)
+            result = restore(args.manifest, args.db or sh.db_path, args.uploads or sh.upload_dir)
+            print(f"Restored {result['snapshot']} to {args.db or sh.db_path}; {result['uploads_restored']} upload(s) restored")
+    except BackupError as e:
+        print('Error:', e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+Benchmark: worker boot time and first-request latency.
+
+Each run starts a fresh Python process against a seeded scratch database
+and times what a gunicorn worker goes through:
+  cold     no --preload: import app (+ create_app() where the tree has it),
+           then the first requests
+  preload  the parent imports and sets up the app (and compiles the
+           templates, as gunicorn.conf.py's when_ready does), then forks; the
+           child does what post_fork does (warm_up() where the tree has it)
+           and serves the first requests
+First requests are an anonymous GET /login, a teacher's /dashboard and a
+/lesson page, each timed on its first and second call.
+
+--tree points at another checkout (e.g. an older commit exported with
+git archive) to compare before and after.
+
+Usage:
+    python bench_boot.py
+    python bench_boot.py --tree /tmp/before --runs 7
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# runs inside the tree under test; prints one JSON object
+CHILD = r'''
+import json, os, sys, time
+mode, teacher, lesson = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+out = {}
+
+
+def boot():
+    t = time.perf_counter()
+    import app
+    out['import'] = time.perf_counter() - t
+    if hasattr(app, 'create_app'):
+        t = time.perf_counter()
+        app.create_app({'TESTING': True})
+        out['create_app'] = time.perf_counter() - t
+    return app
+
+
+def requests(app):
+    client = app.app.test_client()
+    for name, path, uid in (('login', '/login', None), ('dashboard', '/dashboard', teacher),
+                            ('lesson', f'/lesson/{lesson}', teacher)):
+        with client.session_transaction() as s:
+            s.clear()
+            if uid:
+                s['user_id'] = uid
+        for n in (1, 2):
+            t = time.perf_counter()
+            r = client.get(path)
+            out[f'{name}_{n}'] = time.perf_counter() - t
+            assert r.status_code == 200, (path, r.status_code)
+
+
+t0 = time.perf_counter()
+if mode == 'cold':
+    app = boot()
+    out['ready'] = time.perf_counter() - t0
+    requests(app)
+else:
+    app = boot()
+    if hasattr(app, 'compile_templates'):
+        t = time.perf_counter()
+        app.compile_templates()
+        out['compile_templates'] = time.perf_counter() - t
+    master = out
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        out = {}
+        t0 = time.perf_counter()
+        if hasattr(app, 'warm_up'):
+            out['warm_up'] = app.warm_up()['seconds']
+        out['ready'] = time.perf_counter() - t0
+        requests(app)
+        os.write(w, json.dumps(out).encode())
+        os._exit(0)
+    os.close(w)
+    os.waitpid(pid, 0)
+    data = b''
+    while chunk := os.read(r, 65536):
+        data += chunk
+    out = dict(master, **json.loads(data))
+print(json.dumps(out))
+'''
+
+
+def seed(tree, workdir, teachers, courses, students, sessions):
+    """A migrated scratch database with some realistic volume; returns (teacher_id, lesson_id)."""
+    env = _env(workdir)
+    subprocess.run([sys.executable, '-c', 'import app\nif hasattr(app, "create_app"): app.create_app()'],
+                   cwd=tree, env=env, check=True, capture_output=True)
+    conn = sqlite3.connect(os.path.join(workdir, 'database.db'))
+    conn.executemany('INSERT INTO users (name, email, password_hash, role) VALUES (?, ?, ?, ?)',
+                     [(f'Teacher {i}', f't{i}@bench', 'x', 'teacher') for i in range(teachers)]
+                     + [(f'Student {i}', f's{i}@bench', 'x', 'student') for i in range(students)])
+    tids = [r[0] for r in conn.execute("SELECT id FROM users WHERE role = 'teacher'")]
+    sids = [r[0] for r in conn.execute("SELECT id FROM users WHERE role = 'student'")]
+    conn.executemany('INSERT INTO courses (title, description, teacher_id) VALUES (?, ?, ?)',
+                     [(f'Course {t}-{c}', 'Description', t) for t in tids for c in range(courses)])
+    cids = [r[0] for r in conn.execute('SELECT id FROM courses')]
+    conn.executemany('INSERT INTO lessons (course_id, title, content) VALUES (?, ?, ?)',
+                     [(c, f'Lesson {c}', 'Content ' * 50) for c in cids])
+    lid = conn.execute('SELECT MIN(id) FROM lessons').fetchone()[0]
+    questions = json.dumps([{'question': f'Q{i}', 'choices': ['a', 'b', 'c', 'd'], 'answer': i % 4} for i in range(40)])
+    conn.execute('INSERT INTO quizzes (lesson_id, questions, time_limit, draw_count, shuffle) VALUES (?, ?, 60, 20, 1)',
+                 (lid, questions))
+    qid = conn.execute('SELECT MAX(id) FROM quizzes').fetchone()[0]
+    conn.executemany('INSERT INTO quiz_sessions (quiz_id, student_id, started_at, deadline) VALUES (?, ?, 0, 9e9)',
+                     [(qid, s) for s in sids[:sessions]])
+    conn.commit()
+    conn.close()
+    return tids[0], lid
+
+
+def _env(workdir):
+    env = dict(os.environ, TENANTS=f"default={os.path.join(workdir, 'database.db')}",
+               TENANT_DIR=os.path.join(workdir, 'tenants'), DB_MAINTENANCE='0',
+               HASH_POOL_WORKERS='0', PYTHONDONTWRITEBYTECODE='1')
+    env.setdefault('SECRET_KEY', 'bench')
+    return env
+
+
+def run(tree, workdir, mode, teacher, lesson):
+    res = subprocess.run([sys.executable, '-c', CHILD, mode, str(teacher), str(lesson)],
+                         cwd=tree, env=_env(workdir), capture_output=True, text=True)
+    if res.returncode:
+        raise SystemExit(res.stderr)
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Benchmark worker boot time and first-request latency.')
+    p.add_argument('--tree', default=HERE, help='checkout to measure (default: this one)')
+    p.add_argument('--runs', type=int, default=5, help='fresh processes per mode; medians are shown')
+    p.add_argument('--teachers', type=int, default=300)
+    p.add_argument('--courses', type=int, default=3, help='courses per teacher')
+    p.add_argument('--students', type=int, default=3000)
+    p.add_argument('--sessions', type=int, default=1000, help='timed quiz sessions in progress')
+    args = p.parse_args(argv)
+
+    tree = os.path.abspath(args.tree)
+    with tempfile.TemporaryDirectory() as workdir:
+        teacher, lesson = seed(tree, workdir, args.teachers, args.courses, args.students, args.sessions)
+        print(f'{tree}: {args.runs} runs per mode, milliseconds (median)')
+        for mode in ('cold', 'preload'):
+            runs = [run(tree, workdir, mode, teacher, lesson) for _ in range(args.runs)]
+            keys = [k for k in runs[0]]
+            print(f'  {mode}')
+            for k in keys:
+                print(f'    {k:<18}{statistics.median(r[k] for r in runs) * 1000:>9.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Benchmark: fixed-order vs randomized quiz rendering and grading.
+
+Measures, for a fixed-order quiz and for a question bank with per-student
+draws and shuffled choices:
+  render  the work view_quiz does before rendering (parse the questions,
+          pick the student's draw and order)
+  page    render plus the quiz.html template itself
+  grade   what evaluate_quiz_attempt does before writing (map answers back
+          to the bank and score them)
+No database is touched.
+
+Usage:
+    python bench_quiz.py
+    python bench_quiz.py --bank 200 --draw 50 --students 2000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from jinja2 import Environment, FileSystemLoader
+
+import services as svc
+
+env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')))
+env.globals.update(enumerate=enumerate, get_flashed_messages=lambda: [], current_user=None,
+                   asset=lambda path: '/static/' + path)
+quiz_page = env.get_template('quiz.html')
+
+
+def make_bank(n, choices=4):
+    return [{'question': f'Question {i}?', 'choices': [f'Option {c}' for c in range(choices)],
+             'answer': random.randrange(choices)} for i in range(n)]
+
+
+def render(raw, quiz_id, student_id, draw, shuffle):
+    questions = json.loads(raw)
+    return svc.present_quiz(questions, svc.quiz_layout(quiz_id, student_id, questions, draw, shuffle))
+
+
+def page(raw, quiz_id, student_id, draw, shuffle):
+    return quiz_page.render(quiz={'id': quiz_id}, questions=render(raw, quiz_id, student_id, draw, shuffle), exam=None)
+
+
+def grade(questions, quiz_id, student_id, answers, draw, shuffle):
+    return svc._grade_answers(questions, answers, svc.quiz_layout(quiz_id, student_id, questions, draw, shuffle))
+
+
+def timed(fn, students, first, *rest, cold=False):
+    """Average microseconds per call over `students` distinct students."""
+    total = 0.0
+    if not cold:
+        for sid in range(students):
+            fn(first, 1, sid, *rest)
+    for sid in range(students):
+        if cold:
+            svc._layouts.clear()
+        start = time.perf_counter()
+        fn(first, 1, sid, *rest)
+        total += time.perf_counter() - start
+    return total / students * 1e6
+
+
+def check_roundtrip(bank, draw, students=200):
+    """A student who picks every displayed correct answer must score 100%."""
+    for sid in range(students):
+        layout = svc.quiz_layout(1, sid, bank, draw, True)
+        assert layout == svc.quiz_layout(1, sid, bank, draw, True), 'layout is not deterministic'
+        shown = svc.present_quiz(bank, layout)
+        answers = [perm.index(bank[pos]['answer']) for pos, perm in zip(*layout)]
+        assert [q['choices'][a] for q, a in zip(shown, answers)] == [bank[p]['choices'][bank[p]['answer']] for p in layout[0]]
+        _, _, drawn, correct, total = svc._grade_answers(bank, answers, layout)
+        assert correct == total == len(drawn) == min(draw or len(bank), len(bank)), (correct, total)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Benchmark fixed vs randomized quiz rendering and grading.')
+    p.add_argument('--bank', type=int, default=100, help='questions in the bank')
+    p.add_argument('--draw', type=int, default=None, help='questions per student (default: whole bank)')
+    p.add_argument('--students', type=int, default=2000, help='requests to time per case')
+    args = p.parse_args(argv)
+
+    random.seed(0)
+    bank = make_bank(args.bank)
+    draw = args.draw or args.bank
+    raw = json.dumps(bank)
+    check_roundtrip(bank, draw)
+
+    answers = [random.randrange(4) for _ in bank]
+
+    # fixed = today's path (every student gets the whole bank in order);
+    # cold = layout computed from the seed, warm = layout reused from the
+    # cache, as when grading right after the quiz was shown
+    rows = [
+        ('render', timed(render, args.students, raw, None, False),
+         timed(render, args.students, raw, args.draw, True, cold=True),
+         timed(render, args.students, raw, args.draw, True)),
+        ('page', timed(page, args.students, raw, None, False),
+         timed(page, args.students, raw, args.draw, True, cold=True),
+         timed(page, args.students, raw, args.draw, True)),
+        ('grade', timed(grade, args.students, bank, answers, None, False),
+         timed(grade, args.students, bank, answers[:draw], args.draw, True, cold=True),
+         timed(grade, args.students, bank, answers[:draw], args.draw, True)),
+    ]
+    print(f'bank={args.bank} draw={draw} students={args.students} (microseconds per request)')
+    print(f'{"step":<8}{"fixed":>10}{"cold":>10}{"warm":>10}')
+    for name, fixed, cold, warm in rows:
+        print(f'{name:<8}{fixed:>10.1f}{cold:>10.1f}{warm:>10.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""
+Benchmark: concurrent slow uploads, sync workers vs the ASGI mode.
+
+Simulates clients on a slow network submitting assignments (multipart
+POST /assignment/submit/<id>) while other users load /login, and runs
+the same load through
+  sync   the gunicorn gthread setup: WORKERS x THREADS threads, each request
+         holding its thread while the view reads the upload off the socket
+  async  asgi.py with the same number of view threads: bodies are received
+         on the event loop and the view runs once the upload is complete
+Each upload arrives in --chunks pieces, --delay seconds apart. Requests go
+to the app in-process against a scratch database, so the numbers measure
+thread occupancy, not the network stack.
+
+Usage:
+    python bench_uploads.py
+    python bench_uploads.py --uploads 100 --size 512 --delay 0.1
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BOUNDARY = 'bench-boundary'
+
+
+def _multipart(size):
+    head = (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="text"\r\n\r\nbenchmark\r\n'
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="upload.bin"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').encode()
+    return head + os.urandom(size) + f'\r\n--{BOUNDARY}--\r\n'.encode()
+
+
+def _pieces(body, chunks):
+    step = -(-len(body) // chunks)
+    return [body[i:i + step] for i in range(0, len(body), step)]
+
+
+class SlowInput(io.RawIOBase):
+    """wsgi.input that trickles in like a slow client: one piece per delay."""
+
+    def __init__(self, pieces, delay):
+        self.pieces, self.delay, self.buffer = list(pieces), delay, b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer and self.pieces:
+            time.sleep(self.delay)
+            self.buffer = self.pieces.pop(0)
+        n = min(len(b), len(self.buffer))
+        b[:n], self.buffer = self.buffer[:n], self.buffer[n:]
+        return n
+
+
+def _environ(method, path, cookie, body=b'', stream=None):
+    environ = {
+        'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': path, 'QUERY_STRING': '',
+        'SERVER_NAME': 'bench', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1', 'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+        'wsgi.input': stream or io.BytesIO(body), 'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True, 'wsgi.multiprocess': True, 'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    if cookie:
+        environ['HTTP_COOKIE'] = cookie
+    if body:
+        environ['CONTENT_TYPE'] = f'multipart/form-data; boundary={BOUNDARY}'
+    return environ
+
+
+def _wsgi_call(wsgi_app, environ):
+    status = {}
+    it = wsgi_app(environ, lambda s, h, e=None: status.setdefault('s', s))
+    try:
+        for _ in it:
+            pass
+    finally:
+        if hasattr(it, 'close'):
+            it.close()
+    return int(status['s'][:3])
+
+
+def run_sync(application, jobs, threads):
+    """gthread: every request holds a thread from the first body byte to the last response byte."""
+    def job(arrived, kind, path, cookie, body, pieces, delay):
+        stream = SlowInput(pieces, delay) if pieces else None
+        status = _wsgi_call(application.app, _environ('POST' if body else 'GET', path, cookie, body, stream))
+        return kind, status, time.perf_counter() - arrived
+
+    with ThreadPoolExecutor(threads) as pool:
+        start = time.perf_counter()
+        futures = []
+        for at, *args in jobs:
+            wait = at - (time.perf_counter() - start)
+            if wait > 0:
+                time.sleep(wait)
+            # latency counts from arrival, including the wait for a free thread
+            futures.append(pool.submit(job, time.perf_counter(), *args))
+        results = [f.result() for f in futures]
+    return results, time.perf_counter() - start
+
+
+def run_async(asgi, jobs):
+    """asgi.py: the body is received on the loop; the view gets a thread once it is complete."""
+    async def job(at, kind, path, cookie, body, pieces, delay):
+        await asyncio.sleep(at)
+        t = time.perf_counter()
+        queue = list(pieces) or [b'']
+        sent = {}
+
+        async def receive():
+            if pieces:
+                await asyncio.sleep(delay)
+            chunk = queue.pop(0)
+            return {'type': 'http.request', 'body': chunk, 'more_body': bool(queue)}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                sent['status'] = message['status']
+
+        headers = [(b'cookie', cookie.encode())] if cookie else []
+        if body:
+            headers += [(b'content-type', f'multipart/form-data; boundary={BOUNDARY}'.encode()),
+                        (b'content-length', str(len(body)).encode())]
+        scope = {'type': 'http', 'method': 'POST' if body else 'GET', 'path': path, 'query_string': b'',
+                 'headers': headers, 'client': ('127.0.0.1', 0), 'server': ('bench', 80),
+                 'scheme': 'http', 'http_version': '1.1'}
+        await asgi.app(scope, receive, send)
+        return kind, sent['status'], time.perf_counter() - t
+
+    async def main():
+        start = time.perf_counter()
+        results = await asyncio.gather(*(job(*j) for j in jobs))
+        return results, time.perf_counter() - start
+
+    return asyncio.run(main())
+
+
+def setup(students):
+    import app as application
+    import services as svc
+    application.create_app({'TESTING': True})
+    teacher = svc.create_user('Bench Teacher', 'teacher@bench', 'x' * 8, 'teacher')
+    course = svc.create_course('Bench Course', 'Benchmark', teacher)
+    assignment = svc.create_assignment(svc.create_lesson(course, 'Lesson', 'Content'), 'Upload')
+    serializer = application.app.session_interface.get_signing_serializer(application.app)
+    cookies = []
+    for i in range(students):
+        uid = svc.create_user(f'Student {i}', f's{i}@bench', 'x' * 8, 'student')
+        cookies.append('session=' + serializer.dumps({'user_id': uid}))
+    return application, assignment, cookies
+
+
+def _count_submissions(assignment):
+    import services as svc
+    conn = svc._get_read_conn()
+    n = conn.execute('SELECT COUNT(*) FROM submissions WHERE assignment_id = ?', (assignment,)).fetchone()[0]
+    conn.close()
+    return n
+
+
+def _report(mode, results, elapsed, uploads):
+    ups = [r for r in results if r[0] == 'upload']
+    probes = sorted(r[2] for r in results if r[0] == 'probe')
+    bad = [r for r in results if r[1] not in (200, 302)]
+    p95 = probes[min(len(probes) - 1, int(len(probes) * 0.95))] if probes else 0
+    print(f'  {mode:<6} {elapsed:7.2f}s  {uploads / elapsed:7.1f} uploads/s  '
+          f'upload p50 {statistics.median(r[2] for r in ups):6.2f}s  '
+          f'/login p50 {statistics.median(probes) * 1000 if probes else 0:7.1f}ms  p95 {p95 * 1000:7.1f}ms'
+          + (f'  ({len(bad)} failed)' if bad else ''))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Benchmark concurrent slow uploads: sync workers vs ASGI mode.')
+    p.add_argument('--uploads', type=int, default=48, help='concurrent slow uploads')
+    p.add_argument('--size', type=int, default=256, help='upload size in KiB')
+    p.add_argument('--chunks', type=int, default=16, help='pieces each upload arrives in')
+    p.add_argument('--delay', type=float, default=0.05, help='seconds between pieces')
+    p.add_argument('--probes', type=int, default=40, help='GET /login requests spread over the run')
+    p.add_argument('--workers', type=int, default=2, help='gunicorn workers being modelled')
+    p.add_argument('--threads', type=int, default=4, help='threads per worker')
+    args = p.parse_args(argv)
+
+    threads = args.workers * args.threads
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ.update(TENANTS=f"default={os.path.join(workdir, 'database.db')}",
+                          TENANT_DIR=os.path.join(workdir, 'tenants'), DB_MAINTENANCE='0',
+                          HASH_POOL_WORKERS='0', COMPRESSION='0', ASGI_THREADS=str(threads))
+        application, assignment, cookies = setup(args.uploads)
+        import asgi
+
+        body = _multipart(args.size * 1024)
+        pieces = _pieces(body, args.chunks)
+        path = f'/assignment/submit/{assignment}'
+        span = args.chunks * args.delay
+        jobs = [(0.0, 'upload', path, cookie, body, pieces, args.delay) for cookie in cookies]
+        jobs += [(span * 2 * i / args.probes, 'probe', '/login', None, b'', [], 0) for i in range(args.probes)]
+        jobs.sort(key=lambda j: j[0])
+
+        print(f'{args.uploads} uploads of {args.size} KiB in {args.chunks} pieces, {args.delay}s apart '
+              f'(~{span:.1f}s each), {args.probes} /login probes; {threads} view threads')
+        results, elapsed = run_sync(application, jobs, threads)
+        _report('sync', results, elapsed, args.uploads)
+        results, elapsed = run_async(asgi, jobs)
+        _report('async', results, elapsed, args.uploads)
+        stored = _count_submissions(assignment)
+        if stored != 2 * args.uploads:
+            print(f'  expected {2 * args.uploads} stored submissions, found {stored}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
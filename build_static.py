@@ -0,0 +1,142 @@
+"""
+Fingerprint and precompress the files under static/ for production.
+
+Every file is copied to static/dist/ with a content hash in its name
+(css/styles.css -> css/styles.3b1f0c9a2e.css), so it can be cached forever:
+a changed file gets a new name. Text-like files also get .gz (and .br when the
+`brotli` package is installed) siblings compressed at the highest level,
+so the server never compresses them per request. url(...) references
+inside CSS are rewritten to the fingerprinted names.
+
+static/dist/manifest.json maps each source path to its fingerprinted name;
+the asset() template helper (see app.py) reads it, and /assets/<name>
+serves the files with immutable cache headers and the precompressed
+variant the client accepts. Without a build, asset() falls back to the
+plain /static/ URL.
+
+Usage:
+    python build_static.py            # build static/dist
+    python build_static.py --clean    # remove static/dist
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:  # optional: .gz only
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+HASH_LENGTH = 10
+COMPRESSIBLE_EXTENSIONS = frozenset(('.css', '.js', '.mjs', '.map', '.json', '.svg', '.html', '.txt', '.xml', '.ico'))
+
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def fingerprint(rel: str, data: bytes) -> str:
+    base, ext = os.path.splitext(rel)
+    return f'{base}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}'
+
+
+def _sources(static_dir, dist_dir):
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != dist_dir and not d.startswith('.'))
+        for name in sorted(files):
+            if not name.startswith('.'):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, static_dir).replace(os.sep, '/'), path
+
+
+def _rewrite_css(rel, data, manifest):
+    """Point url(...) references at the fingerprinted files."""
+    folder = os.path.dirname(rel)
+
+    def repl(m):
+        quote, url = m.group(1), m.group(2)
+        if url.startswith(('data:', 'http:', 'https:', '//', '#')):
+            return m.group(0)
+        path, sep, suffix = url.partition('?') if '?' in url else url.partition('#')
+        target = os.path.normpath(os.path.join(folder, path)).replace(os.sep, '/') if not path.startswith('/') \
+            else path.lstrip('/').removeprefix('static/')
+        if target not in manifest:
+            return m.group(0)
+        new = os.path.relpath(manifest[target], folder or '.').replace(os.sep, '/')
+        return f'url({quote}{new}{sep}{suffix}{quote})'
+
+    return _CSS_URL.sub(repl, data.decode('utf-8')).encode('utf-8')
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR) -> dict:
+    """Build dist_dir; returns {source: {'file', 'size', 'gzip', 'br'}}."""
+    sources = list(_sources(static_dir, dist_dir))
+    manifest_path = os.path.join(dist_dir, 'manifest.json')
+    manifest, report = {}, {}
+    # CSS last, so the files it references already have their names
+    for rel, path in sorted(sources, key=lambda s: s[0].endswith('.css')):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if rel.endswith('.css'):
+            data = _rewrite_css(rel, data, manifest)
+        name = fingerprint(rel, data)
+        manifest[rel] = name
+        out = os.path.join(dist_dir, name)
+        _write(out, data)
+        entry = report[rel] = {'file': name, 'size': len(data), 'gzip': None, 'br': None}
+        if os.path.splitext(rel)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+            packed = gzip.compress(data, 9, mtime=0)
+            if len(packed) < len(data):
+                _write(out + '.gz', packed)
+                entry['gzip'] = len(packed)
+            if brotli is not None:
+                packed = brotli.compress(data, quality=11)
+                if len(packed) < len(data):
+                    _write(out + '.br', packed)
+                    entry['br'] = len(packed)
+
+    # drop outputs of earlier builds
+    keep = {os.path.join(dist_dir, n) + sfx for n in manifest.values() for sfx in ('', '.gz', '.br')}
+    for root, _, files in os.walk(dist_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if path not in keep and path != manifest_path:
+                os.remove(path)
+    # written last and atomically: running workers pick it up by mtime
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return report
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Fingerprint and precompress static files into static/dist.')
+    p.add_argument('--clean', action='store_true', help='remove static/dist and exit')
+    args = p.parse_args(argv)
+    if args.clean:
+        shutil.rmtree(DIST_DIR, ignore_errors=True)
+        print(f'Removed {DIST_DIR}')
+        return 0
+    report = build()
+    for rel, e in report.items():
+        sizes = ', '.join(f'{k} {e[k]}' for k in ('gzip', 'br') if e[k])
+        print(f"{rel} -> {e['file']}  {e['size']} bytes" + (f' ({sizes})' if sizes else ''))
+    print(f'{len(report)} file(s) written to {DIST_DIR}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
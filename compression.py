@@ -0,0 +1,197 @@
+"""
+Response compression as WSGI middleware.
+
+Text responses (HTML, CSS, JS, JSON, CSV, XML, SVG) larger than MIN_SIZE
+are compressed with brotli when the client accepts it and the `brotli`
+package is installed, otherwise with gzip. The body is compressed as it is
+produced: the middleware buffers only until it has seen MIN_SIZE bytes,
+and after that every chunk the application yields is compressed and
+flushed straight away, so streamed responses keep streaming.
+
+Responses that already carry a Content-Encoding (precompressed static
+files, see build_static.py), partial content, and Cache-Control:
+no-transform are passed through untouched.
+
+Configuration (environment variables):
+    COMPRESSION             0 disables the middleware (default: 1)
+    COMPRESS_MIN_SIZE       smallest body worth compressing, in bytes (default: 1024)
+    COMPRESS_GZIP_LEVEL     zlib level 1-9 (default: 6)
+    COMPRESS_BROTLI_QUALITY brotli quality 0-11 (default: 5)
+"""
+
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+ENABLED = os.environ.get('COMPRESSION', '1') != '0'
+MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+
+COMPRESSIBLE_TYPES = frozenset((
+    'application/json', 'application/javascript', 'application/xml', 'application/xhtml+xml',
+    'image/svg+xml', 'text/csv',
+))
+
+
+def accepted_encodings(header: str) -> dict:
+    """Parse Accept-Encoding into {coding: q}."""
+    out = {}
+    for part in (header or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        out[coding] = q
+    return out
+
+
+def choose_encoding(header: str, available=None):
+    """The best coding both sides support ('br', 'gzip') or None."""
+    available = available or (('br', 'gzip') if brotli else ('gzip',))
+    accepted = accepted_encodings(header)
+    best, best_q = None, 0.0
+    for coding in available:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    mimetype = (content_type or '').split(';')[0].strip().lower()
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+class _Gzip:
+    def __init__(self, level=GZIP_LEVEL):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 31)   # 31: gzip container
+
+    def compress(self, data):
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush()
+
+
+class _Brotli:
+    def __init__(self, quality=BROTLI_QUALITY):
+        self._c = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._c.process(data) + self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+def _compressor(coding):
+    return _Brotli() if coding == 'br' else _Gzip()
+
+
+class CompressionMiddleware:
+    """Wrap a WSGI app: app.wsgi_app = CompressionMiddleware(app.wsgi_app)."""
+
+    def __init__(self, app, min_size=MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+        self.stats = {'compressed': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    def __call__(self, environ, start_response):
+        coding = None
+        if environ.get('REQUEST_METHOD') != 'HEAD':
+            coding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if not coding:
+            return self.app(environ, start_response)
+        return self._compress(environ, start_response, coding)
+
+    def _compress(self, environ, start_response, coding):
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            if exc_info and captured.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            captured['status'], captured['headers'] = status, headers
+            return lambda data: None   # the legacy write() callable is not supported
+
+        app_iter = self.app(environ, capture)
+        iterator = iter(app_iter)
+        try:
+            head = []
+            if 'status' not in captured:
+                # a generator app calls start_response on its first iteration
+                for chunk in iterator:
+                    head.append(chunk)
+                    break
+            status, headers = captured['status'], captured['headers']
+            names = {k.lower(): v for k, v in headers}
+            eligible = (int(status[:3]) == 200 and is_compressible(names.get('content-type'))
+                        and 'content-encoding' not in names
+                        and 'no-transform' not in names.get('cache-control', '').lower())
+            vary = [v.strip().lower() for v in names.get('vary', '').split(',') if v.strip()]
+            if is_compressible(names.get('content-type')) and 'accept-encoding' not in vary and '*' not in vary:
+                headers = [(k, v) for k, v in headers if k.lower() != 'vary']
+                headers.append(('Vary', ', '.join(([names['vary']] if names.get('vary') else []) + ['Accept-Encoding'])))
+            length = names.get('content-length')
+            if not eligible or (length is not None and length.isdigit() and int(length) < self.min_size):
+                start_response(status, headers)
+                captured['sent'] = True
+                yield from head
+                yield from iterator
+                return
+
+            # buffer until the body is big enough to be worth compressing
+            size = sum(map(len, head))
+            while size < self.min_size:
+                chunk = next(iterator, None)
+                if chunk is None:
+                    break
+                head.append(chunk)
+                size += len(chunk)
+            if size < self.min_size:
+                start_response(status, headers)
+                captured['sent'] = True
+                yield b''.join(head)
+                return
+
+            headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+            headers.append(('Content-Encoding', coding))
+            headers = [(k, self._weak_etag(v) if k.lower() == 'etag' else v) for k, v in headers]
+            start_response(status, headers)
+            captured['sent'] = True
+            comp = _compressor(coding)
+            bytes_in = size
+            out = comp.compress(b''.join(head))
+            bytes_out = len(out)
+            yield out
+            for chunk in iterator:
+                if chunk:
+                    bytes_in += len(chunk)
+                    out = comp.compress(chunk)
+                    bytes_out += len(out)
+                    yield out
+            out = comp.finish()
+            self.stats['compressed'] += 1
+            self.stats['bytes_in'] += bytes_in
+            self.stats['bytes_out'] += bytes_out + len(out)
+            yield out
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    @staticmethod
+    def _weak_etag(value):
+        # the compressed bytes differ from the identity ones
+        return value if value.startswith('W/') else 'W/' + value
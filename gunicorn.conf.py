@@ -0,0 +1,77 @@
+"""
+gunicorn settings for production: gunicorn -c gunicorn.conf.py
+
+The app is loaded once in the master (preload_app) through create_app(),
+which runs the schema migrations and then closes its database connections,
+so the forked workers start with none. Templates are compiled in the master
+too (when_ready) and shared with the workers copy-on-write; each worker
+then fills its own caches in post_fork before taking requests.
+
+Every SQLite shard takes one writer at a time, so a few processes with a
+handful of threads each (uploads, ZIP downloads and report pages spend
+their time waiting on I/O) serve better than many processes queuing on
+the write lock.
+
+Configuration (environment variables):
+    PORT / BIND            listen address (default: 0.0.0.0:$PORT, port 8000)
+    WEB_CONCURRENCY        worker processes (default: CPU count + 1, at most 8)
+    GUNICORN_THREADS       threads per worker (default: 4)
+    GUNICORN_MAX_REQUESTS  requests before a worker is recycled (default: 2000; 0 = never)
+    GUNICORN_ASGI          1 serves asgi.py with uvicorn workers instead (default: 0);
+                           slow uploads and downloads then wait on the event loop
+                           instead of holding a thread, see bench_uploads.py
+"""
+
+import os
+import time
+
+_cpus = os.cpu_count() or 1
+
+ASGI = os.environ.get('GUNICORN_ASGI', '0') == '1'
+
+wsgi_app = 'asgi:create_app()' if ASGI else 'app:create_app()'
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+preload_app = True
+
+workers = int(os.environ.get('WEB_CONCURRENCY', min(_cpus + 1, 8)))
+worker_class = 'uvicorn.workers.UvicornWorker' if ASGI else 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+if ASGI:
+    # the view thread pool of asgi.py; slow clients no longer count against it
+    os.environ.setdefault('ASGI_THREADS', str(threads * 2))
+
+# recycle workers now and then; the jitter keeps them from restarting together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# heartbeat files in RAM instead of a possibly slow disk
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# the password hashing pool (hashing.py) is per worker; keep it from
+# multiplying by the worker count
+os.environ.setdefault('HASH_POOL_WORKERS', str(max(1, _cpus // workers)))
+
+
+def when_ready(server):
+    import app
+    start = time.perf_counter()
+    n = app.compile_templates()
+    server.log.info('compiled %d templates in %.3fs before forking', n, time.perf_counter() - start)
+
+
+def post_fork(server, worker):
+    worker._boot_started = time.perf_counter()
+    if ASGI:
+        return   # asgi.py warms up in its lifespan startup
+    import app
+    info = app.warm_up()
+    server.log.info('worker %s warmed up in %.3fs: %s', worker.pid, info['seconds'], info['tenants'])
+
+
+def post_worker_init(worker):
+    started = getattr(worker, '_boot_started', None)
+    if started is not None:
+        worker.log.info('worker %s ready %.3fs after fork', worker.pid, time.perf_counter() - started)
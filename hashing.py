@@ -0,0 +1,133 @@
+"""
+Password hashing off the request thread.
+
+generate_password_hash / check_password_hash are deliberately slow, so they
+run in a small process pool instead of the web worker. In-flight jobs are
+capped; when the cap is reached callers get HasherBusy, which the app turns
+into a 503 with Retry-After rather than letting requests pile up.
+
+Configuration (environment variables):
+    HASH_METHOD         werkzeug method string, e.g. 'scrypt' or 'pbkdf2:sha256:600000'
+    HASH_POOL_WORKERS   processes in the pool; 0 hashes inline (default: CPU count)
+    HASH_QUEUE_LIMIT    max jobs queued or running before rejecting (default: 4 per worker)
+    HASH_QUEUE_WAIT     seconds to wait for a free slot before rejecting (default: 0.5)
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+HASH_METHOD = os.environ.get('HASH_METHOD', 'scrypt')
+POOL_WORKERS = int(os.environ.get('HASH_POOL_WORKERS', os.cpu_count() or 1))
+QUEUE_LIMIT = int(os.environ.get('HASH_QUEUE_LIMIT', max(POOL_WORKERS, 1) * 4))
+QUEUE_WAIT = float(os.environ.get('HASH_QUEUE_WAIT', 0.5))
+RETRY_AFTER = 2
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing queue is full."""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(QUEUE_LIMIT)
+
+_stats_lock = threading.Lock()
+_latencies = {'hash': deque(maxlen=1000), 'verify': deque(maxlen=1000)}
+_counts = {'hash': 0, 'verify': 0, 'rejected': 0}
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS)
+    return _pool
+
+
+def shutdown():
+    """Stop the pool (it is recreated on next use, e.g. after a fork)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _run(kind, fn, *args):
+    if not _slots.acquire(timeout=QUEUE_WAIT):
+        with _stats_lock:
+            _counts['rejected'] += 1
+        raise HasherBusy('Password hashing queue is full')
+    start = time.perf_counter()
+    try:
+        if POOL_WORKERS <= 0:
+            return fn(*args)
+        return _get_pool().submit(fn, *args).result()
+    finally:
+        _slots.release()
+        elapsed = time.perf_counter() - start
+        with _stats_lock:
+            _counts[kind] += 1
+            _latencies[kind].append(elapsed)
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def hash_password(password: str) -> str:
+    """Hash a password with the configured method."""
+    return _run('hash', _hash, password, HASH_METHOD)
+
+
+def verify_password(pwhash: str, password: str) -> bool:
+    """Check a password against a stored hash."""
+    if not pwhash or '$' not in pwhash:
+        return False
+    return _run('verify', check_password_hash, pwhash, password)
+
+
+def _expand_method(method: str) -> str:
+    """
+    The method prefix werkzeug writes for method, with its defaults filled
+    in ('scrypt' -> 'scrypt:32768:8:1'), worked out without hashing anything.
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = args or (2 ** 15, 8, 1)
+        return f'scrypt:{int(n)}:{int(r)}:{int(p)}'
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    raise ValueError(f'unsupported HASH_METHOD {method!r}')
+
+
+METHOD_PREFIX = _expand_method(HASH_METHOD)
+
+
+def needs_rehash(pwhash: str) -> bool:
+    """True if pwhash was produced with different method or cost parameters than HASH_METHOD."""
+    return pwhash.split('$', 1)[0] != METHOD_PREFIX
+
+
+def stats() -> dict:
+    """Latency and throughput counters for this process."""
+    out = {'method': HASH_METHOD, 'workers': POOL_WORKERS, 'queue_limit': QUEUE_LIMIT}
+    with _stats_lock:
+        out.update(_counts)
+        for kind, samples in _latencies.items():
+            s = sorted(samples)
+            out[f'{kind}_ms'] = {
+                'samples': len(s),
+                'avg': round(sum(s) / len(s) * 1000, 1) if s else None,
+                'p50': round(s[len(s) // 2] * 1000, 1) if s else None,
+                'p95': round(s[min(len(s) - 1, int(len(s) * 0.95))] * 1000, 1) if s else None,
+                'max': round(s[-1] * 1000, 1) if s else None,
+            }
+    return out
@@ -0,0 +1,228 @@
+"""
+Background database maintenance for every tenant shard.
+
+A daemon thread in each worker wakes every CHECK_INTERVAL seconds and, per
+shard:
+  checkpoint  PRAGMA wal_checkpoint(TRUNCATE) once the -wal file is larger
+              than WAL_LIMIT. Busy readers during exam week otherwise keep
+              the WAL growing, and every read has to search it.
+  vacuum      PRAGMA incremental_vacuum in small steps when the free-page
+              list is large, e.g. right after purge_user (request_vacuum()
+              wakes the thread).
+  optimize    PRAGMA optimize every OPTIMIZE_INTERVAL.
+  analyze     ANALYZE every ANALYZE_INTERVAL.
+  notifications  services.prune_notifications() every NOTIFY_PRUNE_INTERVAL:
+              drops old notifications and sent e-mail, keeping the unread
+              counters right.
+  activity    services.rollup_activity() every ACTIVITY_ROLLUP_INTERVAL:
+              rolls the page-view partitions up and drops old ones.
+  retention   services.compact_attempts() and expire_deleted_records() every
+              RETENTION_INTERVAL; both do nothing unless ATTEMPT_KEEP_DAYS /
+              AUDIT_KEEP_DAYS are set.
+
+All but checkpoint and vacuum are claimed through the maintenance_runs
+table, so with several workers only one of them does the work. optimize
+and analyze run with analysis_limit set, which bounds how long they hold
+the write lock.
+
+Configuration (environment variables):
+    DB_MAINTENANCE          0 disables the background thread (default: 1)
+    DB_MAINT_INTERVAL       seconds between checks (default: 30)
+    DB_WAL_LIMIT_MB         WAL size that triggers a checkpoint (default: 64)
+    DB_OPTIMIZE_HOURS       hours between PRAGMA optimize runs (default: 1)
+    DB_ANALYZE_HOURS        hours between ANALYZE runs (default: 24)
+    NOTIFY_PRUNE_HOURS      hours between notification prunes (default: 24); how
+                            long they are kept is set in services.py
+    ACTIVITY_ROLLUP_MINUTES minutes between page-view rollups (default: 15)
+    RETENTION_HOURS         hours between retention runs (default: 24); the
+                            policies themselves are set in services.py
+"""
+
+import os
+import threading
+import time
+
+import tenants
+
+ENABLED = os.environ.get('DB_MAINTENANCE', '1') != '0'
+CHECK_INTERVAL = float(os.environ.get('DB_MAINT_INTERVAL', 30))
+WAL_LIMIT = int(float(os.environ.get('DB_WAL_LIMIT_MB', 64)) * 1024 * 1024)
+OPTIMIZE_INTERVAL = float(os.environ.get('DB_OPTIMIZE_HOURS', 1)) * 3600
+ANALYZE_INTERVAL = float(os.environ.get('DB_ANALYZE_HOURS', 24)) * 3600
+NOTIFY_PRUNE_INTERVAL = float(os.environ.get('NOTIFY_PRUNE_HOURS', 24)) * 3600
+ACTIVITY_ROLLUP_INTERVAL = float(os.environ.get('ACTIVITY_ROLLUP_MINUTES', 15)) * 60
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_HOURS', 24)) * 3600
+ANALYSIS_LIMIT = 1000        # rows sampled per index by optimize/ANALYZE
+CHECKPOINT_BUSY_MS = 1000    # how long a checkpoint may wait for readers
+VACUUM_MIN_FREE = 256        # free pages before an incremental vacuum is worth it
+VACUUM_STEP = 256            # pages released per write transaction
+VACUUM_BUDGET = 5.0          # seconds of vacuuming per shard and check
+
+TASKS = ('checkpoint', 'vacuum', 'optimize', 'analyze', 'notifications', 'activity', 'retention')
+
+
+def wal_size(slug=None) -> int:
+    try:
+        return os.path.getsize(tenants.db_path(slug) + '-wal')
+    except OSError:
+        return 0
+
+
+def checkpoint(conn) -> dict:
+    """Checkpoint the WAL and truncate it to zero bytes unless readers are still using it."""
+    conn.execute(f'PRAGMA busy_timeout = {CHECKPOINT_BUSY_MS}')
+    try:
+        busy, log, done = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    finally:
+        conn.execute(f'PRAGMA busy_timeout = {tenants.BUSY_TIMEOUT}')
+    return {'busy': bool(busy), 'wal_pages': log, 'checkpointed': done}
+
+
+def incremental_vacuum(conn, budget=VACUUM_BUDGET) -> dict:
+    """Return free pages to the filesystem a step at a time so writers can interleave."""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return {'skipped': 'auto_vacuum is not INCREMENTAL'}
+    start = free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    deadline = time.monotonic() + budget
+    while free and time.monotonic() < deadline:
+        # executescript steps the pragma to completion; execute() frees one page
+        conn.executescript(f'PRAGMA incremental_vacuum({VACUUM_STEP});')
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        time.sleep(0.01)
+    return {'released_pages': start - free, 'free_pages': free}
+
+
+def optimize(conn) -> dict:
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    conn.execute('PRAGMA optimize').fetchall()
+    return {}
+
+
+def analyze(conn) -> dict:
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    conn.execute('ANALYZE')
+    conn.commit()
+    return {}
+
+
+def prune_notifications(slug=None) -> dict:
+    import services   # services imports this module
+    with tenants.use(slug or tenants.current()):
+        return services.prune_notifications()
+
+
+def rollup_activity(slug=None) -> dict:
+    import services
+    with tenants.use(slug or tenants.current()):
+        return services.rollup_activity()
+
+
+def apply_retention(slug=None) -> dict:
+    import services
+    with tenants.use(slug or tenants.current()):
+        return {'attempts': services.compact_attempts(), 'audit': services.expire_deleted_records()}
+
+
+def _claim(conn, task, interval) -> bool:
+    """Take a periodic task for this run; False if another worker ran it recently."""
+    now = time.time()
+    try:
+        conn.execute('INSERT OR IGNORE INTO maintenance_runs (task, last_run) VALUES (?, 0)', (task,))
+        cur = conn.execute('UPDATE maintenance_runs SET last_run = ? WHERE task = ? AND last_run <= ?',
+                           (now, task, now - interval))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        return False
+    return cur.rowcount == 1
+
+
+def run(slug=None, tasks=TASKS, force=False) -> dict:
+    """
+    Run due maintenance on one shard (the current tenant by default).
+
+    With force=True every requested task runs regardless of thresholds and
+    schedules. Returns {task: result} for the tasks that ran.
+    """
+    out = {}
+    conn = tenants.connect(slug)
+    try:
+        if 'checkpoint' in tasks and (force or wal_size(slug) > WAL_LIMIT):
+            before = wal_size(slug)
+            out['checkpoint'] = dict(checkpoint(conn), wal_bytes_before=before, wal_bytes_after=wal_size(slug))
+        if 'vacuum' in tasks and (force or conn.execute('PRAGMA freelist_count').fetchone()[0] >= VACUUM_MIN_FREE):
+            out['vacuum'] = incremental_vacuum(conn)
+        if 'optimize' in tasks and (force or _claim(conn, 'optimize', OPTIMIZE_INTERVAL)):
+            out['optimize'] = optimize(conn)
+        if 'analyze' in tasks and (force or _claim(conn, 'analyze', ANALYZE_INTERVAL)):
+            out['analyze'] = analyze(conn)
+        if 'notifications' in tasks and (force or _claim(conn, 'notifications', NOTIFY_PRUNE_INTERVAL)):
+            out['notifications'] = prune_notifications(slug)
+        if 'activity' in tasks and (force or _claim(conn, 'activity', ACTIVITY_ROLLUP_INTERVAL)):
+            out['activity'] = rollup_activity(slug)
+        if 'retention' in tasks and (force or _claim(conn, 'retention', RETENTION_INTERVAL)):
+            out['retention'] = apply_retention(slug)
+    finally:
+        conn.close()
+    return out
+
+
+class MaintenanceScheduler:
+    """Runs run() for every shard on a daemon thread; start() is cheap to call per request."""
+
+    def __init__(self, interval=CHECK_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._counts = {task: 0 for task in TASKS}
+        self._counts['errors'] = 0
+        self._last = {}
+
+    def start(self):
+        # a forked worker inherits the object but not the thread
+        if not ENABLED or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='db-maintenance', daemon=True)
+                self._thread.start()
+
+    def request_vacuum(self):
+        """Check free pages now instead of at the next interval (after a mass delete)."""
+        self._wake.set()
+
+    def run_once(self):
+        for slug in tenants.slugs():
+            try:
+                done = run(slug)
+            except Exception as e:
+                with self._lock:
+                    self._counts['errors'] += 1
+                    self._last[slug] = {'error': str(e), 'at': time.time()}
+                continue
+            if done:
+                with self._lock:
+                    for task in done:
+                        self._counts[task] += 1
+                    self._last[slug] = dict(done, at=time.time())
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.run_once()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts, interval=self.interval, wal_limit=WAL_LIMIT,
+                        wal_bytes={slug: wal_size(slug) for slug in tenants.slugs()}, last=dict(self._last))
+
+
+scheduler = MaintenanceScheduler()
+
+
+def request_vacuum():
+    scheduler.request_vacuum()
@@ -0,0 +1,164 @@
+"""
+Delivery of queued e-mail (the outbox table).
+
+Code that wants to send mail writes an outbox row in the same transaction
+as the change it reports (services._enqueue_outbox), so a message exists
+exactly when that change was committed and nothing is sent from inside a
+request. drain() then claims pending rows in batches, hands them to a
+sender and records the outcome; failed messages are retried with backoff
+up to services.OUTBOX_MAX_ATTEMPTS times. reminders.py drains after every
+round, and `python outbox.py` drains once from cron or by hand.
+
+Senders are pluggable. A sender is a context manager (opened once per
+batch) with a send(message) method that raises on failure; message is a
+dict with id, recipient, subject and body. Built in:
+    smtp   delivers over SMTP. Any local stand-in works for development,
+           e.g. `python -m aiosmtpd -n -l localhost:1025` or MailHog.
+    log    prints each message to stdout instead of sending it
+Others are added with register(name, factory).
+
+Configuration (environment variables):
+    OUTBOX_SENDER          sender name (default: smtp)
+    OUTBOX_FROM            From address (default: noreply@localhost)
+    OUTBOX_SMTP_HOST       (default: localhost)
+    OUTBOX_SMTP_PORT       (default: 1025)
+    OUTBOX_SMTP_USER / OUTBOX_SMTP_PASSWORD   log in when set
+    OUTBOX_SMTP_STARTTLS   1 to upgrade the connection with STARTTLS (default: 0)
+    OUTBOX_BATCH           messages claimed per batch (default: 100)
+"""
+
+import argparse
+import os
+import smtplib
+import sys
+from email.message import EmailMessage
+
+import services as svc
+import tenants
+
+SENDER = os.environ.get('OUTBOX_SENDER', 'smtp')
+FROM_ADDRESS = os.environ.get('OUTBOX_FROM', 'noreply@localhost')
+SMTP_HOST = os.environ.get('OUTBOX_SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('OUTBOX_SMTP_PORT', 1025))
+SMTP_USER = os.environ.get('OUTBOX_SMTP_USER')
+SMTP_PASSWORD = os.environ.get('OUTBOX_SMTP_PASSWORD')
+SMTP_STARTTLS = os.environ.get('OUTBOX_SMTP_STARTTLS', '0') == '1'
+BATCH = int(os.environ.get('OUTBOX_BATCH', 100))
+
+
+def to_email(message, sender=FROM_ADDRESS) -> EmailMessage:
+    msg = EmailMessage()
+    msg['From'] = sender
+    msg['To'] = message['recipient']
+    msg['Subject'] = message['subject']
+    msg.set_content(message['body'] or '')
+    return msg
+
+
+class SmtpSender:
+    """One SMTP connection per batch."""
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, user=SMTP_USER, password=SMTP_PASSWORD,
+                 starttls=SMTP_STARTTLS, timeout=30):
+        self.host, self.port, self.user, self.password = host, port, user, password
+        self.starttls, self.timeout = starttls, timeout
+        self._smtp = None
+
+    def __enter__(self):
+        self._smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            self._smtp.starttls()
+        if self.user:
+            self._smtp.login(self.user, self.password or '')
+        return self
+
+    def send(self, message):
+        self._smtp.send_message(to_email(message))
+
+    def __exit__(self, *exc):
+        try:
+            self._smtp.quit()
+        except smtplib.SMTPException:
+            pass
+        self._smtp = None
+
+
+class LogSender:
+    """Print messages instead of sending them."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def __enter__(self):
+        return self
+
+    def send(self, message):
+        print(f"--- outbox #{message['id']} to {message['recipient']}: {message['subject']}\n{message['body']}",
+              file=self.stream or sys.stdout)
+
+    def __exit__(self, *exc):
+        pass
+
+
+SENDERS = {'smtp': SmtpSender, 'log': LogSender}
+
+
+def register(name, factory):
+    """Make a sender available as OUTBOX_SENDER=name; factory() returns a new sender."""
+    SENDERS[name] = factory
+
+
+def get_sender(name=None):
+    name = name or SENDER
+    if name not in SENDERS:
+        raise ValueError(f'unknown OUTBOX_SENDER {name!r}; choose from {", ".join(SENDERS)}')
+    return SENDERS[name]()
+
+
+def drain(sender=None, batch=BATCH, max_batches=None) -> dict:
+    """
+    Deliver the current tenant's pending messages until none are left
+    (or max_batches). Returns {'sent': n, 'failed': n}.
+    """
+    out = {'sent': 0, 'failed': 0}
+    done = 0
+    while max_batches is None or done < max_batches:
+        messages = svc.claim_outbox(batch)
+        if not messages:
+            break
+        done += 1
+        sent, failed = [], {}
+        try:
+            with sender or get_sender() as s:
+                for m in messages:
+                    try:
+                        s.send(m)
+                    except Exception as e:
+                        failed[m['id']] = (m['attempts'], f'{type(e).__name__}: {e}')
+                    else:
+                        sent.append(m['id'])
+        except Exception as e:
+            # could not connect: the whole batch waits for the retry
+            failed.update((m['id'], (m['attempts'], f'{type(e).__name__}: {e}')) for m in messages if m['id'] not in sent)
+        svc.finish_outbox(sent, failed)
+        out['sent'] += len(sent)
+        out['failed'] += len(failed)
+        if failed and not sent:
+            break
+    return out
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Deliver queued e-mail from the outbox of every tenant shard.')
+    p.add_argument('--sender', choices=sorted(SENDERS), default=None, help=f'default: {SENDER}')
+    p.add_argument('--tenant', choices=tenants.slugs(), help='only this institution (default: all)')
+    args = p.parse_args(argv)
+    for slug in [args.tenant] if args.tenant else tenants.slugs():
+        with tenants.use(slug):
+            result = drain(get_sender(args.sender))
+        print(f"{slug}: {result['sent']} sent, {result['failed']} failed")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
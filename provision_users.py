@@ -0,0 +1,135 @@
+"""
+Bulk user provisioning.
+
+Imports users from a CSV (header row) or JSONL file with the fields
+name, email, password, role, school_id and bio. Passwords are hashed in
+parallel across a process pool and rows are written in batched
+transactions, so a semester's worth of accounts loads in minutes.
+
+Usage:
+    python provision_users.py students.csv
+    python provision_users.py staff.jsonl --on-conflict update
+    python provision_users.py students.csv --setup-tokens tokens.csv
+
+With --setup-tokens no passwords are needed: every imported account gets a
+one-time link (/setup/<token>) written to the given CSV instead. Existing
+accounts updated this way keep their current password.
+
+On a multi-institution deployment, --tenant picks the database shard the
+accounts go into (see tenants.py).
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import hashing
+import services as svc
+import tenants
+
+ROLES = ('student', 'teacher', 'admin')
+
+
+def read_rows(path):
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        if path.lower().endswith(('.jsonl', '.ndjson')):
+            return [json.loads(line) for line in f if line.strip()]
+        return list(csv.DictReader(f))
+
+
+def normalize(rows, need_password):
+    """Validate rows; returns (records, errors) with emails lowercased and de-duplicated."""
+    records, errors, seen = [], [], set()
+    for n, r in enumerate(rows, 1):
+        name = (r.get('name') or '').strip()
+        email = (r.get('email') or '').strip().lower()
+        role = (r.get('role') or 'student').strip().lower()
+        password = r.get('password') or ''
+        if not name or not email:
+            errors.append((n, 'name and email are required'))
+        elif role not in ROLES:
+            errors.append((n, f'invalid role {role!r}'))
+        elif need_password and len(password) < 6:
+            errors.append((n, 'password must be at least 6 characters'))
+        elif email in seen:
+            errors.append((n, f'duplicate email {email}'))
+        else:
+            seen.add(email)
+            records.append({'name': name, 'email': email, 'password': password, 'role': role,
+                            'school_id': (r.get('school_id') or '').strip() or None,
+                            'bio': (r.get('bio') or '').strip() or None})
+    return records, errors
+
+
+def hash_passwords(passwords, workers=None):
+    """Hash passwords across a process pool using hashing.HASH_METHOD; order is preserved."""
+    fn = partial(hashing._hash, method=hashing.HASH_METHOD)
+    if len(passwords) < 2 or workers == 1:
+        return [fn(p) for p in passwords]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(fn, passwords, chunksize=32))
+
+
+def provision(path, on_conflict='skip', tokens_out=None, batch_size=1000, workers=None):
+    records, errors = normalize(read_rows(path), need_password=tokens_out is None)
+    for n, msg in errors:
+        print(f'  row {n}: {msg}')
+    existing = svc.existing_emails(r['email'] for r in records)
+    if on_conflict == 'skip':
+        records = [r for r in records if r['email'] not in existing]
+
+    if tokens_out:
+        for r in records:
+            r['password_hash'] = svc.UNUSABLE_PASSWORD
+    else:
+        for r, ph in zip(records, hash_passwords([r['password'] for r in records], workers)):
+            r['password_hash'] = ph
+
+    written = 0
+    for batch in svc._chunks(records, batch_size):
+        # with setup tokens, existing accounts keep their password until the link is used
+        written += svc.bulk_upsert_users(batch, update_existing=on_conflict == 'update',
+                                         keep_passwords=tokens_out is not None)
+
+    if tokens_out:
+        tokens = svc.create_setup_tokens([r['email'] for r in records])
+        with open(tokens_out, 'w', newline='', encoding='utf8') as f:
+            w = csv.writer(f)
+            w.writerow(['email', 'setup_path'])
+            for email, token in tokens.items():
+                w.writerow([email, f'/setup/{token}' + (f'?tenant={tenants.current()}' if tenants.MULTI else '')])
+
+    updated = sum(1 for r in records if r['email'] in existing)
+    print(f'Created {written - updated}, updated {updated}, '
+          f'skipped {len(existing) if on_conflict == "skip" else 0} existing, {len(errors)} invalid')
+    return written
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Bulk-import users from CSV or JSONL.')
+    p.add_argument('file')
+    p.add_argument('--on-conflict', choices=('skip', 'update'), default='skip',
+                   help='what to do with emails that already exist (default: skip)')
+    p.add_argument('--setup-tokens', metavar='OUT_CSV',
+                   help='issue one-time setup links instead of importing passwords')
+    p.add_argument('--batch-size', type=int, default=1000)
+    p.add_argument('--workers', type=int, default=os.cpu_count())
+    p.add_argument('--tenant', choices=tenants.slugs(), default=tenants.DEFAULT,
+                   help='institution whose database receives the users (default: %(default)s)')
+    args = p.parse_args(argv)
+    if not os.path.exists(args.file):
+        print('File not found:', args.file)
+        return 2
+    import app
+    app.migrate_all()   # setup_tokens and any other tables the import needs
+    with tenants.use(args.tenant):
+        provision(args.file, args.on_conflict, args.setup_tokens, args.batch_size, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
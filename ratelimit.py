@@ -0,0 +1,181 @@
+"""
+Token-bucket rate limiting for abuse-prone routes (login, register, quiz attempts).
+
+Limits are declared per route with the rate_limit decorator, placed above
+role_required so rejected clients never reach a database query or the
+password hasher:
+
+    @app.route('/login', methods=['GET', 'POST'])
+    @rate_limit(10, per=60, key='ip', methods=('POST',))
+    @rate_limit(5, per=300, key='email', methods=('POST',))
+    def login(): ...
+
+Buckets live in a fixed-size in-process LRU table by default. Set
+RATE_LIMIT_STORE to a file path to share buckets between gunicorn workers
+through a small local SQLite file instead. RATE_LIMIT_ENABLED=0 turns
+limiting off (e.g. for load tests).
+
+The 'ip' key is request.remote_addr. Behind a reverse proxy set
+TRUSTED_PROXY_HOPS (app.py applies ProxyFix), or every client shares the
+proxy's bucket. A school behind one NAT still shares an address; per-IP
+limits are multiplied by RATE_LIMIT_IP_SCALE for such deployments, and
+abuse of single accounts is caught by the 'email' buckets anyway. 'email'
+and 'user' keys are namespaced by tenant, since the same address or user
+id can exist at two institutions.
+"""
+
+import functools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import request, session
+
+import tenants
+
+ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+STORE_PATH = os.environ.get('RATE_LIMIT_STORE')
+MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 65536))
+IP_SCALE = float(os.environ.get('RATE_LIMIT_IP_SCALE', 1))
+
+
+class RateLimited(Exception):
+    """Raised when a client has exhausted its bucket; retry_after is in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__('Too many requests')
+        self.retry_after = retry_after
+
+
+def _refill(tokens, stamp, now, capacity, rate):
+    return min(capacity, tokens + (now - stamp) * rate)
+
+
+class MemoryStore:
+    """Per-process buckets in an LRU-bounded table of (tokens, timestamp) pairs."""
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            entry = self._buckets.pop(key, None)
+            tokens = capacity if entry is None else _refill(entry[0], entry[1], now, capacity, rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+
+class SqliteStore:
+    """Buckets shared by every worker on the host through a local SQLite file."""
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, max_keys=MAX_KEYS):
+        self.path = path
+        self.max_keys = max_keys
+        self._local = threading.local()
+        self._ops = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL;')
+            conn.execute('PRAGMA synchronous=OFF;')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, stamp REAL) WITHOUT ROWID')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_buckets_stamp ON buckets(stamp)')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, rate, now):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, stamp FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = capacity if row is None else _refill(row[0], row[1], now, capacity, rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, stamp) VALUES (?, ?, ?)', (key, tokens, now))
+            self._ops += 1
+            if self._ops % self.PRUNE_EVERY == 0:
+                # evict least recently touched keys beyond the size cap
+                conn.execute('DELETE FROM buckets WHERE key IN (SELECT key FROM buckets ORDER BY stamp DESC LIMIT -1 OFFSET ?)', (self.max_keys,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, tokens
+
+
+store = SqliteStore(STORE_PATH) if STORE_PATH else MemoryStore()
+
+
+def _client_ip():
+    return request.remote_addr or 'unknown'
+
+
+def _email():
+    # the login form posts a form field, the JSON API a JSON body
+    email = request.form.get('email')
+    if email is None and request.is_json:
+        email = (request.get_json(silent=True) or {}).get('email')
+    email = email.strip().lower() if isinstance(email, str) else ''
+    return f'{tenants.current()}:{email}' if email else None
+
+
+def _session_user():
+    # user ids are only unique within one tenant's database shard
+    uid = session.get('user_id')
+    if uid is not None and session.get('tenant'):
+        return f"{session['tenant']}:{uid}"
+    return uid
+
+
+KEY_FUNCS = {
+    'ip': _client_ip,
+    'email': _email,
+    'user': _session_user,
+}
+
+
+def rate_limit(limit, per=60, key='ip', burst=None, methods=None, scope=None):
+    """
+    Allow `limit` requests per `per` seconds for each client key.
+
+    key is 'ip', 'email' (form field or JSON body), 'user' (session) or a
+    callable returning the key; requests without a key (e.g. no email
+    submitted) are not counted. 'ip' limits are scaled by IP_SCALE. burst
+    sets the bucket size (defaults to limit). methods
+    restricts counting to those HTTP methods. Buckets are namespaced by
+    scope, which defaults to the view function name.
+    """
+    keyfunc = KEY_FUNCS[key] if isinstance(key, str) else key
+    if key == 'ip':
+        limit, burst = limit * IP_SCALE, burst and burst * IP_SCALE
+    capacity = burst or limit
+    rate = limit / float(per)
+
+    def decorator(f):
+        ns = scope or f.__name__
+
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            if ENABLED and (methods is None or request.method in methods):
+                k = keyfunc()
+                if k is not None:
+                    allowed, tokens = store.take(f'{ns}:{key if isinstance(key, str) else "fn"}:{k}',
+                                                 capacity, rate, time.time())
+                    if not allowed:
+                        raise RateLimited(max(1, int((1 - tokens) / rate + 0.999)))
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
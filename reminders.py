@@ -0,0 +1,170 @@
+"""
+Deadline reminders: a scheduler process for assignment due dates.
+
+    python reminders.py            # run until stopped (SIGTERM / Ctrl+C)
+    python reminders.py --once     # send what is due now, drain the outbox, exit
+
+assignments.due_at holds every due date normalized to unix seconds
+(services.parse_due_date). The scheduler keeps a min-heap of the reminder
+times coming up across all tenant shards, services.REMINDER_WINDOWS before
+each deadline (24 hours and 1 hour), and sleeps until the earliest one. When
+a reminder comes due, one anti-join per assignment finds the enrolled
+students (class_members) without a submissions row, and their in-app
+notifications and outbox e-mails are written in one batched transaction
+(services.send_due_reminders). After each round the outbox is drained
+(outbox.py).
+
+The heap only holds deadlines within the next day or so: it is refilled
+from the due_at index every RESCAN_INTERVAL seconds, which also picks up
+new and edited assignments. Entries for a due date that has since changed
+are dropped when they reach the top. Every window is claimed in the
+due_reminders table before anything is sent, so a restarted or second
+scheduler never reminds twice. A window is skipped when a later one is
+already due, so an assignment posted 30 minutes before its deadline only
+gets the 1-hour reminder.
+
+Configuration (environment variables):
+    REMINDER_RESCAN   seconds between refills of the heap (default: 60)
+    OUTBOX_*          delivery settings, see outbox.py
+"""
+
+import argparse
+import heapq
+import os
+import signal
+import sys
+import threading
+import time
+
+import outbox
+import services as svc
+import tenants
+
+RESCAN_INTERVAL = float(os.environ.get('REMINDER_RESCAN', 60))
+
+_OFFSETS = dict(svc.REMINDER_WINDOWS)
+_LARGEST = max(_OFFSETS.values())
+
+
+class DeadlineScheduler:
+    """Min-heap of (fire_at, tenant, assignment id, window, due_at) across every shard."""
+
+    def __init__(self, rescan=RESCAN_INTERVAL, drain_outbox=True, sender=None):
+        self.rescan = rescan
+        self.drain_outbox = drain_outbox
+        self.sender = sender
+        self.heap = []
+        # (tenant, assignment id, window) -> the due_at it is scheduled (or was sent) for
+        self.scheduled = {}
+        self.stop = threading.Event()
+        self.counts = {'windows': 0, 'reminded': 0, 'skipped': 0, 'sent': 0, 'failed': 0, 'errors': 0}
+
+    def refill(self, now=None):
+        """Push the windows of deadlines in the coming RESCAN + largest window that are not queued yet."""
+        now = now or time.time()
+        horizon = now + _LARGEST + 2 * self.rescan
+        for key, due_at in list(self.scheduled.items()):
+            if due_at <= now:
+                del self.scheduled[key]
+        for slug in tenants.slugs():
+            with tenants.use(slug):
+                deadlines = svc.upcoming_deadlines(now, horizon)
+            for assignment_id, due_at in deadlines:
+                for window, offset in svc.REMINDER_WINDOWS:
+                    key = (slug, assignment_id, window)
+                    if self.scheduled.get(key) != due_at:
+                        self.scheduled[key] = due_at
+                        heapq.heappush(self.heap, (due_at - offset, slug, assignment_id, window, due_at))
+
+    def pop_due(self, now=None) -> list:
+        """Remove and return the entries whose time has come, minus stale and superseded ones."""
+        now = now or time.time()
+        due = {}
+        while self.heap and self.heap[0][0] <= now:
+            fire_at, slug, assignment_id, window, due_at = heapq.heappop(self.heap)
+            if self.scheduled.get((slug, assignment_id, window)) != due_at or due_at <= now:
+                continue
+            # of several windows due at once only the latest (smallest offset) is sent
+            key = (slug, assignment_id, due_at)
+            if key not in due or _OFFSETS[window] < _OFFSETS[due[key]]:
+                if key in due:
+                    self.counts['skipped'] += 1
+                due[key] = window
+            else:
+                self.counts['skipped'] += 1
+        return [(slug, assignment_id, window, due_at) for (slug, assignment_id, due_at), window in due.items()]
+
+    def run_due(self, now=None) -> int:
+        """Send every reminder that is due; returns the number of students reminded."""
+        reminded = 0
+        for slug, assignment_id, window, due_at in self.pop_due(now):
+            try:
+                with tenants.use(slug):
+                    n = svc.send_due_reminders(assignment_id, window, due_at)
+            except Exception as e:
+                self.counts['errors'] += 1
+                print(f'{slug}: reminder {window} for assignment {assignment_id} failed: {e}', file=sys.stderr)
+                continue
+            if n is not None:
+                self.counts['windows'] += 1
+                reminded += n
+        self.counts['reminded'] += reminded
+        return reminded
+
+    def drain(self):
+        for slug in tenants.slugs():
+            try:
+                with tenants.use(slug):
+                    result = outbox.drain(self.sender)
+            except Exception as e:
+                self.counts['errors'] += 1
+                print(f'{slug}: outbox drain failed: {e}', file=sys.stderr)
+                continue
+            self.counts['sent'] += result['sent']
+            self.counts['failed'] += result['failed']
+
+    def run_once(self, now=None):
+        self.refill(now)
+        self.run_due(now)
+        if self.drain_outbox:
+            self.drain()
+
+    def run(self):
+        next_refill = 0.0
+        while not self.stop.is_set():
+            now = time.time()
+            if now >= next_refill:
+                self.refill(now)
+                next_refill = now + self.rescan
+            self.run_due(now)
+            if self.drain_outbox:
+                self.drain()
+            wake = next_refill if not self.heap else min(next_refill, self.heap[0][0])
+            self.stop.wait(max(0.0, wake - time.time()))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Send assignment due-date reminders as deadlines approach.')
+    p.add_argument('--once', action='store_true', help='send what is due now and exit')
+    p.add_argument('--no-outbox', action='store_true', help='only write notifications and outbox rows')
+    p.add_argument('--sender', choices=sorted(outbox.SENDERS), help=f'outbox sender (default: {outbox.SENDER})')
+    args = p.parse_args(argv)
+
+    import app
+    app.create_app()
+    scheduler = DeadlineScheduler(drain_outbox=not args.no_outbox, sender=outbox.get_sender(args.sender))
+    if args.once:
+        scheduler.run_once()
+    else:
+        signal.signal(signal.SIGTERM, lambda *_: scheduler.stop.set())
+        print(f'reminders: watching {", ".join(tenants.slugs())}, refill every {scheduler.rescan:g}s')
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            pass
+    print('reminders: ' + ', '.join(f'{k} {v}' for k, v in scheduler.counts.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -39,7 +39,11 @@ DESCRIPTION:
 import sqlite3
 import os
 import json
-from werkzeug.security import generate_password_hash
+import zlib
+from io import StringIO
+import hashing
+import maintenance
+import tenants
 
 BASE_DIR = os.path.dirname(__file__)
 DB_PATH = os.path.join(BASE_DIR, 'database.db')
@@ -54,6 +58,8 @@ def _get_conn():
     Establish a database connection with optimal concurrency settings.
     
     Configuration:
+    - Routed to the current tenant's database shard (see tenants.py)
+    - Reused from a per-shard pool; close() hands it back
     - 10-second timeout for concurrent access
     - WAL (Write-Ahead Logging) for better performance
     - Foreign key constraint enforcement
@@ -61,16 +67,27 @@ def _get_conn():
     Returns:
         sqlite3.Connection: Database connection with row factory enabled
     """
-    # Add a timeout to wait for locks, allow connections from other threads,
-    # and enable WAL for better concurrency.
-    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    try:
-        conn.execute('PRAGMA journal_mode=WAL;')
-        conn.execute('PRAGMA foreign_keys = ON;')
-    except Exception:
-        pass
-    return conn
+    return tenants.connect()
+
+
+def _get_read_conn():
+    """
+    Read-only connection for service functions that only query.
+
+    Comes from the shard's reader pool (mode=ro, query_only), so long reads
+    such as exports and analytics never hold up submit_assignment or
+    evaluate_quiz_attempt.
+    """
+    return tenants.connect(readonly=True)
+
+
+# SQLite builds before 3.32 cap bound parameters at 999 per statement
+_IN_BATCH = 500
+
+
+def _chunks(seq, n=_IN_BATCH):
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
 
 
 # ============================================================================
@@ -79,7 +96,7 @@ def _get_conn():
 
 def create_user(name: str, email: str, password: str, role: str = 'student', school_id: str = None, bio: str = None) -> int:
     """Create a user and return new user id. Raises sqlite3.IntegrityError if email exists."""
-    ph = generate_password_hash(password)
+    ph = hashing.hash_password(password)
     conn = _get_conn()
     cur = conn.execute('INSERT INTO users (name, email, password_hash, role, school_id, bio) VALUES (?, ?, ?, ?, ?, ?)',
                        (name, email, ph, role, school_id, bio))
@@ -89,15 +106,121 @@ def create_user(name: str, email: str, password: str, role: str = 'student', sch
     return uid
 
 
-def get_user_by_email(email: str):
+# Stored in place of a password hash for accounts that must be claimed through
+# a setup token; check_password_hash never accepts it.
+UNUSABLE_PASSWORD = '!'
+
+
+def existing_emails(emails: list) -> set:
+    """Return the subset of emails that already belong to a user."""
+    emails = list(emails)
+    conn = _get_read_conn()
+    found = set()
+    for chunk in _chunks(emails):
+        placeholders = ','.join(['?'] * len(chunk))
+        found.update(r['email'] for r in conn.execute(f'SELECT email FROM users WHERE email IN ({placeholders})', tuple(chunk)).fetchall())
+    conn.close()
+    return found
+
+
+def bulk_upsert_users(records: list, update_existing: bool = False, keep_passwords: bool = False) -> int:
+    """
+    Insert many users in one transaction.
+
+    records are dicts with name, email, password_hash, role, school_id, bio.
+    Existing emails are left untouched unless update_existing is set, in which
+    case their profile fields and password hash are overwritten; with
+    keep_passwords the existing password hash stays (password_hash is then
+    only used for new accounts, e.g. UNUSABLE_PASSWORD with setup tokens).
+    Returns the number of rows written.
+    """
+    if update_existing:
+        sql = ('INSERT INTO users (name, email, password_hash, role, school_id, bio) VALUES (?, ?, ?, ?, ?, ?) '
+               'ON CONFLICT(email) DO UPDATE SET name = excluded.name, '
+               + ('' if keep_passwords else 'password_hash = excluded.password_hash, ') +
+               'role = excluded.role, school_id = excluded.school_id, bio = COALESCE(excluded.bio, users.bio)')
+    else:
+        sql = 'INSERT OR IGNORE INTO users (name, email, password_hash, role, school_id, bio) VALUES (?, ?, ?, ?, ?, ?)'
+    params = [(r['name'], r['email'], r['password_hash'], r.get('role') or 'student', r.get('school_id'), r.get('bio'))
+              for r in records]
     conn = _get_conn()
+    try:
+        with conn:
+            before = conn.total_changes
+            conn.executemany(sql, params)
+            written = conn.total_changes - before
+    finally:
+        conn.close()
+    return written
+
+
+def _hash_token(token: str) -> str:
+    import hashlib
+    return hashlib.sha256(token.encode('utf8')).hexdigest()
+
+
+def create_setup_tokens(emails: list, ttl_days: int = 7) -> dict:
+    """
+    Issue one-time password setup tokens for the given emails.
+
+    Only a SHA-256 of each token is stored. Returns {email: token} for the
+    emails that matched a user.
+    """
+    import secrets
+    emails = list(emails)
+    conn = _get_conn()
+    try:
+        ids = {}
+        for chunk in _chunks(emails):
+            placeholders = ','.join(['?'] * len(chunk))
+            ids.update((r['email'], r['id']) for r in conn.execute(f'SELECT id, email FROM users WHERE email IN ({placeholders})', tuple(chunk)).fetchall())
+        tokens = {email: secrets.token_urlsafe(24) for email in ids}
+        with conn:
+            conn.executemany(f"INSERT INTO setup_tokens (token_hash, user_id, expires_at) VALUES (?, ?, datetime('now', '+{int(ttl_days)} days'))",
+                             [(_hash_token(t), ids[e]) for e, t in tokens.items()])
+    finally:
+        conn.close()
+    return tokens
+
+
+def get_setup_token_user(token: str):
+    """Return the user a valid (unused, unexpired) setup token belongs to, or None."""
+    conn = _get_read_conn()
+    try:
+        return conn.execute("SELECT u.* FROM setup_tokens t JOIN users u ON u.id = t.user_id WHERE t.token_hash = ? AND t.used_at IS NULL AND t.expires_at > datetime('now')",
+                            (_hash_token(token),)).fetchone()
+    finally:
+        conn.close()
+
+
+def consume_setup_token(token: str, password: str):
+    """Set the password for a setup token's user and burn the token. Returns the user id or None."""
+    ph = hashing.hash_password(password)
+    conn = _get_conn()
+    try:
+        with conn:
+            row = conn.execute("SELECT user_id FROM setup_tokens WHERE token_hash = ? AND used_at IS NULL AND expires_at > datetime('now')",
+                               (_hash_token(token),)).fetchone()
+            if not row:
+                return None
+            cur = conn.execute('UPDATE setup_tokens SET used_at = CURRENT_TIMESTAMP WHERE token_hash = ? AND used_at IS NULL', (_hash_token(token),))
+            if cur.rowcount != 1:
+                return None
+            conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (ph, row['user_id']))
+        return row['user_id']
+    finally:
+        conn.close()
+
+
+def get_user_by_email(email: str):
+    conn = _get_read_conn()
     u = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
     conn.close()
     return u
 
 
 def get_user_by_id(user_id: int):
-    conn = _get_conn()
+    conn = _get_read_conn()
     u = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
     conn.close()
     return u
@@ -116,6 +239,18 @@ def update_user_profile(user_id: int, name: str, email: str, school_id: str = No
     return True
 
 
+def set_password(user_id: int, password: str):
+    """Hash and store a new password for a user."""
+    set_password_hash(user_id, hashing.hash_password(password))
+
+
+def set_password_hash(user_id: int, password_hash: str):
+    conn = _get_conn()
+    conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (password_hash, user_id))
+    conn.commit()
+    conn.close()
+
+
 def set_user_role(user_id: int, role: str):
     conn = _get_conn()
     conn.execute('UPDATE users SET role = ? WHERE id = ?', (role, user_id))
@@ -123,8 +258,84 @@ def set_user_role(user_id: int, role: str):
     conn.close()
 
 
+# ============================================================================
+# AUTHORIZATION
+# ============================================================================
+
+_USER_COLS = ('id', 'name', 'email', 'role', 'school_id', 'bio')
+
+# One primary-key lookup per kind: the acting user, the target object and the
+# teacher that owns the course it belongs to.
+_AUTHZ_SQL = {
+    'course': 'SELECT {u}, c.teacher_id AS _owner, c.* FROM users u '
+              'LEFT JOIN courses c ON c.id = ? WHERE u.id = ?',
+    'lesson': 'SELECT {u}, c.teacher_id AS _owner, l.*, c.teacher_id FROM users u '
+              'LEFT JOIN lessons l ON l.id = ? LEFT JOIN courses c ON c.id = l.course_id WHERE u.id = ?',
+    'assignment': 'SELECT {u}, c.teacher_id AS _owner, a.*, l.course_id, c.teacher_id FROM users u '
+                  'LEFT JOIN assignments a ON a.id = ? LEFT JOIN lessons l ON l.id = a.lesson_id '
+                  'LEFT JOIN courses c ON c.id = l.course_id WHERE u.id = ?',
+    'quiz': 'SELECT {u}, c.teacher_id AS _owner, q.*, l.course_id, c.teacher_id FROM users u '
+            'LEFT JOIN quizzes q ON q.id = ? LEFT JOIN lessons l ON l.id = q.lesson_id '
+            'LEFT JOIN courses c ON c.id = l.course_id WHERE u.id = ?',
+}
+
+
+def authorize(user_id: int, kind: str, obj_id: int):
+    """
+    Load the acting user and a course/lesson/assignment/quiz in a single query.
+
+    Returns (user, obj, owner_id): user is None if the account no longer
+    exists, obj is None if the object does not exist, and owner_id is the
+    teacher_id of the course the object belongs to.
+    """
+    sql = _AUTHZ_SQL[kind].format(u=', '.join('u.' + c for c in _USER_COLS))
+    conn = _get_read_conn()
+    cur = conn.execute(sql, (obj_id, user_id))
+    row = cur.fetchone()
+    names = [d[0] for d in cur.description]
+    conn.close()
+    if not row:
+        return None, None, None
+    n = len(_USER_COLS)
+    user = dict(zip(_USER_COLS, row[:n]))
+    owner = row[n]
+    obj = dict(zip(names[n + 1:], row[n + 1:]))
+    if obj.get('id') is None:
+        obj = None
+    return user, obj, owner
+
+
+# Course ids owned by each (tenant, teacher), cached per process. Entries are dropped when
+# the teacher creates or deletes a course here and expire after a short TTL so
+# changes made by other workers show up too.
+_OWNED_TTL = 60
+_owned_courses = {}
+
+
+def owned_course_ids(teacher_id: int) -> frozenset:
+    import time
+    key = (tenants.current(), teacher_id)
+    hit = _owned_courses.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    conn = _get_read_conn()
+    ids = frozenset(r['id'] for r in conn.execute('SELECT id FROM courses WHERE teacher_id = ?', (teacher_id,)).fetchall())
+    conn.close()
+    _owned_courses[key] = (time.monotonic() + _OWNED_TTL, ids)
+    return ids
+
+
+def invalidate_owned_courses(teacher_id: int = None):
+    if teacher_id is None:
+        _owned_courses.clear()
+    else:
+        _owned_courses.pop((tenants.current(), teacher_id), None)
+
+
 import random
 import string
+from collections import OrderedDict
+from itertools import chain, permutations, repeat
 
 
 def _generate_code(n=6):
@@ -149,6 +360,7 @@ def create_course(title: str, description: str, teacher_id: int, code: str = Non
     conn.commit()
     cid = cur.lastrowid
     conn.close()
+    invalidate_owned_courses(teacher_id)
     return cid
 
 
@@ -156,8 +368,9 @@ def create_lesson(course_id: int, title: str, content: str, attachment: str = No
     conn = _get_conn()
     cur = conn.execute('INSERT INTO lessons (course_id, title, content, attachments) VALUES (?, ?, ?, ?)',
                        (course_id, title, content, attachment))
-    conn.commit()
     lid = cur.lastrowid
+    _notify_course(conn, course_id, 'lesson', f'New lesson: {title}', f'/lesson/{lid}')
+    conn.commit()
     conn.close()
     return lid
 
@@ -180,28 +393,91 @@ def join_class(student_id: int, code: str) -> int:
     return course_id
 
 
-def get_teacher_classes(teacher_id: int):
+def parse_roster_csv(text: str) -> list:
+    """
+    Extract student identifiers (emails or school IDs) from roster CSV text.
+
+    Uses the 'email' / 'school_id' columns when a header row names them,
+    otherwise the first non-empty cell of every row. Duplicates are dropped
+    while keeping file order.
+    """
+    import csv
+    rows = [r for r in csv.reader(StringIO(text)) if any(c.strip() for c in r)]
+    if not rows:
+        return []
+    header = [c.strip().lower() for c in rows[0]]
+    cols = [header.index(k) for k in ('email', 'school_id') if k in header]
+    if cols:
+        rows = rows[1:]
+    idents = []
+    for r in rows:
+        cells = [r[i] for i in cols if i < len(r)] if cols else r
+        val = next((c.strip() for c in cells if c.strip()), None)
+        if val:
+            idents.append(val.lower() if '@' in val else val)
+    return list(dict.fromkeys(idents))
+
+
+def bulk_enroll(course_id: int, identifiers: list) -> dict:
+    """
+    Enroll many students into a course in a single transaction.
+
+    Identifiers containing '@' are matched against users.email, everything
+    else against users.school_id; only student accounts are enrolled.
+    Returns {'matched': [...], 'unmatched': [...], 'already_enrolled': [...]}
+    where matched lists the newly enrolled students.
+    """
+    emails = [i for i in identifiers if '@' in i]
+    school_ids = [i for i in identifiers if '@' not in i]
     conn = _get_conn()
+    try:
+        found = {}
+        for key, values in (('email', emails), ('school_id', school_ids)):
+            for chunk in _chunks(values):
+                placeholders = ','.join(['?'] * len(chunk))
+                for r in conn.execute(f"SELECT id, name, email, school_id FROM users WHERE role = 'student' AND {key} IN ({placeholders})", tuple(chunk)).fetchall():
+                    found[r[key]] = r
+        students = list({r['id']: r for r in found.values()}.values())
+        ids = [r['id'] for r in students]
+        enrolled = set()
+        for chunk in _chunks(ids):
+            placeholders = ','.join(['?'] * len(chunk))
+            enrolled.update(r['student_id'] for r in conn.execute(f'SELECT student_id FROM class_members WHERE course_id = ? AND student_id IN ({placeholders})', (course_id, *chunk)).fetchall())
+        new = [r for r in students if r['id'] not in enrolled]
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO class_members (course_id, student_id) VALUES (?, ?)',
+                             [(course_id, r['id']) for r in new])
+    finally:
+        conn.close()
+    return {
+        'matched': [dict(r) for r in new],
+        'unmatched': [i for i in identifiers if i not in found],
+        'already_enrolled': [dict(r) for r in students if r['id'] in enrolled],
+    }
+
+
+def get_teacher_classes(teacher_id: int):
+    conn = _get_read_conn()
     rows = conn.execute('SELECT * FROM courses WHERE teacher_id = ?', (teacher_id,)).fetchall()
     conn.close()
     return rows
 
 
 def get_class_students(course_id: int):
-    conn = _get_conn()
+    conn = _get_read_conn()
     rows = conn.execute('SELECT u.id, u.name, u.email, u.school_id, cm.joined_at FROM class_members cm JOIN users u ON cm.student_id = u.id WHERE cm.course_id = ?', (course_id,)).fetchall()
     conn.close()
     return rows
 
 
 def student_is_member(student_id: int, course_id: int) -> bool:
-    conn = _get_conn()
+    conn = _get_read_conn()
     r = conn.execute('SELECT id FROM class_members WHERE course_id = ? AND student_id = ?', (course_id, student_id)).fetchone()
     conn.close()
     return bool(r)
 
 
-def remove_course(course_id: int, teacher_id: int) -> bool:
+def remove_course(course_id: int, teacher_id: int, deleted_by: int = None) -> bool:
     conn = _get_conn()
     # ensure teacher owns it
     c = conn.execute('SELECT * FROM courses WHERE id = ?', (course_id,)).fetchone()
@@ -211,9 +487,8 @@ def remove_course(course_id: int, teacher_id: int) -> bool:
     
     # Audit trail: Save to deleted_courses before deleting
     try:
-        snapshot = dict(c)
-        conn.execute('INSERT INTO deleted_courses (course_id, title, teacher_id, snapshot) VALUES (?, ?, ?, ?)',
-                     (course_id, c['title'], teacher_id, json.dumps(snapshot)))
+        conn.execute('INSERT INTO deleted_courses (course_id, title, teacher_id, snapshot, deleted_by) VALUES (?, ?, ?, ?, ?)',
+                     (course_id, c['title'], teacher_id, _encode_snapshot(dict(c)), deleted_by))
     except Exception:
         pass
 
@@ -223,6 +498,7 @@ def remove_course(course_id: int, teacher_id: int) -> bool:
     conn.execute('DELETE FROM courses WHERE id = ?', (course_id,))
     conn.commit()
     conn.close()
+    invalidate_owned_courses(teacher_id)
     return True
 
 
@@ -254,7 +530,8 @@ def update_lesson(lesson_id: int, title: str, content: str) -> bool:
 
 def update_assignment(assignment_id: int, title: str, description: str, due_date: str = None) -> bool:
     conn = _get_conn()
-    conn.execute('UPDATE assignments SET title = ?, description = ?, due_date = ? WHERE id = ?', (title, description, due_date, assignment_id))
+    conn.execute('UPDATE assignments SET title = ?, description = ?, due_date = ?, due_at = ? WHERE id = ?',
+                 (title, description, due_date, parse_due_date(due_date), assignment_id))
     conn.commit()
     conn.close()
     return True
@@ -279,9 +556,8 @@ def delete_assignment(assignment_id: int) -> bool:
     return True
 
 
-def delete_user(user_id: int) -> bool:
+def delete_user(user_id: int, deleted_by: int = None) -> bool:
     """Soft-delete a user: mark inactive and record a snapshot in deleted_users for restore."""
-    import json
     conn = _get_conn()
     try:
         u = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
@@ -301,16 +577,7 @@ def delete_user(user_id: int) -> bool:
             # if column missing, ignore and proceed to delete fallback
             pass
 
-        snapshot = dict(u)
-        # remove sqlite Row-specific items
-        for k in list(snapshot.keys()):
-            try:
-                snapshot[k] = snapshot[k]
-            except Exception:
-                snapshot[k] = None
-
-        conn.execute('INSERT INTO deleted_users (user_id, snapshot, deleted_by) VALUES (?, ?, ?)',
-                     (user_id, json.dumps(snapshot), None))
+        _record_deleted_user(conn, u, {}, deleted_by)
         conn.commit()
         conn.close()
         return True
@@ -322,10 +589,14 @@ def delete_user(user_id: int) -> bool:
 
 def create_assignment(lesson_id: int, title: str, description: str = None, due_date: str = None) -> int:
     conn = _get_conn()
-    cur = conn.execute('INSERT INTO assignments (lesson_id, title, description, due_date) VALUES (?, ?, ?, ?)',
-                       (lesson_id, title, description, due_date))
-    conn.commit()
+    cur = conn.execute('INSERT INTO assignments (lesson_id, title, description, due_date, due_at) VALUES (?, ?, ?, ?, ?)',
+                       (lesson_id, title, description, due_date, parse_due_date(due_date)))
     aid = cur.lastrowid
+    lesson = conn.execute('SELECT course_id FROM lessons WHERE id = ?', (lesson_id,)).fetchone()
+    if lesson:
+        _notify_course(conn, lesson['course_id'], 'assignment',
+                       f'New assignment: {title}' + (f' (due {due_date})' if due_date else ''), f'/lesson/{lesson_id}')
+    conn.commit()
     conn.close()
     return aid
 
@@ -342,48 +613,928 @@ def submit_assignment(assignment_id: int, student_id: int, file_path: str = None
 
 def grade_submission(submission_id: int, grade: float, feedback: str = None):
     conn = _get_conn()
-    conn.execute('UPDATE submissions SET grade = ?, feedback = ? WHERE id = ?', (grade, feedback, submission_id))
+    cur = conn.execute('UPDATE submissions SET grade = ?, feedback = ? WHERE id = ? AND (grade IS NOT ? OR feedback IS NOT ?)',
+                       (grade, feedback, submission_id, grade, feedback))
+    if cur.rowcount:
+        r = conn.execute('SELECT assignment_id, student_id FROM submissions WHERE id = ?', (submission_id,)).fetchone()
+        _notify_graded(conn, r['assignment_id'], [(r['student_id'], grade, feedback)])
     conn.commit()
     conn.close()
 
 
-def create_quiz(lesson_id: int, questions: list) -> int:
-    """Questions should be a list of dicts: {question: str, choices: [..], answer: index}"""
+def grade_submissions(assignment_id: int, grades) -> list:
+    """
+    Grade many submissions of one assignment in a single transaction.
+
+    grades is an iterable of (submission_id, grade, feedback). Ids that do
+    not belong to the assignment are ignored, and rows whose grade and
+    feedback are unchanged are not rewritten. Returns the changed rows as
+    dicts (id, student_id, grade, feedback).
+    """
+    grades = {sid: (grade, feedback) for sid, grade, feedback in grades}
+    if not grades:
+        return []
+    conn = _get_conn()
+    try:
+        # the comparison below must see what the UPDATE will overwrite
+        conn.begin_write()
+        current = {}
+        for chunk in _chunks(list(grades)):
+            for r in conn.execute(f"SELECT id, student_id, grade, feedback FROM submissions WHERE assignment_id = ? "
+                                  f"AND id IN ({', '.join('?' * len(chunk))})", (assignment_id, *chunk)):
+                current[r['id']] = r
+        changed = [(sid, r['student_id'], *grades[sid]) for sid, r in current.items()
+                   if (r['grade'], r['feedback']) != grades[sid]]
+        conn.executemany('UPDATE submissions SET grade = ?, feedback = ? WHERE id = ?',
+                         [(grade, feedback, sid) for sid, _, grade, feedback in changed])
+        if changed:
+            _notify_graded(conn, assignment_id, [(student, grade, feedback) for _, student, grade, feedback in changed])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return [{'id': sid, 'student_id': student, 'grade': grade, 'feedback': feedback}
+            for sid, student, grade, feedback in changed]
+
+
+def ungraded_submissions(assignment_id: int, after: int = None, limit: int = 10) -> list:
+    """The next ungraded submissions of an assignment in id order (the grading queue)."""
+    conn = _get_read_conn()
+    rows = conn.execute('''
+        SELECT s.id, s.student_id, u.name AS student_name, s.file_path, s.text, s.submitted_at, s.feedback
+        FROM submissions s JOIN users u ON u.id = s.student_id
+        WHERE s.assignment_id = ? AND s.grade IS NULL AND s.id > ?
+        ORDER BY s.id LIMIT ?''', (assignment_id, after or 0, limit)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def submission_files(assignment_id: int) -> list:
+    """Submissions of an assignment with their student, in the order download_all packs them."""
+    conn = _get_read_conn()
+    rows = conn.execute('''
+        SELECT s.id, s.student_id, u.name AS student_name, s.file_path, s.submitted_at, s.grade
+        FROM submissions s JOIN users u ON u.id = s.student_id
+        WHERE s.assignment_id = ? ORDER BY u.name, s.id''', (assignment_id,)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def _as_index(v):
+    try:
+        return int(v) if v is not None and not isinstance(v, bool) else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _write_quiz_items(conn, quiz_id: int, questions: list):
+    """Store a quiz's questions and choices in quiz_questions / quiz_choices."""
+    conn.execute('DELETE FROM quiz_choices WHERE question_id IN (SELECT id FROM quiz_questions WHERE quiz_id = ?)', (quiz_id,))
+    conn.execute('DELETE FROM quiz_questions WHERE quiz_id = ?', (quiz_id,))
+    for pos, q in enumerate(questions):
+        if not isinstance(q, dict):
+            q = {}
+        cur = conn.execute('INSERT INTO quiz_questions (quiz_id, position, question, answer) VALUES (?, ?, ?, ?)',
+                           (quiz_id, pos, q.get('question'), _as_index(q.get('answer'))))
+        conn.executemany('INSERT INTO quiz_choices (question_id, position, choice) VALUES (?, ?, ?)',
+                         [(cur.lastrowid, i, str(c)) for i, c in enumerate(q.get('choices') or [])])
+
+
+def _answer_rows(attempt_id: int, quiz_id: int, answers: list, key: list, drawn: list = None):
+    """
+    attempt_answers rows for one attempt; key is the list of correct indices.
+    drawn limits the rows to the bank positions the student was shown.
+    """
+    return [(attempt_id, quiz_id, pos, _as_index(answers[pos]) if pos < len(answers) else None,
+             int(pos < len(answers) and answers[pos] is not None and answers[pos] == key[pos]))
+            for pos in (range(len(key)) if drawn is None else drawn)]
+
+
+# Per-attempt answer vector: one byte per question holding the chosen index,
+# UNANSWERED for blanks/out-of-range values and NOT_DRAWN for bank questions
+# the student was not given. Lets re-grading read one small BLOB per attempt
+# instead of a row per answer.
+UNANSWERED = 255
+NOT_DRAWN = 254
+_NO_KEY = 253   # stands in for a missing answer key; never stored as a choice
+
+
+def _pack_answers(answers: list, n: int, drawn: list = None) -> bytes:
+    if drawn is None:
+        out = bytearray([UNANSWERED]) * n
+    else:
+        out = bytearray([NOT_DRAWN]) * n
+        for pos in drawn:
+            out[pos] = UNANSWERED
+    for pos, a in enumerate(answers[:n]):
+        a = _as_index(a)
+        if a is not None and 0 <= a < _NO_KEY and out[pos] != NOT_DRAWN:
+            out[pos] = a
+    return bytes(out)
+
+
+def _n_choices(q) -> int:
+    return len(q.get('choices') or []) if isinstance(q, dict) else 0
+
+
+# Every ordering of k choices, for the common small k, so shuffling a
+# question's choices is one random() call and a table lookup.
+_CHOICE_PERMS = {k: [list(p) for p in permutations(range(k))] for k in range(7)}
+
+# Recently used layouts, so grading reuses the one computed when the quiz was
+# shown. Purely a cache: any layout can be recomputed from its seed.
+_LAYOUT_CACHE_SIZE = 4096
+_layouts = OrderedDict()
+
+
+def quiz_layout(quiz_id: int, student_id: int, questions: list, draw_count: int = None, shuffle: bool = False):
+    """
+    The questions and choice order a student sees for a randomized quiz.
+
+    Returns None for a fixed-order quiz. Otherwise returns (order, choice_orders):
+    order[j] is the bank position shown in slot j and choice_orders[j][k] the
+    original index of the k-th choice shown there. Nothing is stored: the
+    layout is recomputed from a generator seeded with (quiz_id, student_id),
+    which gives the same result in every process and on every request.
+    """
+    n = len(questions)
+    k = min(draw_count or n, n)
+    if not shuffle and k == n:
+        return None
+    cache_key = (quiz_id, student_id, n, k, bool(shuffle))
+    hit = _layouts.get(cache_key)
+    # reuse only if the drawn questions still have the same number of choices
+    if hit is not None and all(len(perm) == _n_choices(questions[pos]) for pos, perm in zip(*hit)):
+        return hit
+    rng = random.Random(f'{quiz_id}:{student_id}')
+    rand = rng.random
+    keys = [rand() for _ in range(n)]
+    order = sorted(range(n), key=keys.__getitem__)[:k]
+    if not shuffle:
+        order.sort()
+    choice_orders = []
+    for pos in order:
+        size = _n_choices(questions[pos])
+        perms = _CHOICE_PERMS.get(size)
+        if perms is None:
+            perm = list(range(size))
+            if shuffle:
+                rng.shuffle(perm)
+        else:
+            # perms[0] is the identity
+            perm = perms[int(rand() * len(perms))] if shuffle else perms[0]
+        choice_orders.append(perm)
+    layout = (order, choice_orders)
+    _layouts[cache_key] = layout
+    if len(_layouts) > _LAYOUT_CACHE_SIZE:
+        _layouts.popitem(last=False)
+    return layout
+
+
+def present_quiz(questions: list, layout) -> list:
+    """Questions in the order (and with the choice order) given by a quiz_layout."""
+    if layout is None:
+        return questions
+    order, choice_orders = layout
+    out = []
+    for pos, perm in zip(order, choice_orders):
+        q = questions[pos]
+        choices = q.get('choices') or []
+        out.append({'question': q.get('question'), 'choices': list(map(choices.__getitem__, perm))})
+    return out
+
+
+def _grade_answers(questions: list, answers: list, layout=None):
+    """
+    Score answers for a quiz in O(n).
+
+    With a layout, answers are indexed by displayed slot and displayed choice
+    and are mapped back through the permutation to bank positions and
+    original choice indices. Returns (bank-ordered answers, key, drawn bank
+    positions or None, correct, total).
+    """
+    key = [q.get('answer') if isinstance(q, dict) else None for q in questions]
+    if layout is None:
+        correct = 0
+        for i, k in enumerate(key):
+            try:
+                if answers[i] == k:
+                    correct += 1
+            except Exception:
+                pass
+        return answers, key, None, correct, len(questions)
+    order, choice_orders = layout
+    canon = [None] * len(questions)
+    correct = 0
+    for pos, perm, a in zip(order, choice_orders, chain(answers, repeat(None, len(order)))):
+        if a.__class__ is not int:
+            a = _as_index(a)
+            if a is None:
+                continue
+        if 0 <= a < len(perm):
+            a = canon[pos] = perm[a]
+            if a == key[pos]:
+                correct += 1
+    return canon, key, order, correct, len(order)
+
+
+def create_quiz(lesson_id: int, questions: list, time_limit: int = None, draw_count: int = None, shuffle: bool = False) -> int:
+    """
+    Questions should be a list of dicts: {question: str, choices: [..], answer: index}.
+    time_limit (minutes) makes it a timed exam; None leaves it untimed.
+    draw_count gives each student that many questions from the list (the
+    question bank); shuffle randomizes question and choice order per student.
+    """
     qjson = json.dumps(questions)
     conn = _get_conn()
-    cur = conn.execute('INSERT INTO quizzes (lesson_id, questions) VALUES (?, ?)', (lesson_id, qjson))
-    conn.commit()
+    cur = conn.execute('INSERT INTO quizzes (lesson_id, questions, time_limit, draw_count, shuffle) VALUES (?, ?, ?, ?, ?)',
+                       (lesson_id, qjson, time_limit, draw_count, int(bool(shuffle))))
     qid = cur.lastrowid
+    _write_quiz_items(conn, qid, questions)
+    lesson = conn.execute('SELECT course_id, title FROM lessons WHERE id = ?', (lesson_id,)).fetchone()
+    if lesson:
+        _notify_course(conn, lesson['course_id'], 'quiz', f"New {'exam' if time_limit else 'quiz'}: {lesson['title']}", f'/quiz/{qid}')
+    conn.commit()
     conn.close()
     return qid
 
 
 def evaluate_quiz_attempt(quiz_id: int, student_id: int, answers: list) -> dict:
-    """Store attempt and return {'score':float,'correct':int,'total':int}. Answers is list of selected indices."""
+    """
+    Store attempt and return {'score':float,'correct':int,'total':int}. Answers is list of selected indices,
+    in the order the student saw them (see quiz_layout).
+    """
     conn = _get_conn()
+    try:
+        result = _record_attempt(conn, quiz_id, student_id, answers)
+        conn.commit()
+    finally:
+        conn.close()
+    return result
+
+
+def _record_attempt(conn, quiz_id: int, student_id: int, answers: list) -> dict:
+    """Score answers and insert the attempt rows on conn without committing."""
     quiz = conn.execute('SELECT * FROM quizzes WHERE id = ?', (quiz_id,)).fetchone()
     if not quiz:
-        conn.close()
         raise ValueError('Quiz not found')
     questions = json.loads(quiz['questions'])
-    correct = 0
-    for i, q in enumerate(questions):
-        try:
-            if answers[i] == q.get('answer'):
-                correct += 1
-        except Exception:
-            pass
-    total = len(questions)
+    layout = quiz_layout(quiz_id, student_id, questions, quiz['draw_count'], quiz['shuffle'])
+    answers, key, drawn, correct, total = _grade_answers(questions, answers, layout)
     score = round((correct / total) * 100, 2) if total else 0
-    conn.execute('INSERT INTO attempts (quiz_id, student_id, answers, score) VALUES (?, ?, ?, ?)',
-                 (quiz_id, student_id, json.dumps(answers), score))
+    cur = conn.execute('INSERT INTO attempts (quiz_id, student_id, answers, score, answer_vec) VALUES (?, ?, ?, ?, ?)',
+                       (quiz_id, student_id, json.dumps(answers), score, _pack_answers(answers, len(key), drawn)))
+    conn.executemany('INSERT INTO attempt_answers (attempt_id, quiz_id, position, choice, correct) VALUES (?, ?, ?, ?, ?)',
+                     _answer_rows(cur.lastrowid, quiz_id, answers, key, drawn))
+    return {'score': score, 'correct': correct, 'total': total, 'attempt_id': cur.lastrowid}
+
+
+def backfill_quiz_items(batch_size: int = 2000) -> dict:
+    """
+    Populate quiz_questions / quiz_choices / attempt_answers and
+    attempts.answer_vec from the JSON columns for quizzes and attempts that
+    predate them. Attempts are processed in batches, one transaction per batch.
+    """
+    conn = _get_conn()
+    try:
+        quizzes = conn.execute('SELECT id, questions FROM quizzes WHERE id NOT IN (SELECT DISTINCT quiz_id FROM quiz_questions)').fetchall()
+        keys = {}
+        with conn:
+            for q in quizzes:
+                try:
+                    questions = json.loads(q['questions'] or '[]')
+                except ValueError:
+                    questions = []
+                _write_quiz_items(conn, q['id'], questions)
+        for r in conn.execute('SELECT quiz_id, answer FROM quiz_questions ORDER BY quiz_id, position').fetchall():
+            keys.setdefault(r['quiz_id'], []).append(r['answer'])
+        done = 0
+        last_id = 0
+        while True:
+            rows = conn.execute('SELECT a.id, a.quiz_id, a.answers, a.answer_vec, '
+                                'EXISTS (SELECT 1 FROM attempt_answers x WHERE x.attempt_id = a.id) AS has_rows FROM attempts a '
+                                'WHERE a.id > ? AND (a.answer_vec IS NULL OR NOT EXISTS (SELECT 1 FROM attempt_answers x WHERE x.attempt_id = a.id)) '
+                                'ORDER BY a.id LIMIT ?', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            params, vecs = [], []
+            for r in rows:
+                try:
+                    answers = json.loads(r['answers'] or '[]')
+                except ValueError:
+                    answers = []
+                if not isinstance(answers, list):
+                    answers = []
+                key = keys.get(r['quiz_id'], [])
+                if not r['has_rows']:
+                    params.extend(_answer_rows(r['id'], r['quiz_id'], answers, key))
+                if r['answer_vec'] is None:
+                    vecs.append((_pack_answers(answers, len(key)), r['id']))
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO attempt_answers (attempt_id, quiz_id, position, choice, correct) VALUES (?, ?, ?, ?, ?)', params)
+                conn.executemany('UPDATE attempts SET answer_vec = ? WHERE id = ?', vecs)
+            done += len(rows)
+            last_id = rows[-1]['id']
+    finally:
+        conn.close()
+    return {'quizzes': len(quizzes), 'attempts': done}
+
+
+def update_quiz_answer_key(quiz_id: int, key: list) -> list:
+    """
+    Replace a quiz's answer key (one choice index per question) in both the
+    JSON column and quiz_questions, and re-flag attempt_answers.correct for
+    the changed questions. Returns the positions whose answer changed.
+    Raises ValueError if an answer is not one of its question's choices.
+    """
+    conn = _get_conn()
+    try:
+        with conn:
+            # read under the write lock, so concurrent key edits do not lose updates
+            conn.begin_write()
+            quiz = conn.execute('SELECT questions FROM quizzes WHERE id = ?', (quiz_id,)).fetchone()
+            if not quiz:
+                raise ValueError('Quiz not found')
+            questions = json.loads(quiz['questions'])
+            changed = []
+            for pos, q in enumerate(questions):
+                if pos >= len(key) or not isinstance(q, dict):
+                    continue
+                answer = _as_index(key[pos])
+                if answer == _as_index(q.get('answer')):
+                    continue
+                if answer is None or not 0 <= answer < len(q.get('choices') or []):
+                    raise ValueError(f'Question {pos + 1}: the answer must be one of its choices')
+                q['answer'] = answer
+                changed.append(pos)
+            conn.execute('UPDATE quizzes SET questions = ? WHERE id = ?', (json.dumps(questions), quiz_id))
+            for pos in changed:
+                conn.execute('UPDATE quiz_questions SET answer = ? WHERE quiz_id = ? AND position = ?',
+                             (questions[pos]['answer'], quiz_id, pos))
+                conn.execute('UPDATE attempt_answers SET correct = (choice IS ?) WHERE quiz_id = ? AND position = ?',
+                             (questions[pos]['answer'], quiz_id, pos))
+    finally:
+        conn.close()
+    return changed
+
+
+def _score_batch(vecs: list, key: list) -> list:
+    """
+    Score a batch of packed answer vectors against the key.
+
+    The batch is compared as one (attempts x questions) matrix with NumPy
+    when it is installed; otherwise each vector is compared with map(eq),
+    which keeps the per-answer loop in C. Scores are out of the questions the
+    student was actually given (NOT_DRAWN positions are excluded).
+    """
+    q = len(key)
+    # a question without a key scores nobody
+    kbytes = bytes(k if k is not None and 0 <= k < _NO_KEY else _NO_KEY for k in key)
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np is not None:
+        m = np.frombuffer(b''.join(vecs), dtype=np.uint8).reshape(len(vecs), q)
+        k = np.frombuffer(kbytes, dtype=np.uint8)
+        given = (m != NOT_DRAWN).sum(axis=1)
+        return np.round((m == k).sum(axis=1) * 100.0 / np.maximum(given, 1), 2).tolist()
+    from operator import eq
+    return [round(sum(map(eq, v, kbytes)) * 100.0 / max(q - v.count(NOT_DRAWN), 1), 2) for v in vecs]
+
+
+def regrade_quiz(quiz_id: int, batch_size: int = 20000) -> dict:
+    """
+    Recompute attempts.score for every attempt of a quiz from the packed
+    answer vectors and the current answer key.
+
+    Attempts are streamed in id order in batches; each batch is scored as an
+    answer matrix against the key and the changed scores are written back
+    with executemany in one transaction per batch. Attempts folded away by
+    compact_attempts are rescored from the answer counts in their summary
+    (see _regrade_summaries).
+    Returns {'attempts': n, 'changed': m, 'summaries': s, 'stale': t}.
+    """
+    conn = _get_conn()
+    try:
+        key = [r['answer'] for r in conn.execute('SELECT answer FROM quiz_questions WHERE quiz_id = ? ORDER BY position',
+                                                 (quiz_id,)).fetchall()]
+        q = len(key)
+        pad = bytes([UNANSWERED]) * q
+        seen = changed = 0
+        last_id = 0
+        cur = conn.cursor()
+        cur.row_factory = None
+        while q:
+            batch = cur.execute('SELECT id, score, answer_vec FROM attempts WHERE quiz_id = ? AND id > ? ORDER BY id LIMIT ?',
+                                (quiz_id, last_id, batch_size)).fetchall()
+            if not batch:
+                break
+            vecs = [(v or b'')[:q] + pad[len(v or b''):] for _, _, v in batch]
+            scores = _score_batch(vecs, key)
+            updates = [(s, aid) for s, (aid, old, _) in zip(scores, batch) if old != s]
+            if updates:
+                with conn:
+                    conn.executemany('UPDATE attempts SET score = ? WHERE id = ?', updates)
+            seen += len(batch)
+            changed += len(updates)
+            last_id = batch[-1][0]
+        summaries, stale = _regrade_summaries(conn, quiz_id, key) if q else (0, 0)
+    finally:
+        conn.close()
+    return {'attempts': seen, 'changed': changed, 'summaries': summaries, 'stale': stale}
+
+
+def _regrade_summaries(conn, quiz_id: int, key: list) -> tuple:
+    """
+    Rescore a quiz's compacted attempts after its live attempts were
+    regraded: compacted_score from the answer counts, best_score and
+    latest_score from those and the live rows. Summaries compacted before
+    answer counts were kept cannot be rescored; they are left as they are
+    and counted. Returns (rescored, stale).
+    """
+    q = len(key)
+    pad = bytes([UNANSWERED]) * q
+    with conn:
+        conn.begin_write()
+        live = {r[0]: (r[1], r[2]) for r in conn.execute('''
+            SELECT student_id, MAX(score),
+                   (SELECT score FROM attempts l WHERE l.quiz_id = a.quiz_id AND l.student_id = a.student_id
+                    ORDER BY l.id DESC LIMIT 1)
+            FROM attempts a WHERE quiz_id = ? GROUP BY student_id''', (quiz_id,))}
+        updates, stale = [], 0
+        for sid, compacted, counts in conn.execute(
+                'SELECT student_id, compacted, answer_counts FROM attempt_summaries WHERE quiz_id = ?', (quiz_id,)).fetchall():
+            counts = _decode_snapshot(counts)
+            if sum(counts.values()) != compacted:
+                stale += 1
+                continue
+            vecs = [bytes.fromhex(v) for v in counts]
+            scores = _score_batch([v[:q] + pad[len(v):] for v in vecs], key) if vecs else []
+            best, latest = live.get(sid, (None, None))
+            if scores:
+                best = max(scores) if best is None else max(best, max(scores))
+            total = sum(s * n for s, n in zip(scores, counts.values()))
+            updates.append((total, best, latest, quiz_id, sid))
+        conn.executemany('UPDATE attempt_summaries SET compacted_score = ?, best_score = ?, latest_score = ? '
+                         'WHERE quiz_id = ? AND student_id = ?', updates)
+    return len(updates), stale
+
+
+def quiz_item_analysis(quiz_id: int) -> list:
+    """
+    Classical item analysis for a quiz, computed in SQL over attempt_answers.
+
+    For each question returns its text, the answer key, the p-value
+    (proportion correct), the discrimination index (p of the top 27% of
+    attempts by score minus p of the bottom 27%), and the count of attempts
+    choosing each option (None key = unanswered).
+    """
+    conn = _get_read_conn()
+    questions = conn.execute('SELECT position, question, answer FROM quiz_questions WHERE quiz_id = ? ORDER BY position',
+                             (quiz_id,)).fetchall()
+    # score cutoffs for the upper and lower 27% groups (ties at a cutoff are included)
+    n = conn.execute('SELECT COUNT(*) FROM attempts WHERE quiz_id = ?', (quiz_id,)).fetchone()[0]
+    k = max(1, int(n * 0.27))
+    hi = conn.execute('SELECT score FROM attempts WHERE quiz_id = ? ORDER BY score DESC LIMIT 1 OFFSET ?', (quiz_id, k - 1)).fetchone()
+    lo = conn.execute('SELECT score FROM attempts WHERE quiz_id = ? ORDER BY score ASC LIMIT 1 OFFSET ?', (quiz_id, k - 1)).fetchone()
+    stats = {}
+    if hi and lo:
+        stats = {r['position']: r for r in conn.execute('''
+            SELECT aa.position,
+                   COUNT(*) AS responses,
+                   AVG(aa.correct) AS p_value,
+                   AVG(CASE WHEN a.score >= ? THEN aa.correct END) - AVG(CASE WHEN a.score <= ? THEN aa.correct END) AS discrimination
+            FROM attempts a JOIN attempt_answers aa ON aa.attempt_id = a.id
+            WHERE a.quiz_id = ?
+            GROUP BY aa.position
+        ''', (hi[0], lo[0], quiz_id)).fetchall()}
+    choices = {}
+    for r in conn.execute('''SELECT qq.position, qc.position AS choice, qc.choice AS label
+                             FROM quiz_questions qq JOIN quiz_choices qc ON qc.question_id = qq.id
+                             WHERE qq.quiz_id = ? ORDER BY qq.position, qc.position''', (quiz_id,)).fetchall():
+        choices.setdefault(r['position'], []).append({'index': r['choice'], 'label': r['label'], 'count': 0})
+    unanswered = {}
+    for r in conn.execute('SELECT position, choice, COUNT(*) AS n FROM attempt_answers WHERE quiz_id = ? GROUP BY position, choice',
+                          (quiz_id,)).fetchall():
+        opts = choices.setdefault(r['position'], [])
+        match = next((o for o in opts if o['index'] == r['choice']), None)
+        if match:
+            match['count'] = r['n']
+        else:
+            unanswered[r['position']] = unanswered.get(r['position'], 0) + r['n']
+    conn.close()
+    out = []
+    for q in questions:
+        st = stats.get(q['position'])
+        p_value = st['p_value'] if st else None
+        disc = st['discrimination'] if st else None
+        out.append({
+            'position': q['position'],
+            'question': q['question'],
+            'answer': q['answer'],
+            'responses': st['responses'] if st else 0,
+            'p_value': round(p_value, 3) if p_value is not None else None,
+            'discrimination': round(disc, 3) if disc is not None else None,
+            'choices': choices.get(q['position'], []),
+            'unanswered': unanswered.get(q['position'], 0),
+        })
+    return out
+
+
+# ============================================================================
+# TIMED EXAMS
+# ============================================================================
+
+# Slack on the deadline for clock skew and the final request in flight
+EXAM_GRACE_SECONDS = 30
+
+
+def start_quiz_session(quiz_id: int, student_id: int, time_limit: int) -> dict:
+    """
+    Open a timed attempt session for a student, or return the one already open.
+
+    The deadline (unix seconds) is fixed when the session is created; reopening
+    the quiz does not restart the clock.
+    """
+    import time
+    now = time.time()
+    conn = _get_conn()
+    # the partial unique index allows one open session per (quiz, student)
+    conn.execute('INSERT OR IGNORE INTO quiz_sessions (quiz_id, student_id, started_at, deadline) VALUES (?, ?, ?, ?)',
+                 (quiz_id, student_id, now, now + time_limit * 60))
     conn.commit()
+    row = conn.execute('SELECT * FROM quiz_sessions WHERE quiz_id = ? AND student_id = ? AND submitted_at IS NULL',
+                       (quiz_id, student_id)).fetchone()
     conn.close()
-    return {'score': score, 'correct': correct, 'total': total}
+    return dict(row) if row else None
 
 
-def export_submissions_csv(assignment_id: int) -> str:
+def get_open_quiz_session(quiz_id: int, student_id: int):
+    conn = _get_read_conn()
+    row = conn.execute('SELECT * FROM quiz_sessions WHERE quiz_id = ? AND student_id = ? AND submitted_at IS NULL',
+                       (quiz_id, student_id)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def save_session_answers(items: list) -> int:
+    """
+    Persist buffered autosaves: items are (session_id, answers, saved_at).
+
+    One transaction for the whole batch. A save never overwrites a newer one,
+    lands after the deadline, or touches a submitted session.
+    """
+    conn = _get_conn()
+    try:
+        with conn:
+            before = conn.total_changes
+            conn.executemany('''
+                UPDATE quiz_sessions SET answers = ?, saved_at = ?
+                WHERE id = ? AND submitted_at IS NULL
+                  AND (saved_at IS NULL OR saved_at < ?)
+                  AND ? <= deadline + ?''',
+                [(json.dumps(answers), ts, sid, ts, ts, EXAM_GRACE_SECONDS) for sid, answers, ts in items])
+            return conn.total_changes - before
+    finally:
+        conn.close()
+
+
+def finish_quiz_session(session_id: int, answers: list = None, pending: tuple = None):
+    """
+    Submit a timed session and record its attempt.
+
+    answers are the ones posted with the submission; they are only accepted
+    before deadline + EXAM_GRACE_SECONDS. Otherwise (or when answers is None,
+    e.g. an abandoned session) the last autosave is graded: the newer of the
+    stored answers and `pending`, this worker's unflushed (answers, saved_at).
+    Returns the evaluate_quiz_attempt result plus 'late', or None if the
+    session was already submitted.
+    """
+    import time
+    now = time.time()
     conn = _get_conn()
+    try:
+        row = conn.execute('SELECT * FROM quiz_sessions WHERE id = ?', (session_id,)).fetchone()
+        if not row or row['submitted_at'] is not None:
+            return None
+        cutoff = row['deadline'] + EXAM_GRACE_SECONDS
+        late = now > cutoff
+        if late or answers is None:
+            answers = json.loads(row['answers'] or '[]')
+            if pending and pending[1] <= cutoff and (row['saved_at'] is None or pending[1] > row['saved_at']):
+                answers = pending[0]
+        with conn:
+            # claim the session first so concurrent submits grade it once
+            cur = conn.execute('UPDATE quiz_sessions SET submitted_at = ?, answers = ? WHERE id = ? AND submitted_at IS NULL',
+                               (now, json.dumps(answers), session_id))
+            if cur.rowcount == 0:
+                return None
+            result = _record_attempt(conn, row['quiz_id'], row['student_id'], answers)
+            conn.execute('UPDATE quiz_sessions SET attempt_id = ? WHERE id = ?', (result['attempt_id'], session_id))
+        result['late'] = late
+        return result
+    finally:
+        conn.close()
+
+
+def finalize_expired_sessions(limit: int = 500) -> int:
+    """Grade sessions whose deadline passed without a submission, using their last autosave."""
+    import time
+    conn = _get_read_conn()
+    ids = [r['id'] for r in conn.execute(
+        'SELECT id FROM quiz_sessions WHERE submitted_at IS NULL AND deadline < ? ORDER BY deadline LIMIT ?',
+        (time.time() - EXAM_GRACE_SECONDS, limit)).fetchall()]
+    conn.close()
+    return sum(1 for sid in ids if finish_quiz_session(sid) is not None)
+
+
+# ============================================================================
+# CLASS ANALYTICS
+# ============================================================================
+
+import threading
+import time
+from bisect import bisect_left
+
+# A student is flagged at risk when any of these is crossed
+AT_RISK_MISSING_RATE = 0.3   # share of past-due assignments never submitted
+AT_RISK_LATE_RATE = 0.5      # share of their submissions that came in late
+AT_RISK_SCORE = 60.0         # average assignment grade or best quiz score
+HIST_BINS = 10               # 0-10, 10-20, ..., 90-100
+
+_ANALYTICS_RECHECK = 10      # seconds before a course's fingerprints are re-read
+_ANALYTICS_MAX_COURSES = 64
+
+# A bare 'YYYY-MM-DD' due date means the end of that day.
+_DUE_JD = "CASE WHEN length(a.due_date) <= 10 THEN julianday(a.due_date, '+1 day') ELSE julianday(a.due_date) END"
+
+
+def _percentile(vals: list, p: float):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not vals:
+        return None
+    k = (len(vals) - 1) * p
+    f = int(k)
+    c = min(f + 1, len(vals) - 1)
+    return round(vals[f] + (vals[c] - vals[f]) * (k - f), 2)
+
+
+def _distribution(vals: list) -> dict:
+    """Summary statistics and a 0-100 histogram for a sorted list of scores."""
+    width = 100.0 / HIST_BINS
+    edges = [bisect_left(vals, i * width) for i in range(1, HIST_BINS)]
+    hist = [hi - lo for lo, hi in zip([0] + edges, edges + [len(vals)])]
+    return {
+        'n': len(vals),
+        'mean': round(sum(vals) / len(vals), 2) if vals else None,
+        'p10': _percentile(vals, 0.10),
+        'p25': _percentile(vals, 0.25),
+        'median': _percentile(vals, 0.50),
+        'p75': _percentile(vals, 0.75),
+        'p90': _percentile(vals, 0.90),
+        'histogram': hist,
+    }
+
+
+class _CourseAnalytics:
+    """
+    Cached analytics state for one course.
+
+    Every assignment and quiz keeps a fingerprint (row count, max id and score
+    sums from one aggregate query), its computed stats and its per-student
+    contribution. On refresh only assessments whose fingerprint moved are
+    re-read, and their old contribution to the per-student totals is swapped
+    for the new one, so a single new grade costs one small query rather than
+    a rescan of the course.
+    """
+
+    def __init__(self, course_id):
+        self.course_id = course_id
+        self.lock = threading.Lock()
+        self.checked = 0.0
+        self.members_fp = None
+        self.members = frozenset()
+        self.assignments = {}   # id -> (fingerprint, stats, {student_id: (late, grade)}, sorted grades)
+        self.quizzes = {}       # id -> (fingerprint, stats, {student_id: best score})
+        # student_id -> [submitted, submitted past due, late, grade sum, graded, quiz sum, quizzes taken]
+        self.totals = {}
+        self.result = None
+
+    def _reset(self, conn, members_fp):
+        self.members_fp = members_fp
+        self.members = frozenset(r[0] for r in conn.execute(
+            'SELECT student_id FROM class_members WHERE course_id = ?', (self.course_id,)))
+        self.assignments, self.quizzes, self.totals = {}, {}, {}
+
+    def _apply_assignment(self, per_student, past_due, sign):
+        totals, due = self.totals, (sign if past_due else 0)
+        for sid, (late, grade) in per_student.items():
+            t = totals.get(sid)
+            if t is None:
+                t = totals[sid] = [0, 0, 0, 0.0, 0, 0.0, 0]
+            t[0] += sign
+            t[1] += due
+            t[2] += sign * late
+            if grade is not None:
+                t[3] += sign * grade
+                t[4] += sign
+
+    def _apply_quiz(self, best, sign):
+        totals = self.totals
+        for sid, score in best.items():
+            t = totals.get(sid)
+            if t is None:
+                t = totals[sid] = [0, 0, 0, 0.0, 0, 0.0, 0]
+            t[5] += sign * score
+            t[6] += sign
+
+    def refresh(self, conn):
+        cid = self.course_id
+        conn = conn.cursor()
+        conn.row_factory = None  # plain tuples: much cheaper to unpack in bulk
+        members_fp = tuple(conn.execute(
+            'SELECT COUNT(*), MAX(id), TOTAL(student_id) FROM class_members WHERE course_id = ?', (cid,)).fetchone())
+        if members_fp != self.members_fp:
+            self._reset(conn, members_fp)
+        a_fps = {r[0]: tuple(r) for r in conn.execute(f'''
+            SELECT a.id, a.title, a.due_date,
+                   julianday('now') >= {_DUE_JD} AS past_due,
+                   COUNT(s.id), MAX(s.id), TOTAL(s.grade), TOTAL(s.grade * s.id)
+            FROM lessons l JOIN assignments a ON a.lesson_id = l.id
+            LEFT JOIN submissions s ON s.assignment_id = a.id
+            WHERE l.course_id = ? GROUP BY a.id''', (cid,))}
+        q_fps = {r[0]: tuple(r) for r in conn.execute('''
+            SELECT q.id, l.title,
+                   COUNT(t.id) + (SELECT IFNULL(SUM(r.compacted), 0) FROM attempt_summaries r WHERE r.quiz_id = q.id),
+                   MAX(t.id), TOTAL(t.score), TOTAL(t.score * t.id),
+                   (SELECT TOTAL(r.best_score) FROM attempt_summaries r WHERE r.quiz_id = q.id)
+            FROM lessons l JOIN quizzes q ON q.lesson_id = l.id
+            LEFT JOIN attempts t ON t.quiz_id = q.id
+            WHERE l.course_id = ? GROUP BY q.id''', (cid,))}
+
+        dirty_a = [i for i, fp in a_fps.items() if i not in self.assignments or self.assignments[i][0] != fp]
+        gone_a = [i for i in self.assignments if i not in a_fps]
+        dirty_q = [i for i, fp in q_fps.items() if i not in self.quizzes or self.quizzes[i][0] != fp]
+        gone_q = [i for i in self.quizzes if i not in q_fps]
+        if self.result is not None and not (dirty_a or gone_a or dirty_q or gone_q):
+            return False
+
+        for i in dirty_a + gone_a:
+            old = self.assignments.pop(i, None)
+            if old:
+                self._apply_assignment(old[2], old[0][3], -1)
+        for i in dirty_q + gone_q:
+            old = self.quizzes.pop(i, None)
+            if old:
+                self._apply_quiz(old[2], -1)
+
+        n_members = len(self.members)
+        for chunk in _chunks(dirty_a):
+            rows = {}
+            for aid, sid, late, grade in conn.execute(f'''
+                    SELECT s.assignment_id, s.student_id,
+                           IFNULL(MIN(julianday(s.submitted_at)) > {_DUE_JD}, 0), MAX(s.grade)
+                    FROM submissions s JOIN assignments a ON a.id = s.assignment_id
+                    JOIN class_members cm ON cm.course_id = ? AND cm.student_id = s.student_id
+                    WHERE s.assignment_id IN ({','.join('?' * len(chunk))})
+                    GROUP BY s.assignment_id, s.student_id''', [cid, *chunk]):
+                rows.setdefault(aid, {})[sid] = (late, grade)
+            for aid in chunk:
+                fp = a_fps[aid]
+                past_due = bool(fp[3])
+                per_student = rows.get(aid, {})
+                grades = sorted(g for _, g in per_student.values() if g is not None)
+                submitted = len(per_student)
+                late = sum(l for l, _ in per_student.values())
+                stats = {
+                    'id': aid, 'title': fp[1], 'due_date': fp[2], 'past_due': past_due,
+                    'submitted': submitted,
+                    'submission_rate': round(submitted / n_members, 3) if n_members else None,
+                    'missing': n_members - submitted if past_due else 0,
+                    'late': late,
+                    'late_rate': round(late / submitted, 3) if submitted else None,
+                    'grades': _distribution(grades),
+                }
+                self.assignments[aid] = (fp, stats, per_student, grades)
+                self._apply_assignment(per_student, past_due, 1)
+
+        for chunk in _chunks(dirty_q):
+            rows = {}
+            marks = ','.join('?' * len(chunk))
+            # a compacted attempt can be the best one again after a regrade
+            for qid, sid, best in conn.execute(f'''
+                    SELECT t.quiz_id, t.student_id, MAX(t.score)
+                    FROM (SELECT quiz_id, student_id, score FROM attempts WHERE quiz_id IN ({marks})
+                          UNION ALL
+                          SELECT quiz_id, student_id, best_score FROM attempt_summaries WHERE quiz_id IN ({marks})) t
+                    JOIN class_members cm ON cm.course_id = ? AND cm.student_id = t.student_id
+                    GROUP BY t.quiz_id, t.student_id''', [*chunk, *chunk, cid]):
+                rows.setdefault(qid, {})[sid] = best or 0.0
+            for qid in chunk:
+                fp = q_fps[qid]
+                best = rows.get(qid, {})
+                stats = {
+                    'id': qid, 'lesson_title': fp[1], 'attempts': fp[2],
+                    'participants': len(best),
+                    'participation_rate': round(len(best) / n_members, 3) if n_members else None,
+                    'scores': _distribution(sorted(best.values())),
+                }
+                self.quizzes[qid] = (fp, stats, best)
+                self._apply_quiz(best, 1)
+
+        self.result = self._summarize(conn)
+        return True
+
+    def _summarize(self, conn):
+        past_due_total = sum(1 for a in self.assignments.values() if a[1]['past_due'])
+        flagged = []
+        for sid in self.members:
+            submitted, submitted_due, late, gsum, graded, qsum, quizzes = self.totals.get(sid, (0, 0, 0, 0.0, 0, 0.0, 0))
+            missing = past_due_total - submitted_due
+            avg_grade = gsum / graded if graded else None
+            avg_quiz = qsum / quizzes if quizzes else None
+            reasons = []
+            if past_due_total and missing / past_due_total >= AT_RISK_MISSING_RATE:
+                reasons.append(f'{missing} of {past_due_total} past-due assignments missing')
+            if submitted and late / submitted >= AT_RISK_LATE_RATE:
+                reasons.append(f'{late} of {submitted} submissions late')
+            if avg_grade is not None and avg_grade < AT_RISK_SCORE:
+                reasons.append(f'average grade {avg_grade:.1f}')
+            if avg_quiz is not None and avg_quiz < AT_RISK_SCORE:
+                reasons.append(f'average quiz score {avg_quiz:.1f}')
+            if reasons:
+                flagged.append({'student_id': sid, 'missing': missing, 'late': late, 'submitted': submitted,
+                                'avg_grade': round(avg_grade, 2) if avg_grade is not None else None,
+                                'avg_quiz': round(avg_quiz, 2) if avg_quiz is not None else None,
+                                'reasons': reasons})
+        names = {}
+        for chunk in _chunks([f['student_id'] for f in flagged]):
+            for r in conn.execute(f'SELECT id, name, email FROM users WHERE id IN ({",".join("?" * len(chunk))})', chunk):
+                names[r[0]] = (r[1], r[2])
+        for f in flagged:
+            f['name'], f['email'] = names.get(f['student_id'], (None, None))
+        flagged.sort(key=lambda f: (-len(f['reasons']), -f['missing'], f['avg_grade'] if f['avg_grade'] is not None else 101))
+
+        assignments = sorted((a[1] for a in self.assignments.values()), key=lambda s: (s['due_date'] is None, s['due_date'] or '', s['id']))
+        quizzes = sorted((q[1] for q in self.quizzes.values()), key=lambda s: s['id'])
+        return {
+            'course_id': self.course_id,
+            'students': len(self.members),
+            'generated_at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+            'grades': _distribution(sorted(chain.from_iterable(a[3] for a in self.assignments.values()))),
+            'quiz_scores': _distribution(sorted(chain.from_iterable(q[2].values() for q in self.quizzes.values()))),
+            'assignments': assignments,
+            'quizzes': quizzes,
+            'at_risk': flagged,
+            'thresholds': {'missing_rate': AT_RISK_MISSING_RATE, 'late_rate': AT_RISK_LATE_RATE, 'score': AT_RISK_SCORE},
+        }
+
+
+_analytics = OrderedDict()
+_analytics_lock = threading.Lock()
+
+
+def course_analytics(course_id: int, max_age: float = _ANALYTICS_RECHECK) -> dict:
+    """
+    Class-level analytics for a course: grade and quiz score distributions
+    (histogram, mean, percentiles), per-assignment submission and late rates,
+    per-quiz participation and a list of at-risk students with reasons.
+
+    Results are cached per process. After max_age seconds the next call
+    re-reads cheap per-assessment fingerprints and recomputes only what
+    changed; pass max_age=0 to force that check.
+    """
+    with _analytics_lock:
+        key = (tenants.current(), course_id)
+        state = _analytics.pop(key, None) or _CourseAnalytics(course_id)
+        _analytics[key] = state
+        while len(_analytics) > _ANALYTICS_MAX_COURSES:
+            _analytics.popitem(last=False)
+    with state.lock:
+        if state.result is None or time.monotonic() - state.checked >= max_age:
+            conn = _get_read_conn()
+            try:
+                state.refresh(conn)
+            finally:
+                conn.close()
+            state.checked = time.monotonic()
+        return state.result
+
+
+def invalidate_course_analytics(course_id: int = None):
+    """Drop cached analytics so the next request rebuilds from scratch."""
+    with _analytics_lock:
+        if course_id is None:
+            _analytics.clear()
+        else:
+            _analytics.pop((tenants.current(), course_id), None)
+
+
+def export_submissions_csv(assignment_id: int) -> str:
+    conn = _get_read_conn()
     rows = conn.execute('SELECT s.id, u.name as student_name, s.file_path, s.text, s.submitted_at, s.grade, s.feedback FROM submissions s JOIN users u ON s.student_id = u.id WHERE s.assignment_id = ?', (assignment_id,)).fetchall()
     conn.close()
     out = ['id,student_name,file_path,text,submitted_at,grade,feedback']
@@ -393,26 +1544,135 @@ def export_submissions_csv(assignment_id: int) -> str:
     return '\n'.join(out)
 
 
-def list_deleted_users():
-    import json
-    conn = _get_conn()
-    rows = conn.execute('SELECT id, user_id, snapshot, deleted_at FROM deleted_users ORDER BY deleted_at DESC').fetchall()
-    out = []
-    for r in rows:
-        try:
-            snap = json.loads(r['snapshot']) if r['snapshot'] else {}
-        except Exception:
-            snap = {}
-        out.append({'id': r['id'], 'user_id': r['user_id'], 'deleted_at': r['deleted_at'], 'snapshot': snap, 'name': snap.get('name'), 'email': snap.get('email')})
-    conn.close()
+# Audit snapshots (deleted_users / deleted_courses.snapshot) are stored as
+# zlib-compressed JSON; rows from before that hold JSON text, which still
+# decodes. What the admin pages list and search on is copied into indexed
+# columns (name, email, role, deleted_by), so listing never decodes a snapshot.
+
+# A purged user's own rows, kept in the snapshot for restore_user:
+# (table, parent table, parent column). On restore, rows whose parent no
+# longer exists are skipped.
+_USER_DATA = (
+    ('class_members', 'courses', 'course_id'),
+    ('submissions', 'assignments', 'assignment_id'),
+    ('attempts', 'quizzes', 'quiz_id'),
+    ('attempt_answers', 'attempts', 'attempt_id'),
+    ('attempt_summaries', 'quizzes', 'quiz_id'),
+)
+# BLOB columns in those rows, stored in the snapshot as hex
+_SNAPSHOT_BLOBS = ('answer_vec', 'answer_counts')
+
+
+def _encode_snapshot(obj) -> bytes:
+    return zlib.compress(json.dumps(obj, separators=(',', ':')).encode(), 6)
+
+
+def _decode_snapshot(value) -> dict:
+    try:
+        if isinstance(value, bytes):
+            value = zlib.decompress(value)
+        return json.loads(value) if value else {}
+    except (TypeError, ValueError, zlib.error):
+        return {}
+
+
+def _user_data(conn, user_id: int) -> dict:
+    out = {}
+    for table, _, _ in _USER_DATA:
+        if not _table_exists(conn, table):
+            continue
+        where = ('attempt_id IN (SELECT id FROM attempts WHERE student_id = ?)' if table == 'attempt_answers'
+                 else 'student_id = ?')
+        out[table] = [{k: r[k].hex() if isinstance(r[k], bytes) else r[k] for k in r.keys()}
+                      for r in conn.execute(f'SELECT * FROM {table} WHERE {where}', (user_id,))]
     return out
 
 
-def list_deleted_courses():
+def _record_deleted_user(conn, user, data: dict, deleted_by: int = None):
+    """Write the deleted_users row for user (a users row) and its data (see _user_data) on conn."""
+    conn.execute('INSERT INTO deleted_users (user_id, name, email, role, deleted_by, snapshot) VALUES (?, ?, ?, ?, ?, ?)',
+                 (user['id'], user['name'], user['email'], user['role'], deleted_by,
+                  _encode_snapshot(dict(data, user=dict(user)))))
+
+
+def backfill_audit_snapshots(batch_size: int = 500) -> int:
+    """
+    Compress the JSON-text snapshots written before compression and fill
+    deleted_users.name/email/role from them; one transaction per batch.
+    """
     conn = _get_conn()
-    rows = conn.execute('SELECT d.*, u.name as teacher_name FROM deleted_courses d LEFT JOIN users u ON d.teacher_id = u.id ORDER BY deleted_at DESC').fetchall()
+    done = 0
+    try:
+        for table in ('deleted_users', 'deleted_courses'):
+            while True:
+                with conn:
+                    conn.begin_write()
+                    rows = conn.execute(f"SELECT id, snapshot FROM {table} WHERE typeof(snapshot) = 'text' LIMIT ?",
+                                        (batch_size,)).fetchall()
+                    if not rows:
+                        break
+                    if table == 'deleted_users':
+                        params = []
+                        for r in rows:
+                            user = _decode_snapshot(r['snapshot'])
+                            params.append((user.get('name'), user.get('email'), user.get('role'),
+                                           _encode_snapshot(user), r['id']))
+                        conn.executemany('UPDATE deleted_users SET name = ?, email = ?, role = ?, snapshot = ? WHERE id = ?',
+                                         params)
+                    else:
+                        conn.executemany(f'UPDATE {table} SET snapshot = ? WHERE id = ?',
+                                         [(_encode_snapshot(_decode_snapshot(r['snapshot'])), r['id']) for r in rows])
+                done += len(rows)
+    finally:
+        conn.close()
+    return done
+
+
+def _like_prefix(q: str) -> str:
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def list_deleted_users(before: int = None, limit: int = 50, q: str = None, role: str = None,
+                       deleted_by: int = None) -> list:
+    """
+    Deleted-user records, newest first; pass the last id seen as before for
+    the next page. q matches the start of the name or e-mail (any case);
+    role and deleted_by filter exactly. Snapshots are not read.
+    """
+    where, params = ['id < ?'], [before or 2 ** 63 - 1]
+    if q:
+        where.append("(name LIKE ? ESCAPE '\\' OR email LIKE ? ESCAPE '\\')")
+        params += [_like_prefix(q)] * 2
+    if role:
+        where.append('role = ?')
+        params.append(role)
+    if deleted_by is not None:
+        where.append('deleted_by = ?')
+        params.append(deleted_by)
+    conn = _get_read_conn()
+    rows = conn.execute(f'''
+        SELECT d.id, d.user_id, d.name, d.email, d.role, d.deleted_by, d.deleted_at, u.name AS deleted_by_name
+        FROM (SELECT * FROM deleted_users WHERE {' AND '.join(where)} ORDER BY id DESC LIMIT ?) d
+        LEFT JOIN users u ON u.id = d.deleted_by ORDER BY d.id DESC''', params + [limit]).fetchall()
     conn.close()
-    return rows
+    return [dict(r) for r in rows]
+
+
+def list_deleted_courses(before: int = None, limit: int = 50, q: str = None, teacher_id: int = None) -> list:
+    """Deleted-course records, newest first, paged like list_deleted_users; q matches the start of the title."""
+    where, params = ['d.id < ?'], [before or 2 ** 63 - 1]
+    if q:
+        where.append("d.title LIKE ? ESCAPE '\\'")
+        params.append(_like_prefix(q))
+    if teacher_id is not None:
+        where.append('d.teacher_id = ?')
+        params.append(teacher_id)
+    conn = _get_read_conn()
+    rows = conn.execute('SELECT d.id, d.course_id, d.title, d.teacher_id, d.deleted_by, d.deleted_at, u.name as teacher_name '
+                        'FROM deleted_courses d LEFT JOIN users u ON d.teacher_id = u.id '
+                        f"WHERE {' AND '.join(where)} ORDER BY d.id DESC LIMIT ?", params + [limit]).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
 
 
 def delete_deleted_course_record(record_id: int):
@@ -423,10 +1683,11 @@ def delete_deleted_course_record(record_id: int):
 
 
 def get_deleted_snapshot(deleted_id: int):
-    conn = _get_conn()
+    """A deleted_users record with its snapshot decoded, or None."""
+    conn = _get_read_conn()
     r = conn.execute('SELECT * FROM deleted_users WHERE id = ?', (deleted_id,)).fetchone()
     conn.close()
-    return r
+    return dict(r, snapshot=_decode_snapshot(r['snapshot'])) if r else None
 
 
 def delete_deleted_record(deleted_id: int) -> bool:
@@ -443,59 +1704,55 @@ def delete_deleted_record(deleted_id: int) -> bool:
         raise
 
 
+# Restoring over a still-existing (soft-deleted) user updates only these
+_RESTORE_UPDATES = ('name', 'email', 'role', 'school_id', 'bio')
+
+
+def _restore_rows(conn, table: str, parent: str, column: str, rows: list) -> int:
+    """Insert snapshot rows back with one statement, skipping those whose parent row is gone."""
+    if not rows or not _table_exists(conn, table):
+        return 0
+    cols = [r['name'] for r in conn.execute(f'PRAGMA table_info({table})') if r['name'] in rows[0]]
+    params = [[bytes.fromhex(r[c]) if c in _SNAPSHOT_BLOBS and r[c] is not None else r[c] for c in cols] + [r[column]]
+              for r in rows]
+    cur = conn.executemany(f"INSERT OR IGNORE INTO {table} ({', '.join(cols)}) SELECT {', '.join('?' * len(cols))} "
+                           f'WHERE EXISTS (SELECT 1 FROM {parent} WHERE id = ?)', params)
+    return cur.rowcount
+
+
 def restore_user(deleted_id: int) -> bool:
-    import json
+    """
+    Bring back a deleted user, with the enrollments, submissions and quiz
+    attempts saved when they were purged, in one transaction: the user row
+    is upserted, then each table is written with a single statement.
+    """
     conn = _get_conn()
     try:
-        rec = conn.execute('SELECT * FROM deleted_users WHERE id = ?', (deleted_id,)).fetchone()
-        if not rec:
-            conn.close()
-            return False
-        snap = json.loads(rec['snapshot'])
-        user_id = rec['user_id']
-        # If the user row exists, update fields and reactivate
-        existing = conn.execute('SELECT id FROM users WHERE id = ?', (user_id,)).fetchone()
-        cols = [r['name'] for r in conn.execute("PRAGMA table_info(users)").fetchall()]
-        if existing:
-            if 'is_active' in cols:
-                conn.execute('UPDATE users SET is_active = 1 WHERE id = ?', (user_id,))
-            # update name/email/role/school_id/bio if present
-            update_parts = []
-            params = []
-            for key in ('name','email','role','school_id','bio'):
-                if key in cols and snap.get(key) is not None:
-                    update_parts.append(f"{key} = ?")
-                    params.append(snap.get(key))
-            if update_parts:
-                params.append(user_id)
-                conn.execute('UPDATE users SET ' + ', '.join(update_parts) + ' WHERE id = ?', tuple(params))
-        else:
-            # recreate user row with snapshot values; include id explicitly
-            insert_cols = []
-            insert_vals = []
-            for key in ('id','name','email','password_hash','role','school_id','bio'):
-                if key == 'id':
-                    insert_cols.append('id')
-                    insert_vals.append(user_id)
-                else:
-                    if key in cols:
-                        insert_cols.append(key)
-                        insert_vals.append(snap.get(key))
-            # set is_active if available
+        with conn:
+            # a second restore of the same record waits, then finds it gone
+            conn.begin_write()
+            rec = conn.execute('SELECT user_id, snapshot FROM deleted_users WHERE id = ?', (deleted_id,)).fetchone()
+            if not rec:
+                return False
+            snap = _decode_snapshot(rec['snapshot'])
+            # records from before purges saved related rows are the bare users row
+            user = snap.get('user') if isinstance(snap.get('user'), dict) else snap
+            user = dict(user, id=rec['user_id'])
+            cols = [r['name'] for r in conn.execute('PRAGMA table_info(users)')]
             if 'is_active' in cols:
-                insert_cols.append('is_active')
-                insert_vals.append(1)
-            if insert_cols:
-                placeholders = ','.join(['?'] * len(insert_cols))
-                conn.execute(f"INSERT INTO users ({', '.join(insert_cols)}) VALUES ({placeholders})", tuple(insert_vals))
-        conn.execute('DELETE FROM deleted_users WHERE id = ?', (deleted_id,))
-        conn.commit()
-        conn.close()
+                user['is_active'] = 1
+            insert = [c for c in cols if c in user]
+            update = [c for c in insert if c in _RESTORE_UPDATES or c == 'is_active']
+            conn.execute(f"INSERT INTO users ({', '.join(insert)}) VALUES ({', '.join('?' * len(insert))}) "
+                         f'ON CONFLICT (id) DO ' + ('UPDATE SET ' + ', '.join(f'{c} = excluded.{c}' for c in update)
+                                                    if update else 'NOTHING'),
+                         [user[c] for c in insert])
+            for table, parent, column in _USER_DATA:
+                _restore_rows(conn, table, parent, column, snap.get(table) or [])
+            conn.execute('DELETE FROM deleted_users WHERE id = ?', (deleted_id,))
         return True
-    except Exception:
-        conn.rollback()
+    finally:
         conn.close()
-        raise
 
 
 def _table_exists(conn, name: str) -> bool:
@@ -503,28 +1760,38 @@ def _table_exists(conn, name: str) -> bool:
     return bool(r)
 
 
-def purge_user(user_id: int) -> bool:
-    """Hard-delete a user and related records immediately. Records a snapshot in deleted_users before deletion."""
-    import json
+def purge_user(user_id: int, deleted_by: int = None) -> bool:
+    """
+    Hard-delete a user and related records immediately. Records a snapshot
+    in deleted_users before deletion, including the user's enrollments,
+    submissions and quiz attempts so restore_user can bring them back.
+    """
     conn = _get_conn()
     try:
+        # the snapshot must match what is deleted
+        conn.begin_write()
         u = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
         if not u:
+            conn.rollback()
             conn.close()
             return False
 
         # record snapshot
-        snapshot = dict(u)
-        conn.execute('INSERT INTO deleted_users (user_id, snapshot, deleted_by) VALUES (?, ?, ?)',
-                     (user_id, json.dumps(snapshot), None))
+        _record_deleted_user(conn, u, _user_data(conn, user_id), deleted_by)
 
         # check tables and delete related records safely
         if _table_exists(conn, 'class_members'):
             conn.execute('DELETE FROM class_members WHERE student_id = ?', (user_id,))
         if _table_exists(conn, 'submissions'):
             conn.execute('DELETE FROM submissions WHERE student_id = ?', (user_id,))
+        if _table_exists(conn, 'attempt_answers'):
+            conn.execute('DELETE FROM attempt_answers WHERE attempt_id IN (SELECT id FROM attempts WHERE student_id = ?)', (user_id,))
         if _table_exists(conn, 'attempts'):
             conn.execute('DELETE FROM attempts WHERE student_id = ?', (user_id,))
+        if _table_exists(conn, 'attempt_summaries'):
+            conn.execute('DELETE FROM attempt_summaries WHERE student_id = ?', (user_id,))
+        if _table_exists(conn, 'quiz_sessions'):
+            conn.execute('DELETE FROM quiz_sessions WHERE student_id = ?', (user_id,))
 
         # if teacher, delete their courses and related data
         if _table_exists(conn, 'courses'):
@@ -543,6 +1810,9 @@ def purge_user(user_id: int) -> bool:
         conn.commit()
         affected = cur.rowcount
         conn.close()
+        invalidate_owned_courses(user_id)
+        # hand the freed pages back in the background
+        maintenance.request_vacuum()
         return affected > 0
     except Exception:
         conn.rollback()
@@ -576,7 +1846,7 @@ def create_resource(resource_type: str, title: str, content: str, teacher_id: in
 
 
 def get_teacher_resources(teacher_id: int, resource_type: str = None):
-    conn = _get_conn()
+    conn = _get_read_conn()
     if resource_type:
         rows = conn.execute('SELECT * FROM resources WHERE teacher_id = ? AND type = ? ORDER BY created_at DESC', (teacher_id, resource_type)).fetchall()
     else:
@@ -605,7 +1875,7 @@ def delete_resource(resource_id: int) -> bool:
         conn.commit()
 
         if cur.rowcount > 0 and resource['attachment']:
-            filepath = os.path.join(BASE_DIR, 'uploads', resource['attachment'])
+            filepath = os.path.join(tenants.upload_dir(), resource['attachment'])
             if os.path.exists(filepath):
                 os.remove(filepath)
         return cur.rowcount > 0
@@ -614,3 +1884,782 @@ def delete_resource(resource_id: int) -> bool:
         raise
     finally:
         conn.close()
+
+
+# ============================================================================
+# TENANT REPORTS
+# ============================================================================
+
+_USAGE_TABLES = ('courses', 'class_members', 'assignments', 'submissions', 'quizzes', 'attempts')
+
+
+def usage_report() -> dict:
+    """
+    Size and activity of the current tenant's shard. Run it across every
+    shard with tenants.each(usage_report).
+    """
+    conn = _get_read_conn()
+    try:
+        out = {role: 0 for role in ('student', 'teacher', 'admin')}
+        for r in conn.execute('SELECT role, COUNT(*) AS n FROM users GROUP BY role'):
+            out[r['role']] = r['n']
+        for t in _USAGE_TABLES:
+            out[t] = conn.execute(f'SELECT COUNT(*) FROM {t}').fetchone()[0] if _table_exists(conn, t) else 0
+        out['submissions_7d'] = conn.execute(
+            "SELECT COUNT(*) FROM submissions WHERE submitted_at >= datetime('now', '-7 days')").fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        out['db_bytes'] = page_size * conn.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        conn.close()
+    return out
+
+
+# ============================================================================
+# RETENTION
+# ============================================================================
+
+import gzip
+
+# Applied by the maintenance thread (maintenance.py); 0 keeps everything.
+# Attempts older than ATTEMPT_KEEP_DAYS are folded into attempt_summaries,
+# except each student's best and latest attempt at every quiz, which stay.
+ATTEMPT_KEEP_DAYS = float(os.environ.get('ATTEMPT_KEEP_DAYS', 0))
+# deleted_users / deleted_courses records older than AUDIT_KEEP_DAYS are
+# removed, after being appended to gzipped JSONL files under
+# AUDIT_ARCHIVE_DIR/<tenant>/ when that is set
+AUDIT_KEEP_DAYS = float(os.environ.get('AUDIT_KEEP_DAYS', 0))
+AUDIT_ARCHIVE_DIR = os.environ.get('AUDIT_ARCHIVE_DIR', '')
+_RETENTION_BATCH = 1000
+
+
+def compact_attempts(keep_days: float = None, now: float = None) -> dict:
+    """
+    Fold attempts older than keep_days into attempt_summaries, one
+    transaction per quiz. Per (quiz, student) the best-scoring and the
+    latest attempt are never removed, so best-score analytics and result
+    pages are unaffected. A summary row holds the count, best and latest
+    score and first/last attempt time as of its last compaction; compacted
+    is how many of those attempts no longer exist and compacted_score their
+    score total, so attempt counts and average scores add them to the live
+    rows. answer_counts maps each packed answer vector of the removed
+    attempts to how many gave it, so regrade_quiz can rescore them after an
+    answer key correction.
+    """
+    keep_days = ATTEMPT_KEEP_DAYS if keep_days is None else keep_days
+    out = {'quizzes': 0, 'students': 0, 'removed': 0}
+    if not keep_days:
+        return out
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime((now or time.time()) - keep_days * 86400))
+    conn = _get_conn()
+    try:
+        quizzes = [r[0] for r in conn.execute('SELECT DISTINCT quiz_id FROM attempts WHERE attempted_at < ?', (cutoff,))]
+        for quiz_id in quizzes:
+            with conn:
+                conn.begin_write()
+                victims = conn.execute('''
+                    SELECT id, student_id, score, answer_vec FROM (
+                        SELECT id, student_id, score, answer_vec, attempted_at,
+                               ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY score DESC, id DESC) AS by_score,
+                               ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY id DESC) AS by_time
+                        FROM attempts WHERE quiz_id = ?)
+                    WHERE attempted_at < ? AND by_score > 1 AND by_time > 1''', (quiz_id, cutoff)).fetchall()
+                if not victims:
+                    continue
+                removed = {}
+                for r in victims:
+                    n, total, counts = removed.get(r['student_id'], (0, 0.0, {}))
+                    vec = (r['answer_vec'] or b'').hex()
+                    counts[vec] = counts.get(vec, 0) + 1
+                    removed[r['student_id']] = (n + 1, total + (r['score'] or 0), counts)
+                students = list(removed)
+                for chunk in _chunks(students):
+                    # summarize before deleting, while every attempt is still there
+                    conn.execute(f'''
+                        INSERT INTO attempt_summaries (quiz_id, student_id, attempts, compacted, best_score,
+                                                       latest_score, first_at, last_at)
+                        SELECT quiz_id, student_id, COUNT(*), 0, MAX(score),
+                               (SELECT score FROM attempts l WHERE l.quiz_id = a.quiz_id AND l.student_id = a.student_id
+                                ORDER BY l.id DESC LIMIT 1),
+                               MIN(attempted_at), MAX(attempted_at)
+                        FROM attempts a WHERE quiz_id = ? AND student_id IN ({','.join('?' * len(chunk))})
+                        GROUP BY student_id
+                        ON CONFLICT (quiz_id, student_id) DO UPDATE SET
+                            attempts = excluded.attempts + attempt_summaries.compacted,
+                            best_score = MAX(excluded.best_score, attempt_summaries.best_score),
+                            latest_score = excluded.latest_score,
+                            first_at = MIN(excluded.first_at, attempt_summaries.first_at),
+                            last_at = excluded.last_at''', [quiz_id, *chunk])
+                for chunk in _chunks(students):
+                    for sid, counts in conn.execute(f'''
+                            SELECT student_id, answer_counts FROM attempt_summaries
+                            WHERE quiz_id = ? AND student_id IN ({','.join('?' * len(chunk))})''', [quiz_id, *chunk]):
+                        for vec, n in _decode_snapshot(counts).items():
+                            removed[sid][2][vec] = removed[sid][2].get(vec, 0) + n
+                conn.executemany('UPDATE attempt_summaries SET compacted = compacted + ?, compacted_score = compacted_score + ?, '
+                                 'answer_counts = ? WHERE quiz_id = ? AND student_id = ?',
+                                 [(n, total, _encode_snapshot(counts), quiz_id, sid)
+                                  for sid, (n, total, counts) in removed.items()])
+                ids = [r['id'] for r in victims]
+                for chunk in _chunks(ids):
+                    marks = ','.join('?' * len(chunk))
+                    conn.execute(f'DELETE FROM attempt_answers WHERE attempt_id IN ({marks})', chunk)
+                    conn.execute(f'DELETE FROM attempts WHERE id IN ({marks})', chunk)
+            out['quizzes'] += 1
+            out['students'] += len(students)
+            out['removed'] += len(ids)
+    finally:
+        conn.close()
+    if out['removed']:
+        maintenance.request_vacuum()
+    return out
+
+
+def _archive_path(archive_dir: str, table: str, now: float) -> str:
+    root = os.path.join(archive_dir, tenants.current())
+    os.makedirs(root, exist_ok=True)
+    return os.path.join(root, f"{table}-{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now))}.jsonl.gz")
+
+
+def expire_deleted_records(keep_days: float = None, archive_dir: str = None, now: float = None) -> dict:
+    """
+    Remove deleted_users and deleted_courses records older than keep_days,
+    in batches. With an archive directory each batch is appended to a
+    gzipped JSONL file (one object per record, snapshot decoded) and synced
+    to disk before the batch is deleted, so a failure leaves the records in
+    place.
+    """
+    keep_days = AUDIT_KEEP_DAYS if keep_days is None else keep_days
+    archive_dir = AUDIT_ARCHIVE_DIR if archive_dir is None else archive_dir
+    out = {'deleted_users': 0, 'deleted_courses': 0, 'archives': []}
+    if not keep_days:
+        return out
+    now = now or time.time()
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - keep_days * 86400))
+    conn = _get_conn()
+    try:
+        for table in ('deleted_users', 'deleted_courses'):
+            path = None
+            while True:
+                with conn:
+                    conn.begin_write()
+                    rows = conn.execute(f'SELECT * FROM {table} WHERE deleted_at < ? ORDER BY id LIMIT ?',
+                                        (cutoff, _RETENTION_BATCH)).fetchall()
+                    if not rows:
+                        break
+                    if archive_dir:
+                        path = path or _archive_path(archive_dir, table, now)
+                        with open(path, 'ab') as raw:
+                            with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+                                for r in rows:
+                                    record = dict(r, snapshot=_decode_snapshot(r['snapshot']))
+                                    f.write(json.dumps(record, default=str).encode() + b'\n')
+                            raw.flush()
+                            os.fsync(raw.fileno())
+                    ids = [r['id'] for r in rows]
+                    for chunk in _chunks(ids):
+                        conn.execute(f"DELETE FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+                out[table] += len(rows)
+            if path:
+                out['archives'].append(path)
+    finally:
+        conn.close()
+    return out
+
+
+# ============================================================================
+# ACTIVITY LOG
+# ============================================================================
+
+import calendar
+
+# Page views (activity.py) are appended to one table per UTC day,
+# activity_YYYYMMDD, listed in activity_days. rollup_activity() condenses
+# them into activity_hourly and activity_daily and drops partitions older
+# than ACTIVITY_KEEP_DAYS; the rollups are kept.
+ACTIVITY_KEEP_DAYS = int(os.environ.get('ACTIVITY_KEEP_DAYS', 90))
+# Time on a page is the gap until the same user's next view, if that comes
+# within ACTIVITY_IDLE seconds; a last view, or one followed by a longer
+# pause, counts as no time
+ACTIVITY_IDLE = 30 * 60
+
+
+def _activity_day(ts: float) -> str:
+    return time.strftime('%Y%m%d', time.gmtime(ts))
+
+
+def _activity_partition(day: str) -> str:
+    return f'activity_{day}'
+
+
+def append_activity(events) -> int:
+    """
+    Append (ts, user_id, kind, object_id) events to their day partitions in
+    one transaction, creating partitions as needed.
+    """
+    by_day = {}
+    for e in events:
+        by_day.setdefault(_activity_day(e[0]), []).append(tuple(e))
+    conn = _get_conn()
+    try:
+        with conn:
+            for day, rows in sorted(by_day.items()):
+                # the registry write comes first and takes the write lock, so the
+                # partition is created inside this transaction
+                conn.execute('INSERT INTO activity_days (day, events) VALUES (?, ?) '
+                             'ON CONFLICT(day) DO UPDATE SET events = events + excluded.events', (day, len(rows)))
+                table = _activity_partition(day)
+                conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (ts REAL NOT NULL, user_id INTEGER NOT NULL, '
+                             'kind TEXT NOT NULL, object_id INTEGER NOT NULL)')
+                conn.executemany(f'INSERT INTO {table} (ts, user_id, kind, object_id) VALUES (?, ?, ?, ?)', rows)
+    finally:
+        conn.close()
+    return len(events)
+
+
+def rollup_activity(keep_days: int = None, now: float = None) -> dict:
+    """
+    Recompute the hourly and daily rollups of every day that received
+    events since its last rollup (one transaction per day), then drop the
+    partitions of rolled-up days older than keep_days.
+
+    activity_hourly: views and distinct users per hour and page.
+    activity_daily:  views and seconds on page per day, user and page.
+    """
+    now = now or time.time()
+    keep_days = ACTIVITY_KEEP_DAYS if keep_days is None else keep_days
+    out = {'days': 0, 'dropped': 0}
+    conn = _get_conn()
+    try:
+        days = [r['day'] for r in conn.execute('SELECT day FROM activity_days WHERE rolled_events != events ORDER BY day')]
+        for day in days:
+            table = _activity_partition(day)
+            start = calendar.timegm(time.strptime(day, '%Y%m%d'))
+            with conn:
+                # first: takes the write lock, so no flush lands between the
+                # count recorded here and the rows read below
+                conn.execute('UPDATE activity_days SET rolled_events = events, rolled_up_at = ? WHERE day = ?', (now, day))
+                conn.execute('DELETE FROM activity_hourly WHERE hour >= ? AND hour < ?', (start, start + 86400))
+                conn.execute(f'''
+                    INSERT INTO activity_hourly (hour, kind, object_id, views, users)
+                    SELECT CAST(ts / 3600 AS INTEGER) * 3600, kind, object_id, COUNT(*), COUNT(DISTINCT user_id)
+                    FROM {table} GROUP BY 1, 2, 3''')
+                conn.execute('DELETE FROM activity_daily WHERE day = ?', (day,))
+                conn.execute(f'''
+                    INSERT INTO activity_daily (day, user_id, kind, object_id, views, seconds)
+                    SELECT ?, user_id, kind, object_id, COUNT(*), SUM(CASE WHEN gap <= ? THEN gap ELSE 0 END)
+                    FROM (SELECT user_id, kind, object_id, LEAD(ts) OVER (PARTITION BY user_id ORDER BY ts) - ts AS gap
+                          FROM {table})
+                    GROUP BY user_id, kind, object_id''', (day, ACTIVITY_IDLE))
+            out['days'] += 1
+        cutoff = _activity_day(now - keep_days * 86400)
+        old = [r['day'] for r in conn.execute('SELECT day FROM activity_days WHERE day < ? AND rolled_events = events',
+                                              (cutoff,))]
+        for day in old:
+            with conn:
+                cur = conn.execute('DELETE FROM activity_days WHERE day = ? AND rolled_events = events', (day,))
+                if cur.rowcount:
+                    conn.execute(f'DROP TABLE IF EXISTS {_activity_partition(day)}')
+            out['dropped'] += cur.rowcount
+    finally:
+        conn.close()
+    return out
+
+
+def lesson_engagement(course_id: int, days: int = 30) -> list:
+    """
+    Per lesson of a course over the last days (from activity_daily): views
+    by enrolled students, how many of them opened it, and their average
+    minutes on the lesson page.
+    """
+    since = _activity_day(time.time() - days * 86400)
+    conn = _get_read_conn()
+    rows = conn.execute('''
+        SELECT l.id, l.title, COALESCE(SUM(d.views), 0) AS views, COUNT(DISTINCT d.user_id) AS viewers,
+               COALESCE(SUM(d.seconds), 0) AS seconds
+        FROM lessons l
+        LEFT JOIN activity_daily d ON d.kind = 'lesson' AND d.object_id = l.id AND d.day >= ?
+             AND d.user_id IN (SELECT student_id FROM class_members WHERE course_id = ?)
+        WHERE l.course_id = ?
+        GROUP BY l.id ORDER BY l.id''', (since, course_id, course_id)).fetchall()
+    conn.close()
+    return [dict(r, avg_minutes=round(r['seconds'] / r['viewers'] / 60, 1) if r['viewers'] else None) for r in rows]
+
+
+# ============================================================================
+# NOTIFICATIONS
+# ============================================================================
+
+# The maintenance thread (maintenance.py) prunes read notifications after
+# NOTIFY_KEEP_READ_DAYS and unread ones after NOTIFY_KEEP_UNREAD_DAYS
+NOTIFY_KEEP_READ_DAYS = float(os.environ.get('NOTIFY_KEEP_READ_DAYS', 30))
+NOTIFY_KEEP_UNREAD_DAYS = float(os.environ.get('NOTIFY_KEEP_UNREAD_DAYS', 180))
+_PRUNE_BATCH = 5000
+_PRUNABLE = 'created_at < ? AND (read_at IS NOT NULL OR created_at < ?)'
+
+
+def _insert_notifications(conn, rows, now=None):
+    """
+    rows: (user_id, kind, title, body, link). Written in the caller's
+    transaction, together with the recipients' unread counters.
+    """
+    now = now or time.time()
+    rows = [tuple(r) + (now,) for r in rows]
+    conn.executemany('INSERT INTO notifications (user_id, kind, title, body, link, created_at) VALUES (?, ?, ?, ?, ?, ?)', rows)
+    counts = {}
+    for r in rows:
+        counts[r[0]] = counts.get(r[0], 0) + 1
+    conn.executemany('UPDATE users SET unread_notifications = unread_notifications + ? WHERE id = ?',
+                     [(n, uid) for uid, n in counts.items()])
+
+
+def _notify_course(conn, course_id: int, kind: str, title: str, link: str, now=None) -> int:
+    """
+    Fan one notification out to every student enrolled in a course, in the
+    caller's transaction: one INSERT ... SELECT over class_members and one
+    counter UPDATE however large the class is. The body names the course.
+    """
+    now = now or time.time()
+    cur = conn.execute('''
+        INSERT INTO notifications (user_id, kind, title, body, link, created_at)
+        SELECT m.student_id, ?, ?, c.title, ?, ? FROM class_members m JOIN courses c ON c.id = m.course_id
+        WHERE m.course_id = ?''', (kind, title, link, now, course_id))
+    if cur.rowcount:
+        conn.execute('UPDATE users SET unread_notifications = unread_notifications + 1 '
+                     'WHERE id IN (SELECT student_id FROM class_members WHERE course_id = ?)', (course_id,))
+    return cur.rowcount
+
+
+def _notify_graded(conn, assignment_id: int, graded):
+    """Tell students their submission was graded; graded is (student_id, grade, feedback) rows."""
+    a = conn.execute('SELECT title, lesson_id FROM assignments WHERE id = ?', (assignment_id,)).fetchone()
+    if a is None:
+        return
+    rows = []
+    for student_id, grade, feedback in graded:
+        if grade is None and not feedback:
+            continue
+        body = f'Grade: {grade:g}' if grade is not None else 'Not graded yet'
+        if feedback:
+            body += f'. Feedback: {feedback}'
+        rows.append((student_id, 'graded', f"{a['title']} was graded", body, f"/lesson/{a['lesson_id']}"))
+    _insert_notifications(conn, rows)
+
+
+def notifications(user_id: int, before: int = None, limit: int = 50) -> list:
+    """A user's notifications, newest first; pass the last id seen as before for the next page."""
+    conn = _get_read_conn()
+    rows = conn.execute('SELECT id, kind, title, body, link, created_at, read_at FROM notifications '
+                        'WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                        (user_id, before or 2 ** 63 - 1, limit)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def unread_count(user_id: int) -> int:
+    conn = _get_read_conn()
+    r = conn.execute('SELECT unread_notifications FROM users WHERE id = ?', (user_id,)).fetchone()
+    conn.close()
+    return r[0] if r else 0
+
+
+def mark_notification_read(user_id: int, notification_id: int):
+    """Mark one of the user's notifications read; returns its link ('' if none), or None if it is not theirs."""
+    conn = _get_conn()
+    try:
+        with conn:
+            cur = conn.execute('UPDATE notifications SET read_at = ? WHERE id = ? AND user_id = ? AND read_at IS NULL',
+                               (time.time(), notification_id, user_id))
+            if cur.rowcount:
+                conn.execute('UPDATE users SET unread_notifications = MAX(unread_notifications - 1, 0) WHERE id = ?', (user_id,))
+            r = conn.execute('SELECT link FROM notifications WHERE id = ? AND user_id = ?', (notification_id, user_id)).fetchone()
+    finally:
+        conn.close()
+    return (r['link'] or '') if r else None
+
+
+def mark_all_notifications_read(user_id: int) -> int:
+    conn = _get_conn()
+    try:
+        with conn:
+            cur = conn.execute('UPDATE notifications SET read_at = ? WHERE user_id = ? AND read_at IS NULL', (time.time(), user_id))
+            conn.execute('UPDATE users SET unread_notifications = 0 WHERE id = ?', (user_id,))
+    finally:
+        conn.close()
+    return cur.rowcount
+
+
+def prune_notifications(keep_read_days: float = None, keep_unread_days: float = None, now: float = None) -> dict:
+    """
+    Delete read notifications older than keep_read_days and unread ones
+    older than keep_unread_days, _PRUNE_BATCH rows per transaction so
+    writers are never held up for long. The unread counters of the owners
+    of deleted unread rows are decremented in the same transaction. Sent
+    outbox e-mail goes after keep_read_days too.
+    """
+    now = now or time.time()
+    read_cutoff = now - 86400 * (NOTIFY_KEEP_READ_DAYS if keep_read_days is None else keep_read_days)
+    unread_cutoff = now - 86400 * (NOTIFY_KEEP_UNREAD_DAYS if keep_unread_days is None else keep_unread_days)
+    out = {'read': 0, 'unread': 0}
+    conn = _get_conn()
+    try:
+        while True:
+            with conn:
+                # the rows counted are the rows deleted
+                conn.begin_write()
+                rows = conn.execute(f'SELECT id, user_id, read_at FROM notifications WHERE {_PRUNABLE} ORDER BY id LIMIT ?',
+                                    (read_cutoff, unread_cutoff, _PRUNE_BATCH)).fetchall()
+                if not rows:
+                    break
+                conn.execute(f'DELETE FROM notifications WHERE id <= ? AND {_PRUNABLE}', (rows[-1]['id'], read_cutoff, unread_cutoff))
+                unread = {}
+                for r in rows:
+                    if r['read_at'] is None:
+                        unread[r['user_id']] = unread.get(r['user_id'], 0) + 1
+                conn.executemany('UPDATE users SET unread_notifications = MAX(unread_notifications - ?, 0) WHERE id = ?',
+                                 [(n, uid) for uid, n in unread.items()])
+            n_unread = sum(unread.values())
+            out['unread'] += n_unread
+            out['read'] += len(rows) - n_unread
+        # delivered e-mail (outbox.py) is kept as long as read notifications
+        out['outbox'] = 0
+        while True:
+            with conn:
+                cur = conn.execute('DELETE FROM outbox WHERE id IN (SELECT id FROM outbox WHERE sent_at < ? ORDER BY id LIMIT ?)',
+                                   (read_cutoff, _PRUNE_BATCH))
+            out['outbox'] += cur.rowcount
+            if cur.rowcount < _PRUNE_BATCH:
+                break
+    finally:
+        conn.close()
+    return out
+
+
+# ============================================================================
+# DUE DATES AND REMINDERS
+# ============================================================================
+
+from datetime import datetime, timedelta, timezone
+
+# Due dates typed by hand, accepted besides ISO 8601 ('2026-03-15', '2026-03-15 17:00')
+_DUE_FORMATS = ('%m/%d/%Y', '%m/%d/%Y %H:%M', '%m/%d/%Y %I:%M %p',
+                '%B %d, %Y', '%b %d, %Y', '%d %B %Y', '%d %b %Y')
+
+# Reminder windows sent before a deadline: (name, seconds before), largest first
+REMINDER_WINDOWS = (('24h', 24 * 3600), ('1h', 3600))
+_WINDOW_TEXT = {'24h': '24 hours', '1h': '1 hour'}
+
+OUTBOX_MAX_ATTEMPTS = 5
+_OUTBOX_RETRY = 60           # seconds before a failed message is tried again, doubling
+
+
+def parse_due_date(text):
+    """
+    Normalize an assignments.due_date string to unix seconds, or None when
+    it is empty or unreadable. Times without a zone are UTC and a bare date
+    means the end of that day, as in the class analytics (_DUE_JD).
+    """
+    text = (text or '').strip()
+    if not text:
+        return None
+    try:
+        dt = datetime.fromisoformat(text)
+        date_only = len(text) <= 10
+    except ValueError:
+        for fmt in _DUE_FORMATS:
+            try:
+                dt = datetime.strptime(text, fmt)
+            except ValueError:
+                continue
+            date_only = '%H' not in fmt and '%I' not in fmt
+            break
+        else:
+            return None
+    if date_only:
+        dt += timedelta(days=1)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def backfill_due_at(batch_size: int = 2000) -> int:
+    """Fill assignments.due_at for rows written before it existed; one transaction per batch."""
+    conn = _get_conn()
+    done = last_id = 0
+    try:
+        while True:
+            rows = conn.execute("SELECT id, due_date FROM assignments WHERE id > ? AND due_at IS NULL "
+                                "AND due_date IS NOT NULL AND due_date != '' ORDER BY id LIMIT ?",
+                                (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            updates = [(due_at, r['id']) for r in rows if (due_at := parse_due_date(r['due_date'])) is not None]
+            if updates:
+                with conn:
+                    conn.executemany('UPDATE assignments SET due_at = ? WHERE id = ?', updates)
+                done += len(updates)
+    finally:
+        conn.close()
+    return done
+
+
+def upcoming_deadlines(start: float, end: float) -> list:
+    """(assignment id, due_at) for deadlines in (start, end], soonest first."""
+    conn = _get_read_conn()
+    rows = conn.execute('SELECT id, due_at FROM assignments WHERE due_at > ? AND due_at <= ? ORDER BY due_at',
+                        (start, end)).fetchall()
+    conn.close()
+    return [(r['id'], r['due_at']) for r in rows]
+
+
+def _enqueue_outbox(conn, rows, now=None):
+    """rows: (recipient, subject, body). Written in the caller's transaction; see outbox.py."""
+    now = now or time.time()
+    conn.executemany('INSERT INTO outbox (recipient, subject, body, created_at) VALUES (?, ?, ?, ?)',
+                     [tuple(r) + (now,) for r in rows])
+
+
+def send_due_reminders(assignment_id: int, window: str, due_at: float, now: float = None):
+    """
+    Remind the students enrolled in the assignment's course who have not
+    submitted it: an in-app notification and an outbox e-mail each, written
+    in one transaction.
+
+    Each (assignment, window, deadline) is claimed in due_reminders first, so
+    a second scheduler or a restarted one does nothing. Returns the number of
+    students reminded, or None when the window was already claimed or the due
+    date has changed since it was scheduled.
+    """
+    now = now or time.time()
+    conn = _get_conn()
+    try:
+        with conn:
+            # the claim takes the write lock, so the anti-join below sees every
+            # submission committed before it
+            cur = conn.execute('INSERT OR IGNORE INTO due_reminders (assignment_id, kind, due_at, sent_at) '
+                               'SELECT id, ?, due_at, ? FROM assignments WHERE id = ? AND due_at = ?',
+                               (window, now, assignment_id, due_at))
+            if cur.rowcount != 1:
+                return None
+            a = conn.execute('''
+                SELECT a.title, a.due_date, l.course_id, c.title AS course
+                FROM assignments a JOIN lessons l ON l.id = a.lesson_id JOIN courses c ON c.id = l.course_id
+                WHERE a.id = ?''', (assignment_id,)).fetchone()
+            if a is None:
+                return 0
+            students = conn.execute('''
+                SELECT u.id, u.email FROM class_members m JOIN users u ON u.id = m.student_id
+                WHERE m.course_id = ? AND NOT EXISTS (
+                    SELECT 1 FROM submissions s WHERE s.assignment_id = ? AND s.student_id = m.student_id)''',
+                (a['course_id'], assignment_id)).fetchall()
+            title = f"{a['title']} is due in {_WINDOW_TEXT.get(window, window)}"
+            body = f"{a['title']} ({a['course']}) is due {a['due_date']} and you have not submitted it yet."
+            link = f'/assignment/submit/{assignment_id}'
+            _insert_notifications(conn, [(u['id'], 'due_reminder', title, body, link) for u in students], now)
+            _enqueue_outbox(conn, [(u['email'], f'Reminder: {title}', body) for u in students if u['email']], now)
+            conn.execute('UPDATE due_reminders SET recipients = ? WHERE assignment_id = ? AND kind = ? AND due_at = ?',
+                         (len(students), assignment_id, window, due_at))
+        return len(students)
+    finally:
+        conn.close()
+
+
+def claim_outbox(limit: int = 100, lease: float = 300) -> list:
+    """
+    Take up to limit unsent messages for delivery. They are leased for
+    lease seconds, so concurrent drainers never send one twice and a
+    drainer that dies mid-batch only delays its messages.
+    """
+    now = time.time()
+    conn = _get_conn()
+    try:
+        with conn:
+            conn.begin_write()
+            rows = conn.execute('''
+                SELECT id, recipient, subject, body, attempts FROM outbox
+                WHERE sent_at IS NULL AND attempts < ? AND (claimed_until IS NULL OR claimed_until < ?)
+                ORDER BY id LIMIT ?''', (OUTBOX_MAX_ATTEMPTS, now, limit)).fetchall()
+            conn.executemany('UPDATE outbox SET claimed_until = ? WHERE id = ?', [(now + lease, r['id']) for r in rows])
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
+
+
+def finish_outbox(sent: list, failed: dict):
+    """Record a delivery round: sent is a list of ids, failed maps id -> (attempts so far, error)."""
+    now = time.time()
+    conn = _get_conn()
+    try:
+        with conn:
+            conn.executemany('UPDATE outbox SET sent_at = ?, claimed_until = NULL WHERE id = ?', [(now, i) for i in sent])
+            conn.executemany('UPDATE outbox SET attempts = ?, last_error = ?, claimed_until = ? WHERE id = ?',
+                             [(n + 1, error[:500], now + _OUTBOX_RETRY * 2 ** n, i) for i, (n, error) in failed.items()])
+    finally:
+        conn.close()
+
+
+# ============================================================================
+# WORKER WARM-UP
+# ============================================================================
+
+def warm_caches(max_teachers: int = 500, max_sessions: int = 2000) -> dict:
+    """
+    Fill this process's caches for the current tenant before its first request:
+    owned course ids of the teachers with the newest courses, and the layouts
+    of timed exam sessions still in progress (the next autosave or submit of
+    each needs one).
+    """
+    conn = _get_read_conn()
+    owned = {}
+    for r in conn.execute('''
+            SELECT teacher_id, id FROM courses WHERE teacher_id IN (
+                SELECT teacher_id FROM courses GROUP BY teacher_id ORDER BY MAX(id) DESC LIMIT ?)''',
+            (max_teachers,)):
+        owned.setdefault(r['teacher_id'], set()).add(r['id'])
+    sessions = conn.execute('''
+        SELECT qs.quiz_id, qs.student_id, q.questions, q.draw_count, q.shuffle
+        FROM quiz_sessions qs JOIN quizzes q ON q.id = qs.quiz_id
+        WHERE qs.submitted_at IS NULL ORDER BY qs.deadline DESC LIMIT ?''', (max_sessions,)).fetchall()
+    conn.close()
+    expires = time.monotonic() + _OWNED_TTL
+    slug = tenants.current()
+    for teacher_id, ids in owned.items():
+        _owned_courses[(slug, teacher_id)] = (expires, frozenset(ids))
+    parsed = {}
+    for r in sessions:
+        questions = parsed.get(r['quiz_id'])
+        if questions is None:
+            questions = parsed[r['quiz_id']] = json.loads(r['questions'] or '[]')
+        quiz_layout(r['quiz_id'], r['student_id'], questions, r['draw_count'], r['shuffle'])
+    return {'teachers': len(owned), 'sessions': len(sessions)}
+
+
+# ============================================================================
+# API QUERIES
+# ============================================================================
+
+# What the /api/v1 resources expose: the columns (API name -> SQL), a FROM
+# clause that reaches the owning course as `c`, and the filters a listing
+# accepts. `own` limits students to their own rows.
+_API_RESOURCES = {
+    'courses': {
+        'from': 'courses c',
+        'cols': {'id': 'c.id', 'title': 'c.title', 'description': 'c.description',
+                 'teacher_id': 'c.teacher_id', 'code': 'c.code'},
+        'filters': {'teacher_id': 'c.teacher_id'},
+    },
+    'lessons': {
+        'from': 'lessons l JOIN courses c ON c.id = l.course_id',
+        'cols': {'id': 'l.id', 'course_id': 'l.course_id', 'title': 'l.title', 'content': 'l.content',
+                 'attachments': 'l.attachments'},
+        'filters': {'course_id': 'l.course_id'},
+    },
+    'assignments': {
+        'from': 'assignments a JOIN lessons l ON l.id = a.lesson_id JOIN courses c ON c.id = l.course_id',
+        'cols': {'id': 'a.id', 'lesson_id': 'a.lesson_id', 'course_id': 'l.course_id', 'title': 'a.title',
+                 'description': 'a.description', 'due_date': 'a.due_date'},
+        'filters': {'lesson_id': 'a.lesson_id', 'course_id': 'l.course_id'},
+    },
+    'quizzes': {
+        'from': 'quizzes q JOIN lessons l ON l.id = q.lesson_id JOIN courses c ON c.id = l.course_id',
+        'cols': {'id': 'q.id', 'lesson_id': 'q.lesson_id', 'course_id': 'l.course_id',
+                 'question_count': 'COALESCE(q.draw_count, json_array_length(q.questions))',
+                 'time_limit': 'q.time_limit', 'shuffle': 'q.shuffle'},
+        'filters': {'lesson_id': 'q.lesson_id', 'course_id': 'l.course_id'},
+    },
+    'submissions': {
+        'from': 'submissions s JOIN users u ON u.id = s.student_id JOIN assignments a ON a.id = s.assignment_id '
+                'JOIN lessons l ON l.id = a.lesson_id JOIN courses c ON c.id = l.course_id',
+        'cols': {'id': 's.id', 'assignment_id': 's.assignment_id', 'course_id': 'l.course_id',
+                 'student_id': 's.student_id',
+                 'student_name': 'u.name', 'file_path': 's.file_path', 'text': 's.text',
+                 'submitted_at': 's.submitted_at', 'grade': 's.grade', 'feedback': 's.feedback'},
+        'filters': {'assignment_id': 's.assignment_id', 'student_id': 's.student_id', 'course_id': 'l.course_id'},
+        'own': 's.student_id',
+    },
+}
+
+
+def api_fields(kind: str) -> tuple:
+    return tuple(_API_RESOURCES[kind]['cols'])
+
+
+def api_filters(kind: str) -> tuple:
+    return tuple(_API_RESOURCES[kind]['filters'])
+
+
+def _api_scope(user):
+    """SQL restricting `c` to the courses a user may see: taught, joined, or all for admins."""
+    if user['role'] == 'admin':
+        return '1', []
+    if user['role'] == 'teacher':
+        return 'c.teacher_id = ?', [user['id']]
+    return 'c.id IN (SELECT course_id FROM class_members WHERE student_id = ?)', [user['id']]
+
+
+def api_list(kind: str, user, fields=None, filters=None, ids=None, after: int = None, limit: int = 50):
+    """
+    Rows of an API resource visible to user, ordered by id.
+
+    fields picks columns (default: all); filters maps filter names to a value
+    or a list of values; ids fetches specific rows. Keyset pagination: pass
+    the last id seen as `after`. Returns (rows, has_more).
+    """
+    spec = _API_RESOURCES[kind]
+    cols = spec['cols']
+    pk = cols['id']
+    select = ', '.join(f'{cols[f]} AS {f}' for f in (fields or cols))
+    scope, params = _api_scope(user)
+    where = [scope]
+    if spec.get('own') and user['role'] == 'student':
+        where.append(f"{spec['own']} = ?")
+        params.append(user['id'])
+    for name, value in (filters or {}).items():
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        where.append(f"{spec['filters'][name]} IN ({', '.join('?' * len(values))})")
+        params.extend(values)
+    if ids is not None:
+        where.append(f"{pk} IN ({', '.join('?' * len(ids))})")
+        params.extend(ids)
+    if after is not None:
+        where.append(f'{pk} > ?')
+        params.append(after)
+    sql = f"SELECT {select} FROM {spec['from']} WHERE {' AND '.join(where)} ORDER BY {pk} LIMIT ?"
+    conn = _get_read_conn()
+    rows = conn.execute(sql, params + [limit + 1]).fetchall()
+    conn.close()
+    return [dict(r) for r in rows[:limit]], len(rows) > limit
+
+
+def student_progress(student_id: int) -> dict:
+    """Overall and per-course progress of a student (what /progress shows, broken down by course)."""
+    conn = _get_read_conn()
+    courses = [dict(r) for r in conn.execute('''
+        SELECT c.id AS course_id, c.title,
+               (SELECT COUNT(*) FROM lessons l WHERE l.course_id = c.id) AS lessons,
+               (SELECT COUNT(*) FROM assignments a JOIN lessons l ON l.id = a.lesson_id
+                 WHERE l.course_id = c.id) AS assignments,
+               (SELECT COUNT(DISTINCT s.assignment_id) FROM submissions s JOIN assignments a ON a.id = s.assignment_id
+                  JOIN lessons l ON l.id = a.lesson_id WHERE l.course_id = c.id AND s.student_id = cm.student_id) AS submitted,
+               (SELECT ROUND(AVG(s.grade), 2) FROM submissions s JOIN assignments a ON a.id = s.assignment_id
+                  JOIN lessons l ON l.id = a.lesson_id WHERE l.course_id = c.id AND s.student_id = cm.student_id) AS avg_grade,
+               (SELECT ROUND((TOTAL(t.score) + (SELECT TOTAL(r.compacted_score) FROM attempt_summaries r
+                                  JOIN quizzes q ON q.id = r.quiz_id JOIN lessons l ON l.id = q.lesson_id
+                                  WHERE l.course_id = c.id AND r.student_id = cm.student_id))
+                             / NULLIF(COUNT(t.score) + (SELECT TOTAL(r.compacted) FROM attempt_summaries r
+                                  JOIN quizzes q ON q.id = r.quiz_id JOIN lessons l ON l.id = q.lesson_id
+                                  WHERE l.course_id = c.id AND r.student_id = cm.student_id), 0), 2)
+                  FROM attempts t JOIN quizzes q ON q.id = t.quiz_id
+                  JOIN lessons l ON l.id = q.lesson_id WHERE l.course_id = c.id AND t.student_id = cm.student_id) AS avg_quiz_score
+        FROM class_members cm JOIN courses c ON c.id = cm.course_id
+        WHERE cm.student_id = ? ORDER BY c.id''', (student_id,)).fetchall()]
+    completed = conn.execute('SELECT COUNT(DISTINCT a.lesson_id) FROM submissions s JOIN assignments a ON a.id = s.assignment_id '
+                             'WHERE s.student_id = ?', (student_id,)).fetchone()[0]
+    total = conn.execute('SELECT COUNT(*) FROM lessons').fetchone()[0]
+    # compacted attempts (see compact_attempts) still count towards the average
+    avg = conn.execute('SELECT ROUND((a.total + s.total) / NULLIF(a.n + s.n, 0), 2) '
+                       'FROM (SELECT TOTAL(score) AS total, COUNT(score) AS n FROM attempts WHERE student_id = ?) a, '
+                       '(SELECT TOTAL(compacted_score) AS total, TOTAL(compacted) AS n FROM attempt_summaries WHERE student_id = ?) s',
+                       (student_id, student_id)).fetchone()[0]
+    conn.close()
+    return {'completed_lessons': completed, 'total_lessons': total, 'avg_quiz_score': avg, 'courses': courses}
@@ -0,0 +1,441 @@
+"""
+Per-institution database shards.
+
+Every institution (tenant) hosted on a deployment gets its own SQLite file
+and uploads directory, so schools no longer queue behind one database write
+lock: a submission rush at one school does not slow down another.
+
+The tenant for a request is chosen in app.py (subdomain first, then the
+session) and held in a context variable; app.get_db() and
+services._get_conn() both call connect(), which hands out a connection to
+that tenant's shard from a small per-shard pool. Background jobs and CLI
+tools select a shard explicitly with `with tenants.use(slug):`.
+
+Each shard has two pools. connect(readonly=True) hands out read-only
+connections (mode=ro, query_only) for pages and reports, so a long read
+never holds anything a writer needs. Write connections serialize their
+transactions: one write transaction per shard at a time in each process,
+opened with BEGIN IMMEDIATE so the lock is taken up front instead of failing
+halfway, and retried with jittered backoff while another process writes.
+
+Configuration (environment variables):
+    TENANTS         comma-separated tenant slugs, optionally slug=path to
+                    place a shard's database explicitly, e.g.
+                    "whhi=database.db,zds". Unset means a single tenant
+                    named "default" using database.db and uploads/, exactly
+                    as before sharding.
+    TENANT_DIR      where shards without an explicit path live, as
+                    <TENANT_DIR>/<slug>/database.db and .../uploads/
+                    (default: ./tenants)
+    DEFAULT_TENANT  tenant used when none can be resolved (default: the
+                    first one listed)
+    DB_POOL_SIZE    idle write connections kept per shard and process (default: 8)
+    DB_READ_POOL_SIZE  idle read-only connections kept per shard and process (default: 16)
+    DB_WRITE_RETRIES   BEGIN IMMEDIATE attempts after the first while another
+                       process holds the write lock (default: 10)
+    DB_PROFILE      PRAGMA tuning profile applied to every new connection:
+                    balanced (default), durable or low-memory; see PROFILES
+    DB_PRAGMAS      per-setting overrides, e.g. "cache_size=-65536,mmap_size=0"
+"""
+
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.request import pathname2url
+
+BASE_DIR = os.path.dirname(__file__)
+DB_PATH = os.path.join(BASE_DIR, 'database.db')
+UPLOAD_DIR = os.path.join(BASE_DIR, 'uploads')
+TENANT_DIR = os.environ.get('TENANT_DIR', os.path.join(BASE_DIR, 'tenants'))
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+READ_POOL_SIZE = int(os.environ.get('DB_READ_POOL_SIZE', 16))
+WRITE_RETRIES = int(os.environ.get('DB_WRITE_RETRIES', 10))
+WRITE_BUSY_MS = 100          # SQLite's own wait per BEGIN IMMEDIATE attempt
+WRITE_BACKOFF = 0.005        # first retry sleeps up to 5 ms, doubling ...
+WRITE_BACKOFF_MAX = 0.25     # ... up to 250 ms
+WRITE_LOCK_TIMEOUT = 10      # seconds to wait for this process's other writers
+
+# Applied once when a pooled connection is opened. journal_mode and
+# foreign_keys are always set; busy_timeout replaces the connect() timeout.
+PROFILES = {
+    # WAL + synchronous=NORMAL only risks the last transactions on power loss,
+    # never corruption; a 64 MiB page cache and 256 MiB of mmap per connection
+    'balanced': {'synchronous': 'NORMAL', 'cache_size': -65536, 'mmap_size': 268435456,
+                 'temp_store': 'MEMORY', 'busy_timeout': 10000, 'journal_size_limit': 67108864},
+    'durable': {'synchronous': 'FULL', 'cache_size': -65536, 'mmap_size': 268435456,
+                'temp_store': 'MEMORY', 'busy_timeout': 10000, 'journal_size_limit': 67108864},
+    'low-memory': {'synchronous': 'NORMAL', 'cache_size': -8192, 'mmap_size': 0,
+                   'temp_store': 'DEFAULT', 'busy_timeout': 10000, 'journal_size_limit': 16777216},
+}
+
+
+def _load_pragmas(profile, overrides):
+    if profile not in PROFILES:
+        raise ValueError(f'unknown DB_PROFILE {profile!r}; choose from {", ".join(PROFILES)}')
+    pragmas = dict(PROFILES[profile])
+    for item in filter(None, (s.strip() for s in overrides.split(','))):
+        name, _, value = item.partition('=')
+        name, value = name.strip().lower(), value.strip()
+        if not re.match(r'^[a-z_]+$', name) or not re.match(r'^-?\w+$', value):
+            raise ValueError(f'invalid DB_PRAGMAS entry {item!r}')
+        pragmas[name] = value
+    return pragmas
+
+
+PRAGMAS = _load_pragmas(os.environ.get('DB_PROFILE', 'balanced'), os.environ.get('DB_PRAGMAS', ''))
+BUSY_TIMEOUT = int(PRAGMAS.get('busy_timeout', 10000))
+
+_SLUG = re.compile(r'^[a-z0-9][a-z0-9-]{0,62}$')
+
+
+class Shard:
+    """One tenant's database file, uploads directory and connection pools."""
+
+    def __init__(self, slug, db_path, upload_dir, pool_size=POOL_SIZE, read_pool_size=READ_POOL_SIZE):
+        self.slug = slug
+        self.db_path = db_path
+        self.upload_dir = upload_dir
+        self.pool_size = pool_size
+        self.read_pool_size = read_pool_size
+        self._idle = {False: [], True: []}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._write_owner = None   # thread holding _write_lock
+        self._pid = os.getpid()
+        self.stats = {'writes': 0, 'busy_retries': 0, 'write_wait': 0.0, 'write_wait_max': 0.0}
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # connections and held locks must not cross a fork; drop the parent's
+            self._idle, self._pid = {False: [], True: []}, os.getpid()
+            self._write_lock = threading.Lock()
+            self._write_owner = None
+
+    def acquire(self, readonly=False):
+        with self._lock:
+            self._check_pid()
+            idle = self._idle[readonly]
+            conn = idle.pop() if idle else None
+        if conn is None:
+            conn = self._open(readonly)
+        conn.row_factory = sqlite3.Row
+        conn._idle = False
+        return conn
+
+    def _open(self, readonly):
+        if not readonly:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        if readonly:
+            uri = 'file:' + pathname2url(os.path.abspath(self.db_path)) + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, timeout=10,
+                                   check_same_thread=False, factory=PooledConnection)
+            pragmas = dict(PRAGMAS, query_only=1)
+        else:
+            # the implicit BEGIN before DML becomes BEGIN IMMEDIATE should one
+            # slip past PooledConnection.execute (e.g. through a cursor)
+            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False,
+                                   isolation_level='IMMEDIATE', factory=PooledConnection)
+            pragmas = dict(PRAGMAS)
+            try:
+                conn.execute('PRAGMA journal_mode=WAL;')
+            except Exception:
+                pass
+        pragmas['foreign_keys'] = 'ON'
+        for name, value in pragmas.items():
+            try:
+                conn.execute(f'PRAGMA {name} = {value};')
+            except Exception:
+                pass
+        conn._shard = self
+        conn._readonly = readonly
+        return conn
+
+    def release(self, conn) -> bool:
+        """Take a connection back into the pool; False if it should really be closed."""
+        if conn._idle:
+            return True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            return False
+        size = self.read_pool_size if conn._readonly else self.pool_size
+        with self._lock:
+            idle = self._idle[conn._readonly]
+            if self._pid != os.getpid() or len(idle) >= size:
+                return False
+            conn._idle = True
+            idle.append(conn)
+        return True
+
+    def begin_write(self, conn):
+        """
+        Start a write transaction on conn: one at a time per shard in this
+        process, then BEGIN IMMEDIATE against other processes, retried with
+        jittered backoff while the database is busy.
+        """
+        start = time.monotonic()
+        if self._write_owner == threading.get_ident():
+            # the lock is not reentrant: waiting would only time out
+            raise RuntimeError(f'nested write on shard {self.slug!r}: this thread already has a write transaction '
+                               'open on another connection; do the work on that connection or commit it first')
+        if not self._write_lock.acquire(timeout=WRITE_LOCK_TIMEOUT):
+            raise sqlite3.OperationalError('database is locked')
+        self._write_owner = threading.get_ident()
+        conn._writing = True
+        # SQLite's busy handler waits only briefly per attempt; the backoff
+        # below spreads competing processes out instead
+        sqlite3.Connection.execute(conn, f'PRAGMA busy_timeout = {WRITE_BUSY_MS}')
+        try:
+            for attempt in range(WRITE_RETRIES + 1):
+                try:
+                    sqlite3.Connection.execute(conn, 'BEGIN IMMEDIATE')
+                    break
+                except sqlite3.OperationalError as e:
+                    if attempt == WRITE_RETRIES or ('locked' not in str(e) and 'busy' not in str(e)):
+                        raise
+                    self.stats['busy_retries'] += 1
+                    time.sleep(random.uniform(0, min(WRITE_BACKOFF_MAX, WRITE_BACKOFF * 2 ** attempt)))
+        except BaseException:
+            self.end_write(conn)
+            raise
+        finally:
+            sqlite3.Connection.execute(conn, f'PRAGMA busy_timeout = {BUSY_TIMEOUT}')
+        wait = time.monotonic() - start
+        self.stats['writes'] += 1
+        self.stats['write_wait'] += wait
+        self.stats['write_wait_max'] = max(self.stats['write_wait_max'], wait)
+
+    def end_write(self, conn):
+        if conn._writing:
+            conn._writing = False
+            self._write_owner = None
+            try:
+                self._write_lock.release()
+            except RuntimeError:
+                pass  # lock was replaced after a fork
+
+    def close_idle(self):
+        with self._lock:
+            idle, self._idle = self._idle[False] + self._idle[True], {False: [], True: []}
+        for conn in idle:
+            sqlite3.Connection.close(conn)
+
+    def __repr__(self):
+        return f'<Shard {self.slug} {self.db_path}>'
+
+
+_DML = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3 connection whose close() returns it to its shard's pool. On a
+    writer, the first INSERT/UPDATE/DELETE/REPLACE outside a transaction
+    goes through Shard.begin_write; commit, rollback or close ends it.
+    begin_write() starts the transaction explicitly, for work that has to
+    read under the write lock before its first write.
+    """
+
+    _shard = None
+    _idle = False
+    _readonly = False
+    _writing = False
+
+    def _before(self, sql) -> bool:
+        if not self._readonly and self._shard is not None and not self.in_transaction \
+                and sql.lstrip()[:7].upper().startswith(_DML):
+            self._shard.begin_write(self)
+            return True
+        return False
+
+    def begin_write(self):
+        """
+        Start the write transaction now (no-op if one is open), so the reads
+        that follow see exactly what the writes will change. Use inside
+        `with conn:`, which commits or rolls back and releases the lock.
+        """
+        if self._readonly:
+            raise sqlite3.OperationalError('begin_write on a read-only connection')
+        if self.in_transaction:
+            return
+        if self._shard is None:
+            super().execute('BEGIN IMMEDIATE')
+        else:
+            self._shard.begin_write(self)
+
+    def _after(self):
+        if self._writing and not self.in_transaction:
+            self._shard.end_write(self)
+
+    def execute(self, sql, *args):
+        began = self._before(sql)
+        try:
+            return super().execute(sql, *args)
+        except sqlite3.Error:
+            # the statement that opened the transaction failed (e.g. a duplicate
+            # email): nothing to keep, so don't hold the write lock until close()
+            if began and self.in_transaction:
+                super().rollback()
+            raise
+        finally:
+            self._after()
+
+    def executemany(self, sql, *args):
+        began = self._before(sql)
+        try:
+            return super().executemany(sql, *args)
+        except sqlite3.Error:
+            # the statement that opened the transaction failed (e.g. a duplicate
+            # email): nothing to keep, so don't hold the write lock until close()
+            if began and self.in_transaction:
+                super().rollback()
+            raise
+        finally:
+            self._after()
+
+    def executescript(self, script):
+        try:
+            return super().executescript(script)
+        finally:
+            self._after()
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._after()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._after()
+
+    def __exit__(self, *exc):
+        try:
+            return super().__exit__(*exc)
+        finally:
+            self._after()
+
+    def close(self):
+        if self._shard is None or not self._shard.release(self):
+            self._idle = True
+            super().close()
+        if self._writing:
+            self._shard.end_write(self)
+
+    def __del__(self):
+        if self._writing:
+            self._shard.end_write(self)
+
+
+def _load_shards(spec):
+    shards = {}
+    for item in filter(None, (s.strip() for s in spec.split(','))):
+        slug, _, path = item.partition('=')
+        slug = slug.strip().lower()
+        if not _SLUG.match(slug):
+            raise ValueError(f'invalid tenant slug {slug!r} in TENANTS')
+        root = os.path.join(TENANT_DIR, slug)
+        db_path = os.path.join(BASE_DIR, path.strip()) if path.strip() else os.path.join(root, 'database.db')
+        # the shard that keeps database.db keeps uploads/ too
+        upload_dir = UPLOAD_DIR if os.path.abspath(db_path) == os.path.abspath(DB_PATH) else os.path.join(root, 'uploads')
+        shards[slug] = Shard(slug, db_path, upload_dir)
+    return shards
+
+
+SHARDS = _load_shards(os.environ.get('TENANTS', '')) or {'default': Shard('default', DB_PATH, UPLOAD_DIR)}
+MULTI = len(SHARDS) > 1
+DEFAULT = os.environ.get('DEFAULT_TENANT') or next(iter(SHARDS))
+if DEFAULT not in SHARDS:
+    raise ValueError(f'DEFAULT_TENANT {DEFAULT!r} is not listed in TENANTS')
+
+_current = ContextVar('tenant', default=None)
+
+
+def slugs() -> list:
+    return list(SHARDS)
+
+
+def known(slug) -> bool:
+    return slug in SHARDS
+
+
+def current() -> str:
+    """Slug of the tenant selected for this request or job."""
+    return _current.get() or DEFAULT
+
+
+def shard(slug: str = None) -> Shard:
+    return SHARDS[slug or current()]
+
+
+def activate(slug: str):
+    """Select a tenant for the current context; returns a token for deactivate()."""
+    if slug not in SHARDS:
+        raise KeyError(f'unknown tenant {slug!r}')
+    return _current.set(slug)
+
+
+def deactivate(token):
+    try:
+        _current.reset(token)
+    except ValueError:
+        # reset from a different context than activate() ran in
+        _current.set(None)
+
+
+@contextmanager
+def use(slug: str):
+    token = activate(slug)
+    try:
+        yield SHARDS[slug]
+    finally:
+        deactivate(token)
+
+
+def connect(slug: str = None, readonly: bool = False) -> sqlite3.Connection:
+    """Pooled connection to a tenant's shard (the current tenant by default)."""
+    return shard(slug).acquire(readonly)
+
+
+def db_path(slug: str = None) -> str:
+    return shard(slug).db_path
+
+
+def upload_dir(slug: str = None) -> str:
+    return shard(slug).upload_dir
+
+
+def from_host(host: str):
+    """Tenant named by the first label of a Host header (zds.example.edu -> zds), if any."""
+    label = (host or '').split(':', 1)[0].split('.', 1)[0].lower()
+    return label if '.' in (host or '') and label in SHARDS else None
+
+
+def prepare():
+    """Create every shard's database and upload directories (app.create_app calls this)."""
+    for sh in SHARDS.values():
+        os.makedirs(os.path.dirname(sh.db_path) or '.', exist_ok=True)
+        os.makedirs(sh.upload_dir, exist_ok=True)
+
+
+def close_all():
+    """Close the idle pooled connections of every shard, e.g. before gunicorn forks workers."""
+    for sh in SHARDS.values():
+        sh.close_idle()
+
+
+def each(fn, *args, **kwargs) -> dict:
+    """Run fn once per shard with that tenant selected; returns {slug: result}."""
+    out = {}
+    for slug in SHARDS:
+        with use(slug):
+            out[slug] = fn(*args, **kwargs)
+    return out
@@ -0,0 +1,86 @@
+"""
+ZIP archives written on the fly for streaming responses.
+
+zipfile can write to an output that cannot seek: it then puts each entry's
+CRC and sizes in a data descriptor after the data instead of going back to
+patch the local header. stream_zip() feeds it a sink that only collects
+bytes and yields them as soon as they are written, so the first bytes leave
+right away and memory stays at about one CHUNK_SIZE no matter how large
+the files are.
+
+Formats that are already compressed (images, video, PDFs, Office files,
+archives) are stored as-is; only text-like files are deflated.
+"""
+
+import os
+import time
+import zipfile
+
+CHUNK_SIZE = 64 * 1024
+# already compressed: deflating again costs CPU and saves nothing
+STORED_EXTENSIONS = frozenset((
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.m4a', '.ogg', '.mp4', '.mov', '.avi', '.mkv', '.webm',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub',
+))
+
+
+class _Sink:
+    """Write-only file object for ZipFile; collects bytes until drained."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def compression_for(name: str) -> int:
+    return zipfile.ZIP_STORED if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def stream_zip(entries):
+    """
+    Yield a ZIP archive chunk by chunk.
+
+    entries is an iterable of (arcname, source) where source is a path on
+    disk or bytes. It is consumed lazily, so the caller can produce entries
+    (and their contents) as the archive is sent.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for arcname, source in entries:
+            info = zipfile.ZipInfo(arcname)
+            info.compress_type = compression_for(arcname)
+            if isinstance(source, (bytes, bytearray)):
+                info.date_time = time.localtime()[:6]
+                info.file_size = len(source)
+            else:
+                st = os.stat(source)
+                # ZIP timestamps start in 1980
+                info.date_time = time.localtime(max(st.st_mtime, 315532800))[:6]
+                # a size known up front lets zipfile switch to ZIP64 for files over 4 GB
+                info.file_size = st.st_size
+            with zf.open(info, 'w') as out:
+                if isinstance(source, (bytes, bytearray)):
+                    out.write(source)
+                else:
+                    with open(source, 'rb') as f:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                            out.write(chunk)
+                            data = sink.drain()
+                            if data:
+                                yield data
+            yield sink.drain()
+    # the central directory is written on close
+    yield sink.drain()